@@ -0,0 +1,159 @@
+import numpy as np
+
+def kmeans(x: np.ndarray, k: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Spherical k-means on (roughly) unit vectors - clusters by dot product.
+    Returns the k unit-length centroids.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=False)].astype(np.float32)
+    for _ in range(iters):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        present = np.flatnonzero(counts)
+        sums[present] = np.add.reduceat(x[order], np.concatenate(([0], np.cumsum(counts)[:-1]))[present])
+        empty = counts == 0
+        # restart empty clusters from random points
+        sums[empty] = x[rng.choice(len(x), size=empty.sum())]
+        centroids = sums / np.maximum(np.linalg.norm(sums, axis=1), 1e-12)[:, None]
+    return centroids
+
+class IVFIndex:
+    """
+    Inverted file index over a MemoryStore's embedding matrix.
+    Rows are bucketed by their nearest k-means centroid, and a search only looks at the rows
+    in the nprobe buckets closest to the query, returning the best candidates rows by relevance.
+    Higher nprobe and candidates mean better recall and slower searches.
+
+    There are about sqrt(n) buckets, trained on up to sample rows per bucket.
+    The index is trained once the store reaches min_size rows, and retrained when it grows
+    retrain_factor times past the size it was trained on. Rows added in between are assigned
+    to their nearest existing centroid as they arrive.
+    Each bucket keeps a list of its rows, so a search only touches the rows it probes.
+    """
+    def __init__(
+            self,
+            nprobe: int = 8,
+            candidates: int = 200,
+            min_size: int = 5000,
+            retrain_factor: float = 4.0,
+            sample: int = 64,
+            seed: int = 0,
+        ):
+        self.nprobe = nprobe
+        self.candidates = candidates
+        self.min_size = min_size
+        self.retrain_factor = retrain_factor
+        self.sample = sample
+        self.seed = seed
+        self.centroids = None
+        self.trained_on = 0
+        self.assign = np.full(0, -1, dtype=np.int32)
+        self.pos = np.zeros(0, dtype=np.int64) # where each row is in its bucket's list
+        self.lists = [] # rows of each bucket, in the first sizes[bucket] entries
+        self.sizes = np.zeros(0, dtype=np.int64)
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def _reserve(self, n: int) -> None:
+        if n > len(self.assign):
+            grown = np.full(max(n, 2 * len(self.assign)), -1, dtype=np.int32)
+            grown[:len(self.assign)] = self.assign
+            self.assign = grown
+            pos = np.zeros(len(grown), dtype=np.int64)
+            pos[:len(self.pos)] = self.pos
+            self.pos = pos
+
+    def _build(self, n: int) -> None:
+        """the bucket lists, from scratch, for the first n rows"""
+        assign = self.assign[:n]
+        rows = np.flatnonzero(assign >= 0)
+        rows = rows[np.argsort(assign[rows], kind="stable")]
+        self.sizes = np.bincount(assign[rows], minlength=len(self.centroids)).astype(np.int64)
+        starts = np.concatenate(([0], np.cumsum(self.sizes)))
+        self.lists = []
+        for bucket, size in enumerate(self.sizes):
+            members = rows[starts[bucket]:starts[bucket + 1]]
+            self.lists.append(np.empty(max(2 * size, 16), dtype=np.int64))
+            self.lists[-1][:size] = members
+            self.pos[members] = np.arange(size)
+
+    def _insert(self, idx: int, bucket: int) -> None:
+        size = self.sizes[bucket]
+        if size == len(self.lists[bucket]):
+            self.lists[bucket] = np.concatenate((self.lists[bucket], np.empty(size, dtype=np.int64)))
+        self.lists[bucket][size] = idx
+        self.pos[idx] = size
+        self.sizes[bucket] = size + 1
+        self.assign[idx] = bucket
+
+    def _discard(self, idx: int) -> None:
+        """takes a row out of its bucket, moving the bucket's last row into its place"""
+        bucket = self.assign[idx]
+        if bucket < 0:
+            return
+        last = self.sizes[bucket] - 1
+        moved = self.lists[bucket][last]
+        self.lists[bucket][self.pos[idx]] = moved
+        self.pos[moved] = self.pos[idx]
+        self.sizes[bucket] = last
+        self.assign[idx] = -1
+
+    def maybe_train(self, store) -> bool:
+        """(Re)train on the store's embeddings if needed. Returns whether the index is usable."""
+        n = store.n
+        if n < self.min_size:
+            return False
+        if self.trained and n <= self.retrain_factor * self.trained_on:
+            return True
+
+        nlist = max(int(np.sqrt(n)), 1)
+        rng = np.random.default_rng(self.seed)
+        size = self.sample * nlist
+        train = store.decode(slice(0, n) if n <= size else np.sort(rng.choice(n, size=size, replace=False)))
+        self.centroids = kmeans(train, min(nlist, len(train)), seed=self.seed)
+        self.trained_on = n
+        self._reserve(n)
+        for start in range(0, n, 65536):
+            block = store.decode(slice(start, min(start + 65536, n)))
+            self.assign[start:start + len(block)] = np.argmax(block @ self.centroids.T, axis=1)
+        self._build(n)
+        return True
+
+    def add(self, idx: int, emb: np.ndarray) -> None:
+        """Assign a new or changed row to its nearest centroid."""
+        self._reserve(idx + 1)
+        if self.trained:
+            bucket = np.argmax(self.centroids @ np.asarray(emb, dtype=np.float32))
+            if bucket != self.assign[idx]:
+                self._discard(idx)
+                self._insert(idx, bucket)
+
+    def truncate(self, n: int) -> None:
+        for idx in n + np.flatnonzero(self.assign[n:] >= 0):
+            self._discard(idx)
+
+    def remap(self, keep: np.ndarray) -> None:
+        """Follow rows being removed from the store - keep holds the old rows that remain, in order."""
+        self.assign[:len(keep)] = self.assign[keep]
+        self.assign[len(keep):] = -1
+        # every row may have moved
+        if self.trained:
+            self._build(len(keep))
+
+    def search(self, query: np.ndarray, store) -> np.ndarray:
+        """
+        The candidates most relevant rows of the store,
+        out of the rows in the nprobe buckets nearest to the query.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        probe = np.argsort(self.centroids @ query)[-self.nprobe:]
+        rows = np.concatenate([self.lists[bucket][:self.sizes[bucket]] for bucket in probe])
+        if len(rows) <= self.candidates:
+            return np.sort(rows)
+        relevance = store.relevance(query, rows)
+        return np.sort(rows[np.argpartition(relevance, -self.candidates)[-self.candidates:]])
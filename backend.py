@@ -0,0 +1,196 @@
+from abc import ABC, abstractmethod
+from typing import Iterator
+import hashlib
+import random
+import re
+import threading
+import time
+
+import numpy as np
+
+ROLES = ["user", "assistant", "system"]
+
+class RateLimitError(Exception):
+    """Raised by a backend when a request is rejected for going over its rate limit (HTTP 429)."""
+
+class Backend(ABC):
+    """
+    The interface to an LLM provider: chat completions and embeddings.
+    Messages are lists of (role, content) tuples, with roles util.USER, util.AI and util.SYSTEM.
+    Calls are made from scheduler workers (see scheduler.py), so they're synchronous - async callers wait on those.
+    """
+
+    @abstractmethod
+    def chat(self, messages: list[tuple[int, str]], model: str, temp: float) -> str:
+        """Returns the model's reply to the messages."""
+        return ""
+
+    @abstractmethod
+    def embed(self, texts: list[str], model: str) -> np.ndarray:
+        """Returns one (unnormalized) embedding vector per text."""
+        return np.zeros((len(texts), 0), dtype=np.float32)
+
+    @property
+    def cache_id(self) -> str:
+        """Goes into the on-disk cache keys (see cache.py), so replies and vectors from different backends never mix."""
+        return type(self).__name__
+
+    def stream_chat(self, messages: list[tuple[int, str]], model: str, temp: float) -> Iterator[str]:
+        """Yields the model's reply as it arrives. Backends that can't stream yield it all at once."""
+        yield self.chat(messages, model, temp)
+
+_env_loaded = False
+
+def load_env() -> None:
+    """
+    Loads the .env file into the environment, the first time it's called.
+    Only done once a backend is needed, since python-dotenv is slow to import.
+    """
+    global _env_loaded
+    if not _env_loaded:
+        import dotenv
+        dotenv.load_dotenv()
+        _env_loaded = True
+
+class OpenAIBackend(Backend):
+    """The OpenAI API. The API client is only constructed when first used."""
+    cache_id = "openai"
+
+    def __init__(self, **client_args):
+        self._client_args = client_args
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI
+            load_env()
+            self._client = OpenAI(**self._client_args)
+        return self._client
+
+    @staticmethod
+    def _messages(messages: list[tuple[int, str]]) -> list[dict]:
+        return [{"role": ROLES[t], "content": c} for t, c in messages]
+
+    def chat(self, messages: list[tuple[int, str]], model: str, temp: float) -> str:
+        return self.client.chat.completions.create(
+            messages=self._messages(messages),
+            model=model,
+            temperature=temp
+        ).choices[0].message.content
+
+    def embed(self, texts: list[str], model: str) -> np.ndarray:
+        response = self.client.embeddings.create(input=texts, model=model)
+        return np.array([emb.embedding for emb in response.data], dtype=np.float32)
+
+    def stream_chat(self, messages: list[tuple[int, str]], model: str, temp: float) -> Iterator[str]:
+        for chunk in self.client.chat.completions.create(
+            messages=self._messages(messages),
+            model=model,
+            temperature=temp,
+            stream=True,
+        ):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+WORDS = """the a of to and in that it with as for was on are be this have from or one had by
+but not what all were when we there can an your which their said if do will each about how up out
+them then she many some so these would other into has more her two like him see time could no make
+than first been its who now people my made over did down only way find use may water long little very
+after words called just where most know get through back much before go good new write our used me
+man too any day same right look think also around another came come work three word must because does
+part even place well such here take why things help put years different away again off went old number""".split()
+
+def _digest(*parts: str) -> int:
+    return int.from_bytes(hashlib.sha256("\0".join(parts).encode("utf-8")).digest()[:8], "little")
+
+def local_response(messages: list[tuple[int, str]], model: str) -> str:
+    """
+    Deterministic stand-in for a chat reply, derived from a hash of the model and messages.
+    Knows just enough about this project's prompts to answer yes/no and rating questions in the expected format.
+    """
+    prompt = messages[-1][1] if messages else ""
+    rng = random.Random(_digest(model, *(c for _, c in messages)))
+
+    if "Return YES or NO" in prompt:
+        return rng.choice(["YES", "NO"])
+    if "rate the likely poignancy" in prompt:
+        count = len(re.findall(r"^\d+\. ", prompt, re.MULTILINE)) or 1
+        return "\n".join(str(rng.randint(1, 10)) for _ in range(count))
+
+    return "\n".join(
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 20))).capitalize() + "."
+        for _ in range(rng.randint(1, 3))
+    )
+
+class LocalBackend(Backend):
+    """
+    A deterministic, offline stand-in for a real provider, for tests and benchmarks.
+    Replies are derived from a hash of the messages (see local_response), embeddings from a hash of the text.
+    latency (+ up to jitter) seconds are slept per request, and more than rpm requests
+    in any 60 second window raise RateLimitError, like a real provider would.
+    Streamed replies come a word at a time, token_latency seconds apart.
+    """
+    def __init__(
+            self,
+            latency: float = 0.0,
+            jitter: float = 0.0,
+            rpm: int | None = None,
+            dim: int = 3072,
+            responder=local_response,
+            token_latency: float = 0.0,
+        ):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.jitter = jitter
+        self.rpm = rpm
+        self.dim = dim
+        self.responder = responder
+        self.requests = 0
+        self._window = []
+        self._lock = threading.Lock()
+
+    @property
+    def cache_id(self) -> str:
+        # embeddings depend on dim
+        return f"local-{self.dim}"
+
+    def _admit(self) -> float:
+        """Counts a request against the rate limit, and returns how long it should take."""
+        with self._lock:
+            now = time.monotonic()
+            if self.rpm is not None:
+                self._window = [t for t in self._window if now - t < 60]
+                if len(self._window) >= self.rpm:
+                    raise RateLimitError(f"more than {self.rpm} requests per minute")
+                self._window.append(now)
+            self.requests += 1
+        return self.latency + random.random() * self.jitter
+
+    def _vectors(self, texts: list[str], model: str) -> np.ndarray:
+        return np.array([
+            np.random.default_rng(_digest(model, t)).standard_normal(self.dim, dtype=np.float32)
+            for t in texts
+        ])
+
+    def chat(self, messages: list[tuple[int, str]], model: str, temp: float) -> str:
+        time.sleep(self._admit())
+        return self.responder(messages, model)
+
+    def embed(self, texts: list[str], model: str) -> np.ndarray:
+        time.sleep(self._admit())
+        return self._vectors(texts, model)
+
+    def stream_chat(self, messages: list[tuple[int, str]], model: str, temp: float) -> Iterator[str]:
+        time.sleep(self._admit())
+        for i, word in enumerate(re.findall(r"\s*\S+", self.responder(messages, model))):
+            if i:
+                time.sleep(self.token_latency)
+            yield word
+
+def from_name(name: str, **kwargs) -> Backend:
+    """Backend by name - "openai" or "local"."""
+    backends = {"openai": OpenAIBackend, "local": LocalBackend}
+    if name not in backends:
+        raise NameError(f"backend {name} not found")
+    return backends[name](**kwargs)
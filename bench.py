@@ -0,0 +1,452 @@
+"""
+Benchmarks for recall, prompt building and conversation turns, run against the local backend.
+
+    python3 bench.py --sizes 100,1000,10000,100000 --participants 2,10,50
+    python3 bench.py --compare bench_results.json --out new_results.json
+
+Results are written as JSON, and can be compared against the results of an earlier run.
+"""
+import argparse
+import contextvars
+import itertools
+import json
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+import tracing
+import util
+import ann
+import backend
+import consolidate
+import pool
+import server
+import store
+from persona import Persona, Memory, run_conv
+from speaker import SpeakerSelector
+
+class _Waited:
+    """time with at least one backend call in flight - calls made at once overlap, so they aren't simply added up"""
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.since = 0.0
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        with self.lock:
+            if not self.calls:
+                self.since = time.perf_counter()
+            self.calls += 1
+
+    def stop(self) -> None:
+        with self.lock:
+            self.calls -= 1
+            if not self.calls:
+                self.seconds += time.perf_counter() - self.since
+
+# the _Waited of whatever asked, and of the scheduler jobs it submitted
+_waited = contextvars.ContextVar("waited", default=None)
+
+class TimedBackend(backend.Backend):
+    """
+    Wraps a backend, adding up how long it's waited on for each caller.
+    Calls mostly run on scheduler workers, so waits go to the context that submitted them (see Job.context) rather than the thread.
+    """
+    def __init__(self, inner: backend.Backend):
+        self.inner = inner
+
+    def _timed(self, fn, *args):
+        waited = _waited.get()
+        if waited is None:
+            return fn(*args)
+        waited.start()
+        try:
+            return fn(*args)
+        finally:
+            waited.stop()
+
+    @property
+    def cache_id(self) -> str:
+        return self.inner.cache_id
+
+    def wait(self) -> float:
+        """seconds this context has waited on the backend - counted from the first time it asks"""
+        waited = _waited.get()
+        if waited is None:
+            waited = _Waited()
+            _waited.set(waited)
+        with waited.lock:
+            return waited.seconds
+
+    def chat(self, messages, model, temp):
+        return self._timed(self.inner.chat, messages, model, temp)
+
+    def embed(self, texts, model):
+        return self._timed(self.inner.embed, texts, model)
+
+    def stream_chat(self, messages, model, temp):
+        chunks = self.inner.stream_chat(messages, model, temp)
+        while True:
+            chunk = self._timed(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+def synthetic_persona(name: str, n: int, dim: int, rng: np.random.Generator, topics: int | None = None) -> Persona:
+    """
+    A persona with n memories: up to 100 identity statements, the rest observations and actions
+    with random embeddings, importances and timestamps. Skips the importance scorer.
+    With topics, the embeddings are scattered around that many random topic vectors instead.
+    """
+    identity = [f"You are {name}. Fact number {i} about {name}." for i in range(min(n, 100))]
+    persona = Persona(name, identity, "Keep responses fairly short.", [f"{name} example quote {i}." for i in range(20)], 0.4)
+
+    vectors = rng.standard_normal((n - len(identity), dim), dtype=np.float32)
+    if topics:
+        centers = rng.standard_normal((topics, dim), dtype=np.float32)
+        vectors = centers[rng.integers(0, topics, len(vectors))] + 0.5 * vectors
+    vectors /= np.linalg.norm(vectors, axis=1)[:, None]
+    for i, vector in enumerate(vectors):
+        mem = Memory(Memory.IDENTITY, f"{name} observed event number {i}.", i) # identity skips importance scoring
+        mem.type = Memory.OBSERVATION if i % 2 else Memory.ACTION
+        mem.imp = rng.integers(1, 11) / 10
+        mem.acc = i + rng.integers(0, max(n - i, 1))
+        persona.mem.append(mem)
+        mem.set_emb(vector)
+    persona.time = n
+    return persona
+
+def timings(fn, repeat: int) -> list[float]:
+    result = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        result.append(time.perf_counter() - start)
+    return result
+
+def summary(times: list[float]) -> dict:
+    ms = np.array(times) * 1000
+    return {
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "runs": len(ms),
+    }
+
+def peak_alloc(fn) -> int:
+    """peak bytes allocated while running fn"""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_recall(n: int, args, rng: np.random.Generator) -> list[dict]:
+    persona = synthetic_persona("Bench", n, args.dim, rng)
+    mem = persona.mem
+    queries = rng.standard_normal((args.repeat, args.dim), dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1)[:, None]
+    query_iter = itertools.cycle(queries)
+
+    def query() -> Memory:
+        q = Memory(Memory.QUERY, "[QUERY]", persona.time)
+        q.set_emb(next(query_iter))
+        return q
+
+    def queries_n() -> list[Memory]:
+        return [query() for _ in range(args.queries)]
+
+    base = mem.base_scores(queries[0], persona.time)
+    recalled = persona.recall(query(), args.k)
+    stages = {
+        "recall_scoring": lambda: mem.base_scores(next(query_iter), persona.time),
+        "topk_selection": lambda: store.select(mem._settle(base, args.k), args.k),
+        "nonrel_topk": lambda: mem.top_nonrel(persona.time, args.k),
+        "recall": lambda: persona.recall(query(), args.k),
+        # reflect's questions, batched vs one recall each
+        "multi_recall": lambda: persona.recall_many(queries_n(), args.k, fuse="rrf"),
+        "multi_recall_loop": lambda: [persona.recall(q, args.k) for q in queries_n()],
+        "prompt_building": lambda: persona.build_prompt(recalled),
+    }
+    if n <= args.last_n_max:
+        # the sort-based recall this repo used to do, for comparison
+        stages["last_n_recall"] = lambda: util.last_n(list(mem), args.k, key=lambda m, q=query(): persona.recall_score(q, m))
+
+    index = ann.IVFIndex(nprobe=args.nprobe, candidates=args.candidates)
+
+    def recall_with(idx: ann.IVFIndex | None, vector: np.ndarray) -> list[Memory]:
+        q = Memory(Memory.QUERY, "[QUERY]", persona.time)
+        q.set_emb(vector)
+        mem.index = idx
+        try:
+            return persona.recall(q, args.k)
+        finally:
+            mem.index = None
+
+    if args.ann:
+        stages["ann_recall"] = lambda: recall_with(index, next(query_iter))
+
+    results = []
+    for stage, fn in stages.items():
+        fn() # warm up
+        row = {"bench": "recall", "memories": n, "stage": stage, **summary(timings(fn, args.repeat))}
+        if args.allocs:
+            row["peak_alloc_kb"] = peak_alloc(fn) / 1024
+        results.append(row)
+
+    for setting in filter(None, args.precision.split(",")):
+        # e.g. "int8:256" - int8 embeddings truncated to 256 dimensions
+        dtype, _, dim = setting.partition(":")
+        compact = mem.compact(dtype, int(dim) if dim else None)
+        fn = lambda: compact.top_rows(next(query_iter), persona.time, args.k)
+        fn()
+        results.append({
+            "bench": "recall", "memories": n, "stage": f"recall_{setting}", **summary(timings(fn, args.repeat)),
+            "topk_overlap": store.precision_overlap(mem, queries, persona.time, args.k, dtype, int(dim) if dim else None),
+            "emb_mb": compact.nbytes / 2 ** 20,
+        })
+
+    if args.ann:
+        # fraction of the exact top k that the index finds
+        overlap = [
+            len({id(m) for m in recall_with(None, q)} & {id(m) for m in recall_with(index, q)}) / args.k
+            for q in queries
+        ]
+        next(r for r in results if r["stage"] == "ann_recall")["topk_overlap"] = float(np.mean(overlap))
+    return results
+
+def bench_consolidation(n: int, args, rng: np.random.Generator) -> list[dict]:
+    """Recall on a consolidated stream, and how much of the unconsolidated top k it still finds."""
+    seed = int(rng.integers(2 ** 32))
+    full = synthetic_persona("Bench", n, args.dim, np.random.default_rng(seed), topics=args.topics)
+    small = synthetic_persona("Bench", n, args.dim, np.random.default_rng(seed), topics=args.topics)
+    start = time.perf_counter()
+    consolidate.consolidate(small, args.consolidate)
+    elapsed = time.perf_counter() - start
+
+    queries = rng.standard_normal((args.repeat, args.dim), dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1)[:, None]
+
+    def recall(persona: Persona, vector: np.ndarray) -> list[Memory]:
+        q = Memory(Memory.QUERY, "[QUERY]", persona.time)
+        q.set_emb(vector)
+        return persona.recall(q, args.k)
+
+    def covered(exact: list[Memory], found: list[Memory]) -> float:
+        # a memory counts as found if it was recalled itself, or through a summary of it
+        seen = {m.desc for m in found} | {r.desc for m in found if m.type == Memory.SUMMARY for r in m.ref}
+        return float(np.mean([m.desc in seen for m in exact]))
+
+    query_iter = itertools.cycle(queries)
+    fn = lambda: recall(small, next(query_iter))
+    fn()
+    return [{
+        "bench": "recall", "memories": n, "stage": f"consolidated_recall_{args.consolidate}",
+        **summary(timings(fn, args.repeat)),
+        "recall_quality": float(np.mean([covered(recall(full, q), recall(small, q)) for q in queries])),
+        "memories_after": len(small.mem),
+        "consolidate_s": elapsed,
+    }]
+
+def worker_setup(latency: float, token_latency: float, dim: int) -> None:
+    """sets up a PersonaPool worker like main does this process"""
+    util.EMBED_CACHE = None
+    util.RESPONSE_CACHE = None
+    util.set_backend(backend.LocalBackend(latency=latency, token_latency=token_latency, dim=dim))
+
+def bench_conv(participants: int, args, rng: np.random.Generator, timed: TimedBackend) -> list[dict]:
+    personas = [synthetic_persona(f"Bench{i}", args.conv_memories, args.dim, rng) for i in range(participants)]
+    workers = None
+    if args.workers:
+        # the backend is waited on in the workers, so backend_wait doesn't count it
+        workers = pool.PersonaPool(args.workers, worker_setup, (args.latency, args.token_latency, args.dim))
+        personas = [workers.add(p) for p in personas]
+    try:
+        return _bench_conv(personas, args, timed)
+    finally:
+        if workers is not None:
+            workers.close()
+
+def _bench_conv(personas: list, args, timed: TimedBackend) -> list[dict]:
+    participants = len(personas)
+    selector = SpeakerSelector(args.speculate)
+    conv = run_conv(personas, stream=args.stream, selector=selector)
+    next(conv) # introductions and first turn
+
+    turn_times, waits, ttfts = [], [], []
+    for _ in range(args.turns):
+        wait = timed.wait()
+        start = time.perf_counter()
+        line = next(conv)
+        if args.stream:
+            # time from the start of the turn to the first chunk of the new line
+            _, chunks = line
+            next(chunks, None)
+            ttfts.append(time.perf_counter() - start)
+            chunks.drain()
+        turn_times.append(time.perf_counter() - start)
+        waits.append(timed.wait() - wait)
+
+    overhead = [t - w for t, w in zip(turn_times, waits)]
+    results = [
+        {"bench": "conv", "participants": participants, "stage": "turn", **summary(turn_times)},
+        {"bench": "conv", "participants": participants, "stage": "backend_wait", **summary(waits)},
+        {"bench": "conv", "participants": participants, "stage": "own_overhead", **summary(overhead)},
+    ]
+    if args.stream:
+        results.append({"bench": "conv", "participants": participants, "stage": "time_to_first_token", **summary(ttfts)})
+    results[0]["turns_per_s"] = len(turn_times) / sum(turn_times)
+    # how much of each prompt a provider's prefix cache could reuse - not known here for personas in workers
+    if not args.workers:
+        prompts = [p.prompts.stats() for p in personas]
+        for key in ("prompt_tokens", "prefix_tokens"):
+            results[0][key] = float(np.mean([s[key] for s in prompts]))
+    if participants > 2 and not args.stream:
+        results[0]["draft_hit_rate"] = selector.stats()["hit_rate"]
+    return results
+
+def bench_server(sessions: int, args, rng: np.random.Generator) -> list[dict]:
+    """
+    sessions users at once, each with a session with one persona over a local socket, saying args.turns lines.
+    The personas are forks of one synthetic persona with args.conv_memories memories.
+    """
+    roster = server.Roster(lambda identifier: None)
+    roster.add("Bench", synthetic_persona("Bench", args.conv_memories, args.dim, rng))
+    with tempfile.TemporaryDirectory() as session_dir:
+        srv = server.Server(roster, session_dir)
+        tcp = srv.listen(port=0)
+        threading.Thread(target=tcp.serve_forever, daemon=True).start()
+        times = [[] for _ in range(sessions)]
+
+        def user(i: int) -> None:
+            conn = server.Connection(port=tcp.server_address[1])
+            session = conn.request("open", personas=["Bench"])["session"]
+            for turn in range(args.turns):
+                start = time.perf_counter()
+                conn.request("say", session=session, text=f"user {i} line {turn}")
+                times[i].append(time.perf_counter() - start)
+            conn.close()
+
+        start = time.perf_counter()
+        users = [threading.Thread(target=user, args=(i,)) for i in range(sessions)]
+        for t in users:
+            t.start()
+        for t in users:
+            t.join()
+        elapsed = time.perf_counter() - start
+        stats = srv.handle({"op": "stats"})
+        evict = timings(srv.evict_all, 1)[0]
+        tcp.shutdown()
+        tcp.server_close()
+
+    row = {"bench": "server", "participants": sessions, "stage": "say", **summary([t for ts in times for t in ts])}
+    row["turns_per_s"] = sessions * args.turns / elapsed
+    row["session_kb"] = stats["session_bytes"] / sessions / 1024 # embeddings each session holds on its own
+    row["shared_kb"] = stats["shared_bytes"] / 1024
+    row["evict_ms_per_session"] = evict / sessions * 1000
+    return [row]
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def row_key(row: dict) -> tuple:
+    return tuple((k, row[k]) for k in ("bench", "memories", "participants", "stage") if k in row)
+
+def compare(old: dict, new: dict, threshold: float) -> list[str]:
+    """Lines describing the change in mean time for each row in both results, marking regressions."""
+    old_rows = {row_key(r): r for r in old["results"]}
+    lines = []
+    for row in new["results"]:
+        prev = old_rows.get(row_key(row))
+        if prev is None or not prev["mean_ms"]:
+            continue
+        ratio = row["mean_ms"] / prev["mean_ms"]
+        flag = "  REGRESSION" if ratio > threshold else ""
+        name = " ".join(f"{k}={v}" for k, v in row_key(row))
+        lines.append(f"{name}: {prev['mean_ms']:.3f}ms -> {row['mean_ms']:.3f}ms ({ratio:.2f}x){flag}")
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,1000,10000,100000", help="memory counts for the recall benchmarks")
+    parser.add_argument("--participants", default="2,10,50", help="persona counts for the conversation benchmarks")
+    parser.add_argument("--dim", type=int, default=512, help="embedding size (text-embedding-3-large is 3072)")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=3, help="queries per recall in the multi-query recall benchmarks")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--conv-memories", type=int, default=1000)
+    parser.add_argument("--sessions", default="", help="concurrent sessions for the server benchmarks, e.g. 10,100")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated backend latency, in seconds")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="simulated time between streamed words, in seconds")
+    parser.add_argument("--speculate", type=int, default=0, help="speakers to draft speculatively in conversations of more than two")
+    parser.add_argument("--stream", action="store_true", help="stream conversation turns, measuring time to first token")
+    parser.add_argument("--workers", type=int, default=0, help="host the conversations' personas in this many worker processes")
+    parser.add_argument("--last-n-max", type=int, default=10000, help="largest size to also time the old sort-based recall on")
+    parser.add_argument("--ann", action="store_true", help="also time recall through an IVF index")
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--candidates", type=int, default=200)
+    parser.add_argument("--precision", default="", help="embedding storage settings to compare, e.g. float16,int8,int8:256")
+    parser.add_argument("--consolidate", type=int, help="also time recall after consolidating down to this many memories, and its recall quality")
+    parser.add_argument("--topics", type=int, default=50, help="topic clusters in the synthetic memories for --consolidate")
+    parser.add_argument("--trace", help="also trace the benchmarks, exporting every span to this JSONL file")
+    parser.add_argument("--allocs", action="store_true", help="also measure peak allocations (slow)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", help="earlier results to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio counted as a regression")
+    args = parser.parse_args()
+
+    util.EMBED_CACHE = None # measure our own code, not the disk
+    util.RESPONSE_CACHE = None
+    timed = TimedBackend(backend.LocalBackend(latency=args.latency, token_latency=args.token_latency, dim=args.dim))
+    util.set_backend(timed)
+    rng = np.random.default_rng(args.seed)
+    if args.trace:
+        tracing.export(args.trace)
+
+    results = []
+    for n in map(int, args.sizes.split(",")):
+        results.extend(bench_recall(n, args, rng))
+        if args.consolidate and n > args.consolidate:
+            results.extend(bench_consolidation(n, args, rng))
+        print(f"recall benchmarks done for {n} memories")
+    for m in map(int, args.participants.split(",")):
+        results.extend(bench_conv(m, args, rng, timed))
+        print(f"conversation benchmarks done for {m} participants")
+    for m in map(int, filter(None, args.sessions.split(","))):
+        results.extend(bench_server(m, args, rng))
+        print(f"server benchmarks done for {m} sessions")
+
+    if args.trace:
+        # summed span attributes like memories mustn't be taken for the row's own keys, see row_key
+        results.extend(
+            {"bench": "trace", "stage": name, **{k if k not in ("memories", "participants") else f"span_{k}": v for k, v in span.items()}}
+            for name, span in tracing.stats().items()
+        )
+
+    out = {"commit": git_commit(), "time": time.time(), "config": vars(args), "results": results}
+    with open(args.out, "w") as file:
+        json.dump(out, file, indent=4)
+
+    for row in results:
+        extra = f", {row['turns_per_s']:.1f} turns/s" if "turns_per_s" in row else ""
+        extra += f", top-k overlap {row['topk_overlap']:.2f}" if "topk_overlap" in row else ""
+        extra += f", recall quality {row['recall_quality']:.2f}" if "recall_quality" in row else ""
+        print(f"{' '.join(f'{k}={v}' for k, v in row_key(row))}: {row['mean_ms']:.3f}ms (p95 {row['p95_ms']:.3f}ms){extra}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            print(util.jlines(compare(json.load(file), out, args.threshold)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+def text_key(text: str) -> str:
+    """content address of a piece of text"""
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """
+    An on-disk embedding cache, keyed by the hash of the normalized text, the backend (see Backend.cache_id) and the model name.
+    Vectors live in one memory-mapped float32 file per backend and model, the index lives in sqlite.
+    When more than max_entries vectors are stored, the least recently used ones are evicted
+    and their rows reused.
+    """
+    def __init__(self, path: str, max_entries: int = 200_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._vectors = {} # model -> memmap
+        self._lock = threading.RLock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(self.path, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(self.path, "index.sqlite"), check_same_thread=False)
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS emb (model TEXT, key TEXT, row INTEGER, used REAL, PRIMARY KEY (model, key));
+                CREATE TABLE IF NOT EXISTS free (model TEXT, row INTEGER);
+                CREATE TABLE IF NOT EXISTS models (model TEXT PRIMARY KEY, dim INTEGER, capacity INTEGER, top INTEGER);
+            """)
+        return self._db
+
+    @staticmethod
+    def _model(model: str, backend: str) -> str:
+        """what the cache files the model's vectors under - a local run's vectors mustn't pass for the real model's"""
+        return f"{backend}/{model}"
+
+    def _file(self, model: str) -> str:
+        return os.path.join(self.path, model.replace("/", "_") + ".f32")
+
+    def _open(self, model: str, dim: int | None = None, rows: int = 0) -> np.memmap | None:
+        """memmap of the model's vector file, growing it to hold at least rows vectors."""
+        db = self._connect()
+        info = db.execute("SELECT dim, capacity FROM models WHERE model = ?", (model,)).fetchone()
+        if info is None:
+            if dim is None:
+                return None
+            info = (dim, 0)
+            db.execute("INSERT INTO models VALUES (?, ?, 0, 0)", (model, dim))
+
+        dim, capacity = info
+        if rows > capacity:
+            capacity = max(rows, 2 * capacity, 1024)
+            with open(self._file(model), "ab") as file:
+                file.truncate(capacity * dim * 4)
+            db.execute("UPDATE models SET capacity = ? WHERE model = ?", (capacity, model))
+
+        # another process may have grown the file since it was mapped
+        mm = self._vectors.get(model)
+        if mm is not None and mm.shape[0] != capacity:
+            del self._vectors[model]
+        if model not in self._vectors and capacity:
+            self._vectors[model] = np.memmap(self._file(model), dtype=np.float32, mode="r+", shape=(capacity, dim))
+        return self._vectors.get(model)
+
+    def _rows(self, model: str, keys: list[str]) -> dict[str, int]:
+        db = self._connect()
+        rows = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows.update(db.execute(
+                f"SELECT key, row FROM emb WHERE model = ? AND key IN ({','.join('?' * len(chunk))})",
+                (model, *chunk)
+            ).fetchall())
+        return rows
+
+    def get(self, texts: list[str], model: str, backend: str) -> tuple[list[np.ndarray | None], list[int]]:
+        """
+        Look up a list of texts.
+        Returns the vectors (None where missing) and the indices of the missing texts.
+        """
+        model = self._model(model, backend)
+        keys = [text_key(t) for t in texts]
+        with self._lock:
+            db = self._connect()
+            rows = self._rows(model, keys)
+            vectors = self._open(model) if rows else None
+            result = [None if rows.get(key) is None else np.array(vectors[rows[key]]) for key in keys]
+            missing = [i for i, v in enumerate(result) if v is None]
+
+            now = time.time()
+            db.executemany("UPDATE emb SET used = ? WHERE model = ? AND key = ?", [(now, model, k) for k in set(rows)])
+            db.commit()
+
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+            return result, missing
+
+    def put(self, texts: list[str], vectors: np.ndarray, model: str, backend: str) -> None:
+        """Store the vectors of the given texts."""
+        model = self._model(model, backend)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        new = dict(zip((text_key(t) for t in texts), vectors))
+        with self._lock:
+            db = self._connect()
+            for key in self._rows(model, list(new)):
+                del new[key]
+            if not new:
+                return
+            self._evict(model, len(new))
+
+            # reuse rows freed by eviction before growing the file
+            free = [r for r, in db.execute("SELECT row FROM free WHERE model = ? LIMIT ?", (model, len(new)))]
+            db.executemany("DELETE FROM free WHERE model = ? AND row = ?", [(model, r) for r in free])
+            self._open(model, vectors.shape[-1])
+            (top,) = db.execute("SELECT top FROM models WHERE model = ?", (model,)).fetchone()
+            rows = free + list(range(top, top + len(new) - len(free)))
+            db.execute("UPDATE models SET top = ? WHERE model = ?", (top + len(new) - len(free), model))
+
+            mm = self._open(model, rows=max(rows) + 1)
+            mm[rows] = np.stack(list(new.values()))
+            mm.flush()
+
+            now = time.time()
+            db.executemany("INSERT INTO emb VALUES (?, ?, ?, ?)", [(model, key, row, now) for key, row in zip(new, rows)])
+            db.commit()
+
+    def _evict(self, model: str, incoming: int) -> None:
+        db = self._connect()
+        (count,) = db.execute("SELECT COUNT(*) FROM emb WHERE model = ?", (model,)).fetchone()
+        excess = count + incoming - self.max_entries
+        if excess <= 0:
+            return
+        victims = db.execute(
+            "SELECT key, row FROM emb WHERE model = ? ORDER BY used LIMIT ?", (model, excess)
+        ).fetchall()
+        db.executemany("DELETE FROM emb WHERE model = ? AND key = ?", [(model, k) for k, _ in victims])
+        db.executemany("INSERT INTO free VALUES (?, ?)", [(model, r) for _, r in victims])
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM emb").fetchone()[0]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+class ResponseCache:
+    """
+    An on-disk cache of LLM replies, keyed by the backend (see Backend.cache_id), model, temperature and normalized messages.
+    By default only deterministic (temperature 0) calls are cached. Other modes:
+    "record" caches every call, sampled ones included, and "replay" answers every call
+    from the cache, raising LookupError on a miss, so a recorded run can be repeated offline.
+    "off" disables the cache.
+    Entries older than ttl seconds are treated as missing, and once the stored replies
+    take up more than max_bytes, the least recently used ones are evicted.
+    """
+    MODES = ("deterministic", "record", "replay", "off")
+
+    def __init__(self, path: str, mode: str = "deterministic", ttl: float | None = None, max_bytes: int = 256 * 2 ** 20):
+        if mode not in self.MODES:
+            raise ValueError(f"unknown response cache mode {mode}")
+        self.path = path
+        self.mode = mode
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._size = None # bytes stored, counted on first use
+        self._lock = threading.RLock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(self.path, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(self.path, "responses.sqlite"), check_same_thread=False)
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, size INTEGER, created REAL, used REAL);
+                CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+            """)
+            self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        return self._db
+
+    def cacheable(self, temp: float) -> bool:
+        return self.mode in ("record", "replay") or (self.mode == "deterministic" and temp == 0)
+
+    @staticmethod
+    def key(messages: list[tuple[int, str]], model: str, temp: float, backend: str) -> str:
+        parts = [backend, model, repr(float(temp))] + [f"{role}:{normalize_text(content)}" for role, content in messages]
+        return hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, messages: list[tuple[int, str]], model: str, temp: float, backend: str) -> str | None:
+        """The cached reply to the messages, or None."""
+        if not self.cacheable(temp):
+            return None
+        key = self.key(messages, model, temp, backend)
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is not None and (self.ttl is None or now - row[1] <= self.ttl):
+                db.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+                db.commit()
+                self.hits += 1
+                return row[0]
+            self.misses += 1
+        if self.mode == "replay":
+            raise LookupError(f"no recorded reply from {model} for: {messages[-1][1][:80]!r}")
+        return None
+
+    def put(self, messages: list[tuple[int, str]], model: str, temp: float, backend: str, response: str) -> None:
+        if not self.cacheable(temp) or response is None:
+            return
+        key = self.key(messages, model, temp, backend)
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            db = self._connect()
+            old = db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)", (key, response, size, now, now))
+            self._size += size - (old[0] if old else 0)
+            self._evict()
+            db.commit()
+
+    def _evict(self) -> None:
+        db = self._connect()
+        while self._size > self.max_bytes:
+            victims = db.execute("SELECT key, size FROM responses ORDER BY used LIMIT 100").fetchall()
+            if not victims:
+                return
+            db.executemany("DELETE FROM responses WHERE key = ?", [(k,) for k, _ in victims])
+            self._size -= sum(size for _, size in victims)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connect().execute("DELETE FROM responses")
+            self._db.commit()
+            self._size = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0, "bytes": self._size}
@@ -1,15 +1,20 @@
 from abc import ABC, abstractmethod
+from typing import Iterable
+import asyncio
 import sys
 
+from history import History
 import util
+import scheduler
 
 class Client(ABC):
 
     # name is just so the client object can easily be referred to in text
     # such as for use in conversations
-    def __init__(self, name: str = None):
+    # history defaults to the last thousand messages, with no token budget
+    def __init__(self, name: str = None, history: History | None = None):
         self.name = name
-        self._history = []
+        self._history = History() if history is None else history
         self._ready = None
 
     @abstractmethod
@@ -22,11 +27,62 @@ class Client(ABC):
         """For subclasses to implement. Gives information to the AI."""
         return
 
-    def read(self) -> str:    
-        """Gets a response from the AI."""
-        response = self._read()
-        self._history.append((1, response))
+    # the async versions default to running the sync ones in a thread
+    async def _aread(self) -> str:
+        """For subclasses to implement. Gets a response from the AI without blocking the event loop."""
+        return await asyncio.to_thread(self._read)
+
+    async def _awrite(self, data: str) -> None:
+        """For subclasses to implement. Gives information to the AI without blocking the event loop."""
+        await asyncio.to_thread(self._write, data)
+
+    async def _ais_ready(self) -> bool:
+        return await asyncio.to_thread(self._is_ready)
+
+    def _stream_read(self) -> Iterable[str]:
+        """For subclasses to implement. Gets a response from the AI a chunk at a time."""
+        yield self._read()
+
+    # set by clients whose _draft doesn't change them,
+    # so a response can be generated before it's known whether it'll be used (see speaker.py)
+    can_draft = False
+
+    def _draft(self):
+        """For subclasses that can draft. Gets a response from the AI without changing the client."""
+        raise NotImplementedError
+
+    def _use_draft(self, draft) -> str:
+        """For subclasses that can draft. Takes in a draft as if it had just been read, returning the response."""
+        raise NotImplementedError
+
+    def draft(self):
+        """
+        Gets a response from the AI without changing the client or its history, if can_draft is set.
+        Pass it to read to go with it, or just drop it.
+        """
+        return self._draft()
+
+    def read(self, draft=None) -> str:    
+        """Gets a response from the AI, or goes with one from draft()."""
+        response = self._read() if draft is None else self._use_draft(draft)
+        self._commit_read(response)
+        return response
+
+    def stream_read(self) -> util.Stream:
+        """
+        Gets a response from the AI as a stream of chunks.
+        The response only goes into the history once the stream has been read to the end.
+        """
+        return util.Stream(self._stream_read(), on_done=self._commit_read)
+
+    def _commit_read(self, response: str) -> None:
+        self._history.append(util.AI, response)
         self._ready = None
+
+    async def aread(self) -> str:
+        """async version of read()"""
+        response = await self._aread()
+        self._commit_read(response)
         return response
     
     def write(self, query: str, msg_type: int = util.USER) -> str:
@@ -34,14 +90,23 @@ class Client(ABC):
         if not isinstance(query, str):
             raise TypeError(f"Query {query} is not of type str")
         
-        self._history.append((msg_type, query))
+        self._history.append(msg_type, query)
         self._write(query)
         self._ready = None
 
+    async def awrite(self, query: str, msg_type: int = util.USER) -> None:
+        """async version of write()"""
+        if not isinstance(query, str):
+            raise TypeError(f"Query {query} is not of type str")
+
+        self._history.append(msg_type, query)
+        await self._awrite(query)
+        self._ready = None
+
     @property
     def history(self) -> list[tuple[int, str]]:
-        """a list of tuples of [type, content] storing this client's history of calls. """
-        return self._history
+        """a list of tuples of [type, content] storing this client's history of calls, as far back as it's kept. """
+        return list(self._history)
     
     def call(self, query: str) -> str:
         """
@@ -71,6 +136,17 @@ class Client(ABC):
             self._ready = self._is_ready()
         return self._ready
 
+    async def ais_ready(self) -> bool:
+        """async version of is_ready"""
+        if self._ready is None:
+            self._ready = await self._ais_ready()
+        return self._ready
+
+    async def acall(self, query: str) -> str:
+        """async version of call()"""
+        await self.awrite(query)
+        return await self.aread()
+
     def _is_ready(self) -> bool:
         """returns whether this client "wants" to say something right now"""
         return True
@@ -99,14 +175,21 @@ class IOClient(Client):
         return input("want to say something? [y/n]: ").strip().lower().startswith("y")
 
 class OpenAIClient(Client):
+    """
+    A chat with an LLM. Each read sends the system message and as much of the latest history as fits in budget tokens
+    (all of it, with budget None), so prompts stop growing once a chat gets long.
+    With summarize, what no longer fits is summarized and sent along instead. See history.py.
+    """
     def __init__(
             self, 
             name: str = "GPT-4",
             system_msg: str = None,
             temp: float = 0,
             model: str = "gpt-4-0125-preview",
+            budget: int | None = 8000,
+            summarize: bool = False,
         ):
-        super().__init__(name)
+        super().__init__(name, History(budget, summarize_model=util.GPT3 if summarize else None))
 
         assert 0 <= temp <= 1, "Temperature must be between 0 and 1"
 
@@ -115,6 +198,15 @@ class OpenAIClient(Client):
         self._model = model
         self.clear()
 
+    # reading doesn't change anything but the history, so a response can always be drafted
+    can_draft = True
+
+    def _draft(self) -> str:
+        return self._read()
+
+    def _use_draft(self, draft: str) -> str:
+        return draft
+
     def _read(self) -> str:
         # for t, d in self.history:
         #     messages.append({"role": ["user", "assistant", "system"][t], "content": d})
@@ -136,7 +228,16 @@ class OpenAIClient(Client):
         #     raise CapitalismException()
         
         # return comp.choices[0].message.content
-        return util.call_LLM(self.history, temp=self._temp)
+        return util.call_LLM(self._history.window(), temp=self._temp, priority=scheduler.INTERACTIVE)
+
+    def _stream_read(self) -> Iterable[str]:
+        return util.stream_LLM(self._history.window(), temp=self._temp)
+
+    async def _aread(self) -> str:
+        return await util.acall_LLM(self._history.window(), temp=self._temp, priority=scheduler.INTERACTIVE)
+
+    async def _awrite(self, data: str) -> None:
+        return
     
     def clear(self):
         super().clear()
@@ -0,0 +1,139 @@
+"""
+Memory consolidation, to keep a persona's memory stream from growing forever.
+
+Once a stream goes over its budget, the observations and actions that haven't been
+accessed in a while are clustered by embedding, and each cluster is replaced by one
+SUMMARY memory that references the originals. The originals move to the store's archive,
+out of the way of recall. Summaries are written in the background, and swapped in
+the next time the persona adds a memory.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+import ann
+import scheduler
+import util
+from persona import Memory, Persona
+from store import MemoryStore
+
+# only these are summarized - identity, reflections and plans stay as they are
+KINDS = (Memory.OBSERVATION, Memory.ACTION)
+
+def select(persona: Persona, count: int, min_age: int = 50) -> list[Memory]:
+    """
+    Up to count observations and actions, least recently accessed first,
+    skipping any accessed in the last min_age time steps.
+    """
+    mem = persona.mem
+    acc = mem.acc[:mem.n]
+    rows = np.flatnonzero(np.isin(mem.type[:mem.n], KINDS) & (acc <= persona.time - min_age))
+    rows = rows[np.argsort(acc[rows], kind="stable")][:count]
+    return [mem[i] for i in np.sort(rows)]
+
+def cluster(emb: np.ndarray, size: int, seed: int = 0) -> list[np.ndarray]:
+    """Indices of the rows in each cluster of about size similar embeddings, with empty clusters dropped."""
+    k = max(len(emb) // size, 1)
+    if k == 1:
+        return [np.arange(len(emb))]
+    assign = np.argmax(emb @ ann.kmeans(emb, k, seed=seed).T, axis=1)
+    return [group for group in (np.flatnonzero(assign == c) for c in range(k)) if len(group)]
+
+def summarize(name: str, groups: list[list[Memory]], model: str = util.GPT3) -> list[str]:
+    """One summary per group of memories, written by the LLM in one batch."""
+    prompts = [f"""Here are some of {name}'s memories:
+{util.jlines(group)}
+Summarize them in one or two sentences, in the second person, keeping names and other specifics.
+Only return the summary.""" for group in groups]
+    return [s.strip() for s in util.call_LLM(prompts, model, single=False, priority=scheduler.BACKGROUND)]
+
+def plan(persona: Persona, mems: list[Memory], emb: np.ndarray, size: int, model: str = util.GPT3) -> list[tuple[str, list[Memory], np.ndarray]]:
+    """(summary, originals, embedding) for each cluster of the memories - the slow part, safe to run in the background"""
+    groups = cluster(emb, size)
+    clusters = [[mems[i] for i in group] for group in groups]
+    centroids = [emb[group].mean(axis=0) for group in groups]
+    return list(zip(summarize(persona.name, clusters, model), clusters, centroids))
+
+def apply(persona: Persona, summaries: list[tuple[str, list[Memory], np.ndarray]]) -> int:
+    """
+    Swaps the originals for their summaries, moving them to the archive. Returns how many memories were archived.
+    A summary stands in for its cluster in recall, so its embedding is the cluster's mean,
+    and it keeps the cluster's latest access time and highest importance.
+    """
+    mem = persona.mem
+    # anything dropped since planning (say, by clear) is left out
+    summaries = [(s, [m for m in ms if m._store is mem], c) for s, ms, c in summaries]
+    summaries = [(s, ms, c) for s, ms, c in summaries if ms and s]
+    if not summaries:
+        return 0
+
+    originals = mem.remove([m._idx for _, ms, _ in summaries for m in ms])
+    if mem.archive is None:
+        # the archive is never recalled from, so it doesn't need an index
+        mem.archive = MemoryStore(**dict(persona._store_args, index=None))
+        mem.archive.factory = Memory.view
+    for m in originals:
+        mem.archive.append(m)
+
+    for desc, ms, centroid in summaries:
+        last = max(int(m.acc) for m in ms)
+        summary = Memory(Memory.SUMMARY, desc, last, ms, imp=float(np.nan_to_num(np.nanmax([m.imp for m in ms]))))
+        summary.crt = min(int(m.crt) for m in ms)
+        summary.set_emb(centroid / max(np.linalg.norm(centroid), 1e-12))
+        mem.append(summary)
+    return len(originals)
+
+def consolidate(persona: Persona, budget: int, target: float = 0.75, min_age: int = 50, size: int = 8, model: str = util.GPT3) -> int:
+    """Consolidates the persona's memories down to about target * budget, right away. Returns how many were archived."""
+    mems, emb = _gather(persona, budget, target, min_age, size)
+    return 0 if mems is None else apply(persona, plan(persona, mems, emb, size, model))
+
+def _gather(persona: Persona, budget: int, target: float, min_age: int, size: int) -> tuple[list[Memory] | None, np.ndarray | None]:
+    """the memories to summarize and their embeddings, or (None, None) if there aren't enough"""
+    # every size memories summarized become one summary
+    excess = len(persona.mem) - int(target * budget)
+    mems = select(persona, int(np.ceil(excess * size / max(size - 1, 1))), min_age)
+    if len(mems) < 2:
+        return None, None
+    rows = persona.mem.indices(mems)
+    persona.mem.fill_emb(rows)
+    return mems, persona.mem.decode(np.array(rows))
+
+class Consolidator:
+    """
+    Keeps one persona's memory stream around budget memories.
+    When the stream goes over budget, the memories to summarize are picked (see select) and their
+    summaries written in the background, bringing it down to target * budget.
+    Each step (run whenever the persona adds a memory) swaps in the finished summaries.
+    """
+    _pool = ThreadPoolExecutor(max_workers=2)
+
+    def __init__(self, budget: int, target: float = 0.75, min_age: int = 50, size: int = 8, model: str = util.GPT3):
+        self.budget = budget
+        self.target = target
+        self.min_age = min_age
+        self.size = size
+        self.model = model
+        self._plan = None
+        self.archived = 0
+
+    def step(self, persona: Persona) -> None:
+        if self._plan is not None and self._plan.done():
+            plan, self._plan = self._plan, None
+            if plan.exception() is None:
+                self.archived += apply(persona, plan.result())
+        if self._plan is None and len(persona.mem) > self.budget:
+            self._plan = self.start(persona)
+
+    def start(self, persona: Persona) -> Future | None:
+        # embeddings are gathered now, on the persona's thread - the store can change under a background thread
+        mems, emb = _gather(persona, self.budget, self.target, self.min_age, self.size)
+        if mems is None:
+            return None
+        return self._pool.submit(plan, persona, mems, emb, self.size, self.model)
+
+    def wait(self, persona: Persona) -> None:
+        """Finish any consolidation in progress."""
+        if self._plan is not None:
+            self._plan.result()
+            self.step(persona)
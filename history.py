@@ -0,0 +1,152 @@
+"""
+Conversation history for clients, kept to a token budget so long sessions don't grow every prompt.
+"""
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import itertools
+import threading
+
+import scheduler
+import util
+
+ROLE_NAMES = {util.USER: "User", util.AI: "Assistant", util.SYSTEM: "System"}
+
+class History:
+    """
+    A client's messages as (type, text), oldest first - see util.USER, util.AI and util.SYSTEM.
+    System messages written before anything else are pinned: they always come first.
+    The rest go in a ring buffer of the last capacity messages, each with its token count (see util.count_tokens).
+    Message types are small ints, which CPython shares, so each message costs one tuple and its text.
+
+    window() is what gets sent to the LLM: the pinned messages, then the most recent messages that fit in budget tokens.
+    The window's start moves in jumps, cutting it down to low of the budget each time it's over,
+    so prompts keep the same prefix for a few turns at a time.
+    With summarize_model, messages that fall out of the window are summarized in the background,
+    and the running summary goes right after the pinned messages.
+    """
+    _pool = ThreadPoolExecutor(max_workers=2)
+
+    def __init__(self, budget: int | None = None, capacity: int = 1000, low: float = 0.75, summarize_model: str | None = None):
+        self.budget = budget
+        self.low = low
+        self.summarize_model = summarize_model
+        self.summary = None
+        self._pinned = [] # (text, tokens)
+        self._messages = deque(maxlen=capacity) # (type, text, tokens)
+        self._dropped = 0 # messages pushed out of the ring buffer, so _messages[i] is message _dropped + i
+        self._start = 0 # first message in the window
+        self._tokens = 0 # tokens in the window, not counting the pinned messages or summary
+        self._summarized = 0 # messages before this one are covered by the summary
+        self._summarizing = None # future of the summary being written
+        self._epoch = 0 # bumped by clear, so a summary of cleared messages isn't used
+        self._lock = threading.RLock()
+
+    def append(self, msg_type: int, text: str) -> None:
+        tokens = util.count_tokens(text)
+        with self._lock:
+            if msg_type == util.SYSTEM and not self._messages and not self._dropped:
+                self._pinned.append((text, tokens))
+                return
+            if len(self._messages) == self._messages.maxlen:
+                oldest = self._messages[0][2]
+                self._dropped += 1
+                if self._start < self._dropped:
+                    self._start = self._dropped
+                    self._tokens -= oldest
+            self._messages.append((msg_type, text, tokens))
+            self._tokens += tokens
+            self._trim()
+
+    def _fixed(self) -> int:
+        """tokens always sent, whatever the window"""
+        return sum(tokens for _, tokens in self._pinned) + (util.count_tokens(self.summary) if self.summary else 0)
+
+    def _trim(self) -> None:
+        if self.budget is None:
+            return
+        room = self.budget - self._fixed()
+        if self._tokens <= room:
+            return
+        end = self._dropped + len(self._messages)
+        # the latest message always stays, even on its own over budget
+        while self._tokens > self.low * room and self._start < end - 1:
+            self._tokens -= self._messages[self._start - self._dropped][2]
+            self._start += 1
+        self._summarize()
+
+    def _summarize(self) -> None:
+        """starts summarizing the messages that have left the window since the last summary, unless that's already going"""
+        if self.summarize_model is None or self._summarizing is not None:
+            return
+        # anything that's also left the ring buffer is gone
+        first = max(self._summarized, self._dropped)
+        if first >= self._start:
+            return
+        messages = [(t, text) for t, text, _ in itertools.islice(self._messages, first - self._dropped, self._start - self._dropped)]
+        self._summarizing = self._pool.submit(self._write_summary, self.summary, messages)
+        epoch, end = self._epoch, self._start
+        self._summarizing.add_done_callback(lambda future: self._summarized_to(future, epoch, end))
+
+    def _write_summary(self, summary: str | None, messages: list[tuple[int, str]]) -> str:
+        words = max(50, (self.budget or 4000) // 8)
+        before = f"""Summary of the conversation so far:
+{summary}
+""" if summary else ""
+        lines = util.jlines(f"{ROLE_NAMES.get(t, 'User')}: {text}" for t, text in messages)
+        return util.call_LLM(f"""{before}The conversation continued:
+{lines}
+Write a summary of the whole conversation in under {words} words, keeping names, facts, decisions and open questions.
+Only return the summary.""", self.summarize_model, priority=scheduler.BACKGROUND).strip()
+
+    def _summarized_to(self, future: Future, epoch: int, end: int) -> None:
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            self._summarizing = None
+            if future.exception() is None:
+                self.summary = future.result()
+                self._summarized = end
+                self._trim()
+            # more may have left the window while this one was being written
+            self._summarize()
+
+    def window(self) -> list[tuple[int, str]]:
+        """the messages to send: pinned, then the summary of earlier messages if there is one, then the window"""
+        with self._lock:
+            messages = [(util.SYSTEM, text) for text, _ in self._pinned]
+            if self.summary:
+                messages.append((util.SYSTEM, f"Summary of the earlier conversation:\n{self.summary}"))
+            messages.extend((t, text) for t, text, _ in itertools.islice(self._messages, self._start - self._dropped, None))
+            return messages
+
+    def tokens(self) -> int:
+        """approximate size of the window, in tokens"""
+        with self._lock:
+            return self._fixed() + self._tokens
+
+    def wait(self) -> None:
+        """Waits for any summary being written."""
+        while True:
+            with self._lock:
+                future = self._summarizing
+            if future is None:
+                return
+            future.exception()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch += 1
+            self._pinned.clear()
+            self._messages.clear()
+            self._dropped = self._start = self._tokens = self._summarized = 0
+            self._summarizing = None
+            self.summary = None
+
+    def __iter__(self):
+        """every message still held, pinned ones first"""
+        with self._lock:
+            messages = [(util.SYSTEM, text) for text, _ in self._pinned] + [(t, text) for t, text, _ in self._messages]
+        return iter(messages)
+
+    def __len__(self) -> int:
+        return len(self._pinned) + len(self._messages)
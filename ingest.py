@@ -0,0 +1,154 @@
+"""
+Fetching and caching for building personas out of web pages.
+
+Pages are fetched concurrently over one pooled HTTP session, and kept on disk with their
+ETag / Last-Modified headers, so fetching them again is a conditional request.
+Each processing stage caches its output under a hash of its inputs,
+so rebuilding a roster only redoes the work for pages whose text actually changed.
+"""
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable
+from urllib.parse import urlparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import scheduler
+
+if TYPE_CHECKING:
+    import requests
+
+POOL_SIZE = 32 # connections kept open per host
+
+@dataclass
+class Page:
+    url: str
+    html: str
+
+class IngestCache:
+    """Raw pages with their validators, and the cached outputs of each stage, in sqlite."""
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._lock = threading.RLock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(self.path, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(self.path, "ingest.sqlite"), check_same_thread=False)
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, modified TEXT, html TEXT, fetched REAL);
+                CREATE TABLE IF NOT EXISTS stages (stage TEXT, key TEXT, output TEXT, created REAL, PRIMARY KEY (stage, key));
+            """)
+        return self._db
+
+    def page(self, url: str) -> tuple[str | None, str | None, str] | None:
+        """(etag, last modified, html) of the stored copy of the page"""
+        with self._lock:
+            return self._connect().execute("SELECT etag, modified, html FROM pages WHERE url = ?", (url,)).fetchone()
+
+    def put_page(self, url: str, etag: str | None, modified: str | None, html: str) -> None:
+        with self._lock:
+            self._connect().execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)", (url, etag, modified, html, time.time()))
+            self._db.commit()
+
+    @staticmethod
+    def key(inputs) -> str:
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def stage_many(self, stage: str, inputs: list, fn: Callable[[list], list]) -> list:
+        """
+        The output of the stage for each of the inputs (anything JSON-serializable).
+        fn is called once with the inputs that aren't cached, and returns their outputs in order.
+        """
+        keys = [self.key(i) for i in inputs]
+        with self._lock:
+            db = self._connect()
+            found = dict(
+                (key, json.loads(output))
+                for key, output in db.execute(
+                    f"SELECT key, output FROM stages WHERE stage = ? AND key IN ({','.join('?' * len(keys))})",
+                    (stage, *keys),
+                )
+            )
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            outputs = fn([inputs[i] for i in missing])
+            with self._lock:
+                self._connect().executemany(
+                    "INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?)",
+                    [(stage, keys[i], json.dumps(out), time.time()) for i, out in zip(missing, outputs)],
+                )
+                self._db.commit()
+            found.update((keys[i], out) for i, out in zip(missing, outputs))
+        return [found[key] for key in keys]
+
+    def stage(self, stage: str, inputs, fn: Callable):
+        """The cached output of fn(inputs) for the stage."""
+        return self.stage_many(stage, [inputs], lambda todo: [fn(todo[0])])[0]
+
+# shared by everything that fetches pages - set to None to always refetch and recompute
+CACHE = IngestCache(os.environ.get("INGEST_CACHE_DIR", ".cache/ingest"))
+
+_session = None
+_session_lock = threading.Lock()
+
+def session() -> "requests.Session":
+    """one pooled session for every fetch, so connections are reused"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            # requests is slow to import, and only needed once something is fetched
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+    return _session
+
+def _fetch(url: str) -> Page:
+    old = None if CACHE is None else CACHE.page(url)
+    headers = {}
+    if old is not None:
+        etag, modified, _ = old
+        if etag:
+            headers["If-None-Match"] = etag
+        if modified:
+            headers["If-Modified-Since"] = modified
+
+    response = session().get(url, headers=headers, timeout=30)
+    if response.status_code == 304 and old is not None:
+        return Page(url, old[2])
+    response.raise_for_status()
+
+    if CACHE is not None:
+        CACHE.put_page(url, response.headers.get("ETag"), response.headers.get("Last-Modified"), response.text)
+    return Page(url, response.text)
+
+def fetch(urls: list[str], priority: int = scheduler.BACKGROUND) -> list[Page]:
+    """
+    Fetches the pages concurrently on the scheduler, revalidating stored copies.
+    Requests are rate limited per host - see scheduler.SCHEDULER.set_limit.
+    """
+    futures = [
+        scheduler.SCHEDULER.submit(_fetch, url, priority=priority, model=urlparse(url).netloc)
+        for url in urls
+    ]
+    return [future.result() for future in futures]
+
+def cached_many(stage: str, inputs: list, fn: Callable[[list], list]) -> list:
+    """CACHE.stage_many, or just fn(inputs) with the cache off"""
+    return fn(inputs) if CACHE is None else CACHE.stage_many(stage, inputs, fn)
+
+def cached(stage: str, inputs, fn: Callable):
+    return fn(inputs) if CACHE is None else CACHE.stage(stage, inputs, fn)
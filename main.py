@@ -1,11 +1,12 @@
-import dotenv
+import sys
 
-import util
-import client
-import persona
-import presets
+import startup
 
-dotenv.load_dotenv()
+with startup.phase("imports"):
+    import client
+    import persona
+    import presets
+    import util
 
 # load Raiden Shogun's data from the Fandom wiki
 raiden_urls = [
@@ -14,22 +15,17 @@ raiden_urls = [
     "https://genshin-impact.fandom.com/wiki/Raiden_Shogun/Voice-Overs",
     "https://genshin-impact.fandom.com/wiki/Raiden_Shogun/Companion",
 ]
-raiden_text = presets.get_text(raiden_urls)
 
-raiden_desc = presets.get_desc_from_wiki("Raiden", raiden_text, util.GPT4)
-print("description loaded")
-raiden_quotes = presets.get_quotes_from_wiki("Raiden", raiden_text, util.GPT4)
-print("quotes loaded")
-raiden_tone = presets.get_tone("Raiden", raiden_quotes, util.GPT4)
-presets.save_persona(
-    "Raiden",
-    "Raiden",
-    raiden_desc,
-    raiden_quotes,
-    f"""Keep responses fairly short - around 1-3 sentences, like in a real conversation.
-Respond in a slightly {raiden_tone} tone.""",
-    0.4,
-)
+# a saved snapshot is used as is - run with --rebuild to pick up changes to the wiki
+with startup.phase("load snapshot"):
+    raiden = None if "--rebuild" in sys.argv else presets.load_snapshot("Raiden")
+
+if raiden is None:
+    with startup.phase("build preset"):
+        # pages and extraction results are cached, so this only does real work the first time or when the wiki changes
+        presets.build_preset("Raiden", "Raiden", raiden_urls, util.GPT4)
+    with startup.phase("build persona"):
+        raiden = presets.load_persona("Raiden")
 
 print("Raiden persona loaded")
 
@@ -59,11 +55,11 @@ print("Raiden persona loaded")
 
 # print("Xiangling persona loaded")
 
-raiden = presets.load_persona("Raiden")
 # xiangling = presets.load_persona("Xiangling")
 user = client.IOClient("User")
 
 print("ready!")
+startup.report()
 
 
 for entry in persona.run_conv([raiden, user]):
@@ -1,8 +1,22 @@
-from typing import Iterable
+from typing import AsyncIterator, Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+import asyncio
+import copy
 import random
+import re
+import threading
+import time
+
+import numpy as np
 
 import util
+import scheduler
+import tracing
 from client import Client
+from prompt import PromptAssembler
+from speaker import SpeakerSelector
+import store
+from store import Column, MemoryStore
 
 def get_importance(mem_type: int, desc: str) -> float:
     """
@@ -20,12 +34,126 @@ extremely poignant (e.g., a break up, college
 acceptance), rate the likely poignancy of the
 following piece of memory. Only return the number, do not explain anything.
 Memory: {desc}
-Rating: <fill in>""", util.GPT3)
+Rating: <fill in>""", util.GPT3, priority=scheduler.BACKGROUND)
     try:
         return int(response) / 10
     except ValueError:
         return random.random()
 
+def get_importances(descs: list[str]) -> list[float]:
+    """
+    Returns the perceived importance of a list of observation-like memories, using a single LLM call.
+    Falls back to one call per memory if the response can't be matched up with the memories.
+    """
+    lines = util.jlines(f"{i + 1}. {desc}" for i, desc in enumerate(descs))
+    response = util.call_LLM(f"""On the scale of 1 to 10, where 1 is purely mundane
+(e.g., brushing teeth, making bed) and 10 is
+extremely poignant (e.g., a break up, college
+acceptance), rate the likely poignancy of each
+of the following {len(descs)} pieces of memory.
+Return only the ratings, one number per line, in the same order. Do not explain anything.
+Memories:
+{lines}""", util.GPT3, priority=scheduler.BACKGROUND)
+    ratings = [re.findall(r"\d+", line) for line in response.splitlines() if line.strip()]
+    if len(ratings) == len(descs) and all(ratings):
+        # "3. 7" style answers - the rating is the last number on the line
+        return [min(int(r[-1]), 10) / 10 for r in ratings]
+
+    responses = util.call_LLM([f"""On the scale of 1 to 10, where 1 is purely mundane
+(e.g., brushing teeth, making bed) and 10 is
+extremely poignant (e.g., a break up, college
+acceptance), rate the likely poignancy of the
+following piece of memory. Only return the number, do not explain anything.
+Memory: {desc}
+Rating: <fill in>""" for desc in descs], util.GPT3, single=False, priority=scheduler.BACKGROUND)
+    result = []
+    for response in responses:
+        try:
+            result.append(int(response) / 10)
+        except ValueError:
+            result.append(random.random())
+    return result
+
+class ImportanceScorer:
+    """
+    Scores memory importance in the background.
+    Memories are submitted as soon as they're created, with their importance pending (NaN).
+    Pending memories from every persona are coalesced into batches of up to batch_size,
+    waiting at most window seconds for a batch to fill, and each batch is scored with one LLM call.
+    """
+    def __init__(self, batch_size: int = 20, window: float = 0.05, workers: int = 4):
+        self.batch_size = batch_size
+        self.window = window
+        self._queue = []
+        self._cond = threading.Condition()
+        self._flush = False
+        self._thread = None
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, mem: "Memory") -> Future:
+        mem._imp_future = Future()
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._queue.append(mem)
+            self._cond.notify()
+        return mem._imp_future
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.window
+                while len(self._queue) < self.batch_size and not self._flush:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._queue = self._queue[:self.batch_size], self._queue[self.batch_size:]
+                self._flush = bool(self._queue) and self._flush
+            try:
+                self._pool.submit(self._score, batch)
+            except RuntimeError: # interpreter shutting down
+                return
+
+    def _score(self, batch: list["Memory"]) -> None:
+        try:
+            with tracing.span("importance", memories=len(batch)):
+                scores = get_importances([str(mem) for mem in batch])
+        except Exception:
+            # like an unparseable rating - a failed call mustn't leave the memories unscorable for good
+            tracing.record("importance", errors=1)
+            scores = [random.random() for _ in batch]
+        for mem, score in zip(batch, scores):
+            mem.imp = score
+            mem._imp_future.set_result(score)
+
+    def wait(self, mems: list["Memory"]) -> None:
+        """Block until the given memories have their importance, skipping the batching window."""
+        futures = [(m, m._imp_future) for m in mems if m._imp_future is not None]
+        if not futures:
+            return
+        with self._cond:
+            self._flush = True
+            self._cond.notify()
+        for mem, future in futures:
+            # written again here in case the scorer raced with the memory being added to a store
+            mem.imp = future.result()
+            mem._imp_future = None
+
+SCORER = ImportanceScorer()
+
+class Importance(Column):
+    """Importance column which blocks on the scorer if the importance is still pending."""
+    def __get__(self, obj, objtype=None):
+        value = super().__get__(obj, objtype)
+        if obj is not None and np.isnan(value):
+            SCORER.wait([obj])
+            value = super().__get__(obj, objtype)
+        return value
+
 class Memory:
     """
     This class represents a memory, 
@@ -52,7 +180,18 @@ class Memory:
 
     # QUERY memories aren't true memories - they're used to look for other ones
 
-    def __init__(self, mem_type: int, desc: str, time: int, ref: list["Memory"] = []):
+    # once added to a MemoryStore, these live in the store's columns
+    type = Column(int)
+    crt = Column(int)
+    acc = Column(int)
+    imp = Importance(float)
+
+    # imp is only given for memories whose importance is already known, such as summaries
+    def __init__(self, mem_type: int, desc: str, time: int, ref: list["Memory"] = [], imp: float | None = None):
+        self._store = None
+        self._idx = -1
+        self._imp_future = None
+
         self.type = mem_type
         self.desc = desc
         self.ref = ref
@@ -64,15 +203,45 @@ class Memory:
         
         self.refcount = 0
 
-        self.imp = get_importance(self.type, self)
+        if imp is not None:
+            self.imp = imp
+        elif mem_type in (self.IDENTITY, self.QUERY):
+            self.imp = get_importance(self.type, self)
+        else:
+            # scored in the background - see ImportanceScorer
+            self.imp = np.nan
+            SCORER.submit(self)
 
         self._emb = None
         self._has_emb = False
 
+    @classmethod
+    def view(cls, store: MemoryStore, idx: int) -> "Memory":
+        """A Memory for a row of the store that doesn't have one yet."""
+        mem = cls.__new__(cls)
+        mem._store, mem._idx = store, idx
+        mem._imp_future = None
+        mem.desc = store.desc(idx)
+        mem.ref = [store.ref_mem(i) for i in store.refs(idx)]
+        mem.refcount = 0
+        mem._emb = None
+        mem._has_emb = False
+        return mem
+
     def get_emb(self) -> list[float]:
+        if self._store is not None:
+            emb = self._store.get_emb(self._idx)
+            if emb is None:
+                self._store.fill_emb([self._idx])
+                emb = self._store.get_emb(self._idx)
+            return emb
+
         if not self._has_emb:
             if self.type == self.QUERY and len(self.ref):
-                self._emb = sum(r.get_emb() for r in self.ref)
+                # one batch per store rather than one request per memory
+                for mem_store in {r._store for r in self.ref if r._store is not None}:
+                    mem_store.fill_emb(mem_store.indices(self.ref))
+                self._emb = np.sum([r.get_emb() for r in self.ref], axis=0)
 
             else:
                 self._emb = util.get_embedding(self.desc)
@@ -82,9 +251,22 @@ class Memory:
     
     # so embeddings can be batch-processed by an external system
     def set_emb(self, emb: list[float]) -> None:
+        if self._store is not None:
+            self._store.set_emb(self._idx, emb)
+            return
         self._emb = emb
         self._has_emb = True
 
+    def _detach(self) -> None:
+        """Copy this memory's row out of its store, so it stays valid after the store drops it."""
+        store, idx = self._store, self._idx
+        values = {name: getattr(store, name)[idx] for name in store.COLUMNS}
+        emb = store.get_emb(idx)
+        self._store, self._idx = None, -1
+        for name, value in values.items():
+            setattr(self, name, value)
+        self._emb, self._has_emb = (None, False) if emb is None else (emb.copy(), True)
+
     def __str__(self) -> str:
         return f"{self.MEM_TYPES[self.type]} at t={self.crt}: {self.desc}"
     
@@ -103,102 +285,226 @@ class Persona(Client):
     """
     This client emulates a person with memories.
     They can plan out and reflect on their actions, 
-    as well as summarize older memories. (TODO: do these things)
+    as well as summarize older memories (see consolidate.py). (TODO: plans and reflections)
     """
 
-    def __init__(self, name: str, id: list[str], instructions: str, examples: list[str], temp: float):
+    # mem is an already-built memory stream, such as one loaded from a snapshot.
+    # otherwise store_args are passed on to the persona's MemoryStore, e.g. index=ann.IVFIndex()
+    def __init__(
+            self,
+            name: str,
+            id: list[str],
+            instructions: str,
+            examples: list[str],
+            temp: float,
+            mem: MemoryStore | None = None,
+            budget: int | None = None,
+            prompt_budget: int = 4000,
+            **store_args,
+        ):
         super().__init__(name)
 
+        # with a budget, old memories are summarized in the background to keep the stream around that size
+        self.consolidator = None
+        if budget is not None:
+            from consolidate import Consolidator
+            self.consolidator = Consolidator(budget)
+
+        self._store_args = dict(store_args, resolve_imp=SCORER.wait)
+
         self.temp = temp
 
         self.identity = id
         self.inst = instructions
 
-        self.identity_mem = None
         self.examples = examples
-        
-        self.mem = []
+        self.prompts = self._assembler(prompt_budget)
+
+        if mem is None:
+            self._n_identity = None
+            self.mem = MemoryStore(**self._store_args)
+            self.clear()
+        else:
+            # already built, e.g. loaded from a snapshot - the identity memories come first
+            super().clear()
+            self.time = 0
+            self._n_identity = len(id)
+            self.mem = mem
+            self.mem.factory = Memory.view
+            self.mem.resolve_imp = SCORER.wait
+            if self.mem.archive is not None:
+                self.mem.archive.factory = Memory.view
+                self.mem.archive.resolve_imp = SCORER.wait
 
-        self.clear()
         print(f"ready: {self.name}")
 
+    def fork(self) -> "Persona":
+        """
+        A copy of this persona to have a conversation of its own, with an empty history,
+        sharing this persona's memories so far read-only (see MemoryStore.fork), so it's cheap to make many.
+        This persona shouldn't be talked to while its forks are in use.
+        """
+        persona = copy.copy(self)
+        Client.__init__(persona, self.name)
+        persona.mem = self.mem.fork()
+        persona.prompts = self._assembler(self.prompts.budget)
+        if self.consolidator is not None:
+            from consolidate import Consolidator
+            c = self.consolidator
+            persona.consolidator = Consolidator(c.budget, c.target, c.min_age, c.size, c.model)
+        return persona
+
+    @property
+    def archive(self) -> MemoryStore | None:
+        """memories consolidated out of the memory stream, see consolidate.py"""
+        return self.mem.archive
+
     def add_mem(self, mem_type: int, data: str, ref: list[Memory] = []) -> Memory:
         """Add the following memory to the memory stream."""
+        if self.consolidator is not None:
+            self.consolidator.step(self)
         mem = Memory(mem_type, data, self.time, list(ref))
-        self.mem.append(mem)
+        self.mem.prefetch_emb([self.mem.append(mem)])
         return mem
         
     def clear(self) -> None:
         super().clear()
         self.time = 0
 
-        if self.identity_mem is None:
-            self.mem = []
+        if self._n_identity is None:
+            self.mem = MemoryStore(max(64, len(self.identity)), **self._store_args)
+            self.mem.factory = Memory.view
 
-            for desc, emb in zip(self.identity, util.get_embedding(self.identity)):
-                self.add_mem(Memory.IDENTITY, desc).set_emb(emb)
+            # embedded together in the background, see MemoryStore.prefetch_emb
+            for desc in self.identity:
+                self.add_mem(Memory.IDENTITY, desc)
 
-            self.identity_mem = self.mem[:]
+            self._n_identity = len(self.mem)
     
         else:
-            self.mem = self.identity_mem[:]
+            self.mem.truncate(self._n_identity)
+            self.mem.archive = None
         
-    def _read(self) -> str:
-        recent = util.last_n([m for m in self.mem if m.type != Memory.IDENTITY], 10, key=lambda m: m.crt)
+    def _recall_recent(self) -> list[Memory]:
+        """The recent memories plus those they bring to mind, oldest first."""
+        recent = self.mem.recent(10, skip_type=(Memory.IDENTITY, Memory.SUMMARY))
         # print(f"RECENT:\n{util.jlines(recent)}")
-        recalled = sorted(self.recall(recent, 10) + recent, key=lambda mem: mem.crt)
-        ex_str = f"""Carefully mimic the style and tone of these examples:
-{util.jlines(util.last_n(self.examples, 5, key="random"))}""" if self.examples else ""
-        
+        return sorted(self.recall(recent, 10) + recent, key=lambda mem: mem.crt)
+
+    # nothing changes until a draft is used - the recalled memories are only marked as accessed then
+    can_draft = True
+
+    def _draft(self) -> tuple[list[Memory], str]:
+        with tracing.span("draft", persona=self.name) as span:
+            recalled = self._recall_recent()
+            response = util.call_LLM(
+                self.build_prompt(recalled),
+                model=util.GPT4,
+                temp=self.temp,
+                priority=scheduler.INTERACTIVE,
+            )  
+            # response = self.backend.single_call(prompt)
+            if span:
+                span.set(recalled=len(recalled), prompt_tokens=self.prompts.last.tokens, prefix_tokens=self.prompts.last.prefix_tokens)
+            return recalled, response
+
+    def _use_draft(self, draft: tuple[list[Memory], str]) -> str:
+        recalled, response = draft
         for m in recalled:
             m.acc = self.time
+        self.add_mem(Memory.ACTION, response)
+        self.time += 1
 
-        prompt = f"""Your recent memories:
-{util.jlines(recalled)}
-What would you do or say in the current situation?
+        return response
+
+    def _read(self) -> str:
+        with tracing.span("read", persona=self.name, memories=len(self.mem)):
+            return self._use_draft(self._draft())
+
+    def _stream_read(self) -> Iterable[str]:
+        recalled = self._recall_recent()
+        stream = util.stream_LLM(self.build_prompt(recalled), model=util.GPT4, temp=self.temp)
+        yield from stream
+        # only remembered once the whole response is in
+        self._use_draft((recalled, stream.text))
+
+    async def _aread(self) -> str:
+        with tracing.span("read", persona=self.name, memories=len(self.mem)):
+            # recall can block on embeddings and importance scores, so it gets a thread
+            recalled = await asyncio.to_thread(self._recall_recent)
+            response = await util.acall_LLM(self.build_prompt(recalled), model=util.GPT4, temp=self.temp, priority=scheduler.INTERACTIVE)
+            return self._use_draft((recalled, response))
+
+    def _assembler(self, budget: int) -> PromptAssembler:
+        """
+        Everything but the recalled memories is the same every turn, and goes first.
+        The examples are picked once, seeded by name, so the prefix also stays the same across runs.
+        """
+        examples = random.Random(self.name).sample(self.examples, min(5, len(self.examples)))
+        ex_str = f"""Carefully mimic the style and tone of these examples:
+{util.jlines(examples)}""" if examples else ""
+
+        prefix = f"""You are {self.name}.
 If you would say something, only return what you say, without enclosing quotation marks.
 Act like the character described, NOT like an assistant.
 {ex_str}
-{self.inst}
+{self.inst}"""
+        footer = f"""
+What would you do or say in the current situation?
 {self.name}: """
-        response = util.call_LLM(
-            [
-                (util.SYSTEM, f"You are {self.name}."),
-                (util.USER, prompt)
-            ],
-            model=util.GPT4,
-            temp=self.temp,
-        )  
-        # response = self.backend.single_call(prompt)
-        self.add_mem(Memory.ACTION, response)
-        self.time += 1
+        return PromptAssembler(prefix, "Your recent memories:\n", footer, budget)
 
-        return response
+    def build_prompt(self, recalled: list[Memory]) -> list[tuple[int, str]]:
+        """
+        The messages sent to the LLM to get this persona's next action, given the recalled memories.
+        Older memories are left out if they don't fit the prompt budget. See self.prompts.stats() for prompt sizes.
+        """
+        return self.prompts.build([str(m) for m in recalled]).messages
 
     def _write(self, data: str) -> None:
-        self.add_mem(Memory.OBSERVATION, data)
-        self.time += 1
+        with tracing.span("write", persona=self.name, memories=len(self.mem)):
+            self.add_mem(Memory.OBSERVATION, data)
+            self.time += 1
 
-    def _is_ready(self) -> bool:
-        recent = util.last_n([m for m in self.mem if m.type != Memory.IDENTITY], 10, key=lambda m: m.crt)
-        prompt = f"""You are {self.name}.
+    # adding a memory doesn't wait on anything - importance is scored in the background
+    async def _awrite(self, data: str) -> None:
+        self._write(data)
+
+    def _ready_prompt(self) -> str:
+        recent = self.mem.recent(10, skip_type=(Memory.IDENTITY, Memory.SUMMARY))
+        return f"""You are {self.name}.
 Here are your recent memories:
 {util.jlines(recent)}
 Would you want to say something in the current conversation?
 Return YES or NO. Do not give an explanation."""
-        return util.call_LLM(prompt, util.GPT3).strip().lower().startswith("y")
+
+    def _is_ready(self) -> bool:
+        with tracing.span("is_ready", persona=self.name) as span:
+            ready = util.call_LLM(self._ready_prompt(), util.GPT3, priority=scheduler.INTERACTIVE).strip().lower().startswith("y")
+            if span:
+                span.set(ready=ready)
+            return ready
+
+    async def _ais_ready(self) -> bool:
+        return (await util.acall_LLM(self._ready_prompt(), util.GPT3, priority=scheduler.INTERACTIVE)).strip().lower().startswith("y")
 
     # more advanced actions, not currently in use
     def reflect(self) -> None:
         """Reflect on recent events, generating new memories."""
-        recent = util.last_n(self.m, 20, key=lambda m: m.acc)
+        with tracing.span("reflect", persona=self.name, memories=len(self.mem)):
+            self._reflect()
+
+    def _reflect(self) -> None:
+        rows = self.mem.acc[:len(self.mem)]
+        recent = [self.mem[i] for i in store.select(rows, min(20, len(rows)))]
         prompt = f"""Here are {self.name}'s recent memories:
 {util.jlines(recent)}
 “Given only the information above, what are 3 most salient high-level questions we can answer about the subjects in the statements?
 Place each question on a seperate line."""
 
-        queries = [Memory(Memory.QUERY, desc, self.time, recent) for desc in util.call_LLM(prompt).splitlines()]
-        refs = self.recall(queries, 10)
+        # each question is its own query, so they don't blur into one
+        queries = [Memory(Memory.QUERY, desc.strip(), self.time) for desc in util.call_LLM(prompt).splitlines() if desc.strip()]
+        _, refs = self.recall_many(queries, 10, fuse="rrf")
         
         mem_str = util.jlines(f"{i + 1}. {mem}" for i, mem in enumerate(refs))
         prompt = f"""Statements about you, {self.name}:
@@ -235,50 +541,190 @@ Each action should be of the form: {self.name} should <action>.
     def recall_score(self, query: Memory, key: Memory) -> float:
         """Get the recall score between the given query memory and the given key memory."""
         relevance = util.cos_sim(query.get_emb(), key.get_emb()) # cosine-based similarity
-        recency = 0.995 ** (self.time - key.acc) # brought up / used recently?
+        recency = store.DECAY ** (self.time - key.acc) # brought up / used recently?
         importance = key.imp # important?
-        return 5 * relevance + 2 * recency + 3 * importance
+        return store.RELEVANCE_W * relevance + store.RECENCY_W * recency + store.IMPORTANCE_W * importance
 
     def recall(self, query: Memory | list[Memory], k: int) -> list[Memory]:
         """Find a list of memories that are likely related to the given memory."""
         used = query if isinstance(query, list) else [query]
-        query = Memory(Memory.QUERY, "[QUERY]", 0, query) if isinstance(query, list) else query
-        result = util.last_n([m for m in self.mem if m not in used], k, key=lambda mem: self.recall_score(query, mem))
+        with tracing.span("recall", persona=self.name, memories=len(self.mem), queries=1):
+            if not isinstance(query, list):
+                emb = query.get_emb()
+            elif query:
+                # summed here rather than by a QUERY memory referencing them, which would mark them all accessed
+                for mem_store in {m._store for m in query if m._store is not None}:
+                    mem_store.fill_emb(mem_store.indices(query))
+                emb = np.sum([m.get_emb() for m in query], axis=0)
+            else:
+                emb = util.get_embedding("[QUERY]")
+            result = self.mem.top_k(emb, self.time, k, exclude=self.mem.indices(used))
         # print("RECALLED:\n" + util.jlines(result))
         return result
     
-def run_conv(personas: list[Persona]) -> Iterable[str]:
+
+    def recall_many(self, queries: list[Memory], k: int, fuse: str | None = None) -> tuple[list[list[Memory]], list[Memory] | None]:
+        """
+        The top k memories for each of the queries, found in one pass over the memory stream,
+        and with fuse ("sum", "max" or "rrf"), the top k under one ranking combining them - see MemoryStore.top_rows_many.
+        """
+        with tracing.span("recall", persona=self.name, memories=len(self.mem), queries=len(queries)):
+            # queries that need their text embedded get it in one batch
+            todo = [q for q in queries if q._store is None and not q._has_emb and not (q.type == Memory.QUERY and q.ref)]
+            if todo:
+                for q, emb in zip(todo, util.get_embedding([q.desc for q in todo])):
+                    q.set_emb(emb)
+            emb = np.stack([q.get_emb() for q in queries]) if queries else np.zeros((0, 0), dtype=np.float32)
+            per_query, fused = self.mem.top_rows_many(emb, self.time, k, self.mem.indices(queries), fuse)
+        return [[self.mem[i] for i in rows] for rows in per_query], None if fused is None else [self.mem[i] for i in fused]
+
+
+def intro(personas: list[Client], p: Client) -> str:
+    """what persona p is told at the start of a conversation"""
+    others = [q.name for q in personas if q != p]
+    if len(others) == 1:
+        others_str = others[0]
+    else:
+        others_str = ", ".join(others[:-1]) + ", and " + others[-1]
+    return f"You are in a conversation with {others_str}."
+
+def run_conv(
+        personas: list[Persona],
+        stream: bool = False,
+        selector: SpeakerSelector | None = None,
+    ) -> Iterable[str] | Iterable[tuple[str, util.Stream]]:
+    """
+    Runs a conversation between the personas, yielding each line as "<name>: <line>".
+    With stream=True, yields (name, stream) pairs instead, where stream gives the line as it's generated.
+    Whatever isn't read of a stream is read before the conversation moves on.
+    With more than two personas, selector picks who speaks next - e.g. SpeakerSelector(speculate=1)
+    to draft the likeliest speaker's line while readiness is being checked (not when streaming).
+    Each turn gets a tracing span - when streaming, it ends once the line starts streaming.
+    """
+    def say(p: Client):
+        if not stream:
+            response = p.read()
+            return f"{p.name}: {response}", f"{p.name}: {response}"
+        chunks = p.stream_read()
+        return (p.name, chunks), chunks
+
+    def said(p: Client, out) -> str:
+        return out if not stream else f"{p.name}: {out.drain()}"
+
+    def tell(speaker: Client, s: str) -> None:
+        for p in personas:
+            if p != speaker:
+                p.write(s)
+
     persona = None
     for p in personas:
-        others = [q.name for q in personas if q != p]
-        if len(others) == 1:
-            others_str = others[0]
+        p.write(intro(personas, p))
+
+    if len(personas) == 2:
+        out, line = say(personas[0])
+        yield out
+        s = said(personas[0], line)
+        while True:
+            for p in (personas[1], personas[0]):
+                with tracing.span("turn", participants=2, speaker=p.name):
+                    p.write(s)
+                    out, line = say(p)
+                yield out
+                s = said(p, line)
+            
+            
+
+    selector = selector or SpeakerSelector()
+    while True:
+        candidates = [p for p in personas if p != persona]
+        with tracing.span("turn", participants=len(personas)) as span:
+            if stream:
+                persona = selector.pick(candidates)
+                out, line = say(persona)
+            else:
+                persona, response = selector.speak(candidates)
+                out = s = f"{persona.name}: {response}"
+                tell(persona, s)
+            if span:
+                span.set(speaker=persona.name)
+
+        if stream:
+            yield out
+            tell(persona, said(persona, line))
         else:
-            others_str = ", ".join(others[:-1]) + ", and " + others[-1]
+            yield out
+
+
+async def arun_conv(personas: list[Client]) -> AsyncIterator[str]:
+    """
+    async version of run_conv.
+    Readiness is checked for every persona at once, and listeners take in each line
+    in the background while the next speaker is being picked and generating.
+    """
+    # each client's in-flight write - awaited before the client is asked anything else
+    writes = {}
+
+    async def settled(p: Client) -> Client:
+        if p in writes:
+            await writes.pop(p)
+        return p
+
+    async def ready(p: Client) -> bool:
+        return await (await settled(p)).ais_ready()
 
-        p.write(f"You are in a conversation with {others_str}.")
+    await asyncio.gather(*(p.awrite(intro(personas, p)) for p in personas))
 
     if len(personas) == 2:
-        s = f"{personas[0].name}: {personas[0].read()}"
+        s = f"{personas[0].name}: {await personas[0].aread()}"
         yield s
         while True:
-            s = f"{personas[1].name}: {personas[1].call(s)}"
+            s = f"{personas[1].name}: {await personas[1].acall(s)}"
             yield s
-            s = f"{personas[0].name}: {personas[0].call(s)}"
+            s = f"{personas[0].name}: {await personas[0].acall(s)}"
             yield s
-            
-            
 
+    persona = None
     while True:
-        choices = [p for p in personas if p != persona and p.is_ready]
-        choices = choices if choices else [p for p in personas if p != persona]
+        with tracing.span("turn", participants=len(personas)) as span:
+            candidates = [p for p in personas if p != persona]
+            readiness = await asyncio.gather(*(ready(p) for p in candidates))
+            choices = [p for p, r in zip(candidates, readiness) if r] or candidates
 
-        persona = random.choice(choices)
-        response = persona.read()
-        s = f"{persona.name}: {response}"
+            persona = random.choice(choices)
+            response = await (await settled(persona)).aread()
+            s = f"{persona.name}: {response}"
+            if span:
+                span.set(speaker=persona.name)
 
         for p in personas:
             if p != persona:
-                p.write(s)
-        
+                writes[p] = asyncio.ensure_future(_chain(writes.pop(p, None), p.awrite(s)))
+
         yield s
+
+async def _chain(before: asyncio.Future | None, after) -> None:
+    """runs the coroutine after once before is done, so writes to a client stay in order"""
+    if before is not None:
+        await before
+    await after
+
+async def run_convs(convs: list[list[Client]], turns: int, max_concurrency: int = 8) -> list[list[str]]:
+    """
+    Runs many independent conversations for the given number of turns on one event loop,
+    with at most max_concurrency turns in progress at once.
+    Returns the transcript of each conversation.
+    """
+    budget = asyncio.Semaphore(max_concurrency)
+
+    async def run(personas: list[Client]) -> list[str]:
+        transcript = []
+        conv = arun_conv(personas)
+        try:
+            for _ in range(turns):
+                async with budget:
+                    transcript.append(await anext(conv))
+        finally:
+            await conv.aclose()
+        return transcript
+
+    return list(await asyncio.gather(*(run(personas) for personas in convs)))
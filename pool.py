@@ -0,0 +1,312 @@
+"""
+Personas hosted in a pool of worker processes, so a big conversation's recall, prompt building and the rest
+of the CPU-side work is spread over every core rather than held to one by the GIL.
+
+    with PersonaPool() as pool:
+        personas = [pool.add(p) for p in personas]
+        for line in run_conv(personas):
+            ...
+
+PersonaPool.add moves a persona into the least loaded worker and returns a RemoteClient, which reads, writes
+and checks readiness like the persona would, by sending each request to its worker.
+The persona's embeddings go into shared memory (see multiprocessing.shared_memory) which the worker's memory stream
+uses where it is (see MemoryStore.sharing), so they're copied once rather than pickled through a pipe.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from typing import Callable
+import itertools
+import multiprocessing
+import os
+import pickle
+import threading
+
+import numpy as np
+
+from client import Client
+from persona import SCORER, Memory, Persona
+from store import MemoryStore
+
+def _export_store(mem: MemoryStore, arrays: list[np.ndarray]) -> dict:
+    """everything needed to rebuild the store and its archive, apart from their embeddings, which are added to arrays"""
+    pending = np.flatnonzero(np.isnan(mem.imp[:mem.n]))
+    if len(pending) and mem.resolve_imp is not None:
+        mem.resolve_imp([mem[i] for i in pending])
+    mem.fill_emb()
+
+    emb = [a for a in mem.stored_emb(slice(0, mem.n)) if a is not None] if mem.n else []
+    first = len(arrays)
+    arrays.extend(emb)
+    return {
+        "dtype": mem.dtype,
+        "dim": mem.dim,
+        "rec_time": mem.rec_time,
+        "columns": {name: np.array(getattr(mem, name)[:mem.n]) for name in mem.COLUMNS},
+        "lazy": tuple(np.array(a) for a in mem._lazy_rows()),
+        "emb": (first, len(arrays)),
+        # consolidated memories' refs point into it
+        "archive": None if mem.archive is None else _export_store(mem.archive, arrays),
+    }
+
+def _import_store(state: dict, arrays: list[np.ndarray]) -> MemoryStore:
+    emb, scale = (arrays[slice(*state["emb"])] + [None, None])[:2]
+    mem = MemoryStore.sharing(state["columns"], emb, scale, state["lazy"], state["dtype"], state["dim"], SCORER.wait, state["rec_time"])
+    mem.factory = Memory.view
+    if state["archive"] is not None:
+        mem.archive = _import_store(state["archive"], arrays)
+    return mem
+
+def _export(persona: Persona) -> tuple[dict, shared_memory.SharedMemory | None]:
+    """(everything needed to rebuild the persona, apart from its embeddings, shared memory holding its embeddings)"""
+    arrays = []
+    store = _export_store(persona.mem, arrays)
+
+    shm, shapes = None, []
+    if arrays:
+        shm = shared_memory.SharedMemory(create=True, size=sum(a.nbytes for a in arrays))
+        offset = 0
+        for a in arrays:
+            np.ndarray(a.shape, a.dtype, shm.buf, offset)[:] = a
+            shapes.append((a.shape, a.dtype.str, offset))
+            offset += a.nbytes
+
+    state = {
+        "name": persona.name,
+        "identity": persona.identity,
+        "inst": persona.inst,
+        "examples": persona.examples,
+        "temp": persona.temp,
+        "time": persona.time,
+        "n_identity": persona._n_identity,
+        "prompt_budget": persona.prompts.budget,
+        "budget": None if persona.consolidator is None else persona.consolidator.budget,
+        "history": list(persona.history),
+        "store": store,
+        "shm": None if shm is None else shm.name,
+        "shapes": shapes,
+    }
+    return state, shm
+
+def _import(state: dict) -> tuple[Persona, shared_memory.SharedMemory | None]:
+    """The persona exported by _export, using its embeddings in shared memory, which has to stay open while it's used"""
+    shm = None if state["shm"] is None else shared_memory.SharedMemory(state["shm"])
+    arrays = [np.ndarray(shape, np.dtype(dtype), shm.buf, offset) for shape, dtype, offset in state["shapes"]]
+    mem = _import_store(state["store"], arrays)
+    persona = Persona(
+        state["name"], state["identity"], state["inst"], state["examples"], state["temp"],
+        mem=mem, budget=state["budget"], prompt_budget=state["prompt_budget"],
+    )
+    persona.time = state["time"]
+    persona._n_identity = state["n_identity"]
+    for msg_type, text in state["history"]:
+        persona._history.append(msg_type, text)
+    return persona, shm
+
+def _serve(conn, initializer: Callable | None, initargs: tuple) -> None:
+    """A worker process: runs requests (id, persona, op, args) from conn on threads, sending back (id, ok, result)."""
+    if initializer is not None:
+        initializer(*initargs)
+    personas = {}
+    shms = {}
+    drafts = {} # persona -> (draft number, draft), only the latest
+    numbers = itertools.count()
+    send_lock = threading.Lock()
+
+    def add(pid: int, state: dict) -> None:
+        personas[pid], shms[pid] = _import(state)
+
+    def remove(pid: int) -> None:
+        del personas[pid]
+        drafts.pop(pid, None)
+        shm = shms.pop(pid)
+        if shm is not None:
+            shm.close()
+
+    def draft(pid: int) -> int:
+        number = next(numbers)
+        drafts[pid] = (number, personas[pid].draft())
+        return number
+
+    def use_draft(pid: int, number: int) -> str:
+        latest, d = drafts.pop(pid, (None, None))
+        if latest != number:
+            raise ValueError(f"draft {number} of {personas[pid].name} isn't their latest")
+        return personas[pid].read(d)
+
+    ops = {
+        "add": add,
+        "remove": remove,
+        "read": lambda pid: personas[pid].read(),
+        "write": lambda pid, data: personas[pid].write(data),
+        "is_ready": lambda pid: personas[pid].is_ready,
+        "draft": draft,
+        "use_draft": use_draft,
+        "clear": lambda pid: personas[pid].clear(),
+    }
+
+    def run(req: int, pid: int, op: str, args: tuple) -> None:
+        try:
+            result = (req, True, ops[op](pid, *args))
+        except Exception as e:
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = RuntimeError(f"{type(e).__name__}: {e}")
+            result = (req, False, e)
+        with send_lock:
+            conn.send(result)
+
+    with ThreadPoolExecutor(max_workers=64) as pool:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                break
+            if request is None:
+                break
+            pool.submit(run, *request)
+    for shm in shms.values():
+        if shm is not None:
+            shm.close()
+
+class Worker:
+    """The pool's end of a worker process. Requests can be sent from any thread, and get a Future of their result."""
+    def __init__(self, context, initializer: Callable | None = None, initargs: tuple = ()):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child, initializer, initargs), daemon=True)
+        self.process.start()
+        child.close()
+        self.personas = 0
+        self._futures = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._receive, daemon=True).start()
+
+    def call(self, pid: int, op: str, *args) -> Future:
+        future = Future()
+        with self._lock:
+            req = next(self._ids)
+            self._futures[req] = future
+            self.conn.send((req, pid, op, args))
+        return future
+
+    def _receive(self) -> None:
+        while True:
+            try:
+                req, ok, result = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future = self._futures.pop(req)
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+        # the worker's gone, so nothing still waiting will get an answer
+        with self._lock:
+            futures, self._futures = list(self._futures.values()), {}
+        for future in futures:
+            future.set_exception(ConnectionError("worker process exited"))
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.send(None)
+        self.process.join()
+        self.conn.close()
+
+class RemoteClient(Client):
+    """
+    A persona living in a PersonaPool worker. Works like the persona: its reads, writes, readiness checks and drafts
+    run in the worker, and this end only keeps the history of what was said.
+    Writes don't wait for the worker, so telling everyone in a conversation a line happens on all workers at once -
+    the next request to the same persona waits for it instead.
+    """
+    can_draft = True
+
+    def __init__(self, pool: "PersonaPool", worker: Worker, pid: int, name: str):
+        super().__init__(name)
+        self.pool = pool
+        self._worker = worker
+        self._pid = pid
+        self._writing = None
+
+    def _send(self, op: str, *args) -> Future:
+        writing = self._writing
+        if writing is not None:
+            writing.result()
+        return self._worker.call(self._pid, op, *args)
+
+    def _call(self, op: str, *args):
+        return self._send(op, *args).result()
+
+    def _read(self) -> str:
+        return self._call("read")
+
+    def _write(self, data: str) -> None:
+        self._writing = self._send("write", data)
+
+    def _is_ready(self) -> bool:
+        return self._call("is_ready")
+
+    def _draft(self) -> int:
+        return self._call("draft")
+
+    def _use_draft(self, draft: int) -> str:
+        return self._call("use_draft", draft)
+
+    def clear(self) -> None:
+        super().clear()
+        self._call("clear")
+
+class PersonaPool:
+    """
+    Worker processes hosting personas, workers of them (by default one per core).
+    initializer(*initargs) runs at the start of each worker, e.g. to set the LLM backend (see util.set_backend),
+    since workers are started fresh rather than forked, and don't share the settings of this process.
+    """
+    def __init__(self, workers: int | None = None, initializer: Callable | None = None, initargs: tuple = ()):
+        context = multiprocessing.get_context("spawn")
+        self.workers = [Worker(context, initializer, initargs) for _ in range(workers or os.cpu_count() or 1)]
+        self._ids = itertools.count()
+        self._shms = {}
+        self._lock = threading.Lock()
+
+    def add(self, persona: Persona) -> RemoteClient:
+        """
+        Moves the persona into a worker - the persona itself shouldn't be used after this, only the client returned.
+        Workers take personas in turn, each going to the one with the fewest.
+        """
+        state, shm = _export(persona)
+        with self._lock:
+            pid = next(self._ids)
+            worker = min(self.workers, key=lambda w: w.personas)
+            worker.personas += 1
+            self._shms[pid] = shm
+        worker.call(pid, "add", state).result()
+        return RemoteClient(self, worker, pid, persona.name)
+
+    def remove(self, client: RemoteClient) -> None:
+        """Drops a persona from its worker."""
+        client._call("remove")
+        with self._lock:
+            client._worker.personas -= 1
+            shm = self._shms.pop(client._pid)
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.close()
+        with self._lock:
+            shms, self._shms = list(self._shms.values()), {}
+        for shm in shms:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    def __enter__(self) -> "PersonaPool":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
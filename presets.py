@@ -1,40 +1,52 @@
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
-
-from bs4 import BeautifulSoup as Soup
+import os
 
 import util
+import ingest
+import snapshot
 from client import OpenAIClient
 from persona import Persona
 
 DATA_PATH = "data.json"
+SNAPSHOT_DIR = "snapshots"
 PRESET_DATA = {}
 
 
+def html_text(html: str) -> str:
+    """the readable lines of a page"""
+    # only needed when building presets, and slow to import
+    from bs4 import BeautifulSoup as Soup
+
+    soup = Soup(html, features="html.parser")
+
+    # kill all script and style elements
+    for script in soup(["script", "style"]):
+        script.extract()  # rip it out
+
+    # get text
+    text = soup.get_text()
+
+    # break into lines and remove leading and trailing space on each
+    lines = (line.strip() for line in text.splitlines())
+    # break multi-headlines into a line each
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    # drop blank lines
+    return "\n".join(
+        chunk for chunk in chunks if chunk and any(p in chunk for p in ".,!?:;-")
+    )
+
+
 def get_text(urls: str | list[str]) -> list[str] | list[list[str]]:
+    """
+    The text of each page, fetched concurrently.
+    Unchanged pages are revalidated rather than downloaded again, and their text isn't re-extracted.
+    """
     single = isinstance(urls, str)
     urls = [urls] if single else urls
-    out = []
-    for url in urls:
-        html = requests.get(url).text
-        soup = Soup(html, features="html.parser")
-
-        # kill all script and style elements
-        for script in soup(["script", "style"]):
-            script.extract()  # rip it out
-
-        # get text
-        text = soup.get_text()
-
-        # break into lines and remove leading and trailing space on each
-        lines = (line.strip() for line in text.splitlines())
-        # break multi-headlines into a line each
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        # drop blank lines
-        text = "\n".join(
-            chunk for chunk in chunks if chunk and any(p in chunk for p in ".,!?:;-")
-        )
-        out.append(text)
+    pages = ingest.fetch(urls)
+    out = ingest.cached_many("text", [p.html for p in pages], lambda htmls: [html_text(h) for h in htmls])
     return out[0] if single else out
 
 
@@ -71,19 +83,74 @@ def load_persona(identifier: str) -> Persona:
     if identifier not in PRESET_DATA:
         raise NameError(f"persona {identifier} not found")
 
+    # snapshots are rebuilt whenever the preset they were built from changes
+    source = hashlib.sha1(json.dumps(PRESET_DATA[identifier]).encode("utf-8")).hexdigest()
+    path = snapshot_path(identifier)
+    meta = snapshot.read_meta(path)
+    if meta is not None and meta["source"] == source:
+        return snapshot.load(path)
+
     name, desc, ex, inst, temp = PRESET_DATA[identifier]
-    return Persona(name, list(set(desc)), inst, list(set(ex)), temp)
+    persona = Persona(name, list(dict.fromkeys(desc)), inst, list(dict.fromkeys(ex)), temp)
+    snapshot.save(persona, path, source)
+    return persona
+
+
+def load_snapshot(identifier: str) -> Persona | None:
+    """
+    The persona as saved in its snapshot, without needing its preset or checking it's up to date - or None if there's no snapshot.
+    The fast way to start up, once a persona has been built.
+    """
+    path = snapshot_path(identifier)
+    return snapshot.load(path) if snapshot.read_meta(path) is not None else None
+
+
+def snapshot_path(identifier: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, identifier.replace(":", "_").replace("/", "_"))
+
+
+def save_snapshot(persona: Persona, identifier: str) -> None:
+    """Saves a persona's current memories, so the next load_persona picks up where it left off."""
+    snapshot.save(persona, snapshot_path(identifier))
+
+
+# pages are split into chunks of about this many tokens for extraction, overlapping by CHUNK_OVERLAP
+CHUNK_TOKENS = 2000
+CHUNK_OVERLAP = 200
+
+
+def page_chunks(texts: list[str], chunk_tokens: int | None = CHUNK_TOKENS, overlap: int = CHUNK_OVERLAP) -> list[str]:
+    """every page's chunks, in order. chunk_tokens=None keeps each page whole"""
+    if chunk_tokens is None:
+        return texts
+    return [chunk for text in texts for chunk in util.chunk_text(text, chunk_tokens, overlap)]
+
+
+def merge(header: str, extracted: list[list[str]], threshold: float | None) -> list[str]:
+    """
+    Joins the lines extracted from each chunk after the header line, dropping blank lines and repeats.
+    Near-duplicates (by embedding similarity, see util.dedup) are dropped too unless threshold is None.
+    """
+    lines = [header] + [line.strip() for chunk in extracted for line in chunk if line.strip()]
+    return list(dict.fromkeys(lines)) if threshold is None else util.dedup(lines, threshold)
 
 
 def get_desc_from_wiki(
-    name: str, texts: str | list[str], model: str = util.GPT3
+    name: str,
+    texts: str | list[str],
+    model: str = util.GPT3,
+    chunk_tokens: int | None = CHUNK_TOKENS,
+    dedup_threshold: float | None = 0.95,
 ) -> list[str]:
+    """
+    Statements about the character, extracted from each chunk of the pages concurrently (map)
+    and merged without near-duplicates (reduce).
+    """
     if isinstance(texts, str):
         texts = [texts]
 
-    desc = [f"You are {name}."]
-    for text in texts:
-        prompt = f"""Turn the following webpage text into a set of statements about {name} and what they know.
+    def extract(todo: list[list[str]]) -> list[list[str]]:
+        prompts = [f"""Turn the following webpage text into a set of statements about {name} and what they know.
 Pay attention to {name}'s personality and character, not game mechanics or other 4th-wall breaking info.
 Place each statement on a seperate line, with no numbering or other prefixes. 
 Each statement should be in the second person.
@@ -92,9 +159,12 @@ Be sure to mention what {name} knows about other characters.
 Return up to 500 statements.
 Example: You are {name}.
 Text:
-{text}"""
-        desc.extend(util.call_LLM(prompt, model).splitlines())
-    return desc
+{text}""" for _, _, text in todo]
+        return [response.splitlines() for response in util.call_LLM(prompts, model, single=False)]
+
+    # chunks are only sent again if their text changed
+    extracted = ingest.cached_many("desc", [[name, model, text] for text in page_chunks(texts, chunk_tokens)], extract)
+    return merge(f"You are {name}.", extracted, dedup_threshold)
 
 
 #     prompt = f"""This is a list of statements about {name}.
@@ -105,32 +175,79 @@ Text:
 
 
 def get_quotes_from_wiki(
-    name: str, texts: str | list[str], model: str = util.GPT3
+    name: str,
+    texts: str | list[str],
+    model: str = util.GPT3,
+    chunk_tokens: int | None = CHUNK_TOKENS,
+    dedup_threshold: float | None = 0.95,
 ) -> list[str]:
+    """The character's quotes, extracted chunk by chunk like get_desc_from_wiki."""
     if isinstance(texts, str):
         texts = [texts]
 
-    quotes = [f"You are {name}."]
-    for text in texts:
-        prompt = f"""From this webpage, extract all of {name}'s quotes:
+    def extract(todo: list[list[str]]) -> list[list[str]]:
+        prompts = [f"""From this webpage text, extract all of {name}'s quotes:
 {text}
 Place each quote on a seperate line, with no numbering or other prefixes.
 Be sure to only grab quotes that {name} has said, not quotes about {name}.
-if no quotes can be found on this page, return NONE.
-"""
-        response = util.call_LLM(prompt, model)
-        if response.lower() != "none":
-            quotes.extend(response.splitlines())
+if no quotes can be found in this text, return NONE.
+""" for _, _, text in todo]
+        responses = util.call_LLM(prompts, model, single=False)
+        return [[] if response.strip().lower() == "none" else response.splitlines() for response in responses]
 
-    return quotes
+    extracted = ingest.cached_many("quotes", [[name, model, text] for text in page_chunks(texts, chunk_tokens)], extract)
+    return merge(f"You are {name}.", extracted, dedup_threshold)
 
 
 def get_tone(name: str, quotes: list[str], model: str = util.GPT3) -> str:
-    prompt = f"""Here are some of {name}'s quotes:
+    def tone(inputs: list) -> str:
+        prompt = f"""Here are some of {name}'s quotes:
 {util.jlines(util.last_n(util.shuffled(quotes), 20))}
 In one word, describe the tone / style of these quotes.
 Do not explain anything, returning only that single word."""
-    return util.call_LLM(prompt, model).strip().lower()
+        return util.call_LLM(prompt, model).strip().lower()
+
+    # the quotes are sampled at random, so the answer is cached to keep rebuilds stable
+    return ingest.cached("tone", [name, model, quotes], tone)
+
+
+def wiki_urls(urlname: str) -> list[str]:
+    return [
+        f"https://genshin-impact.fandom.com/wiki/{urlname}",
+        f"https://genshin-impact.fandom.com/wiki/{urlname}/Lore",
+        f"https://genshin-impact.fandom.com/wiki/{urlname}/Voice-Overs",
+        f"https://genshin-impact.fandom.com/wiki/{urlname}/Companion",
+    ]
+
+
+def build_preset(name: str, identifier: str, urls: list[str], model: str = util.GPT4) -> None:
+    """
+    Scrapes a character's pages into a preset.
+    Every stage is cached, so only pages that changed since the last build cost any LLM calls.
+    """
+    texts = get_text(urls)
+    print(f"{name} raw text loaded")
+    desc = get_desc_from_wiki(name, texts, model)
+    print(f"{name} desc loaded")
+    quotes = get_quotes_from_wiki(name, texts, model)
+    print(f"{name} quotes loaded")
+    tone = get_tone(name, quotes, model)
+    save_persona(
+        identifier,
+        name,
+        desc,
+        quotes,
+        f"Keep responses fairly short - around 1-3 sentences, like in a real conversation. \nRespond in a slightly {tone} tone.",
+        0.4,
+    )
+
+
+def build_roster(roster: list[tuple[str, str, str]], model: str = util.GPT4, workers: int = 8) -> None:
+    """Builds presets for (name, identifier, wiki page name) entries concurrently, then saves them."""
+    with ThreadPoolExecutor(max_workers=workers) as exc:
+        for future in [exc.submit(build_preset, name, identifier, wiki_urls(urlname), model) for name, identifier, urlname in roster]:
+            future.result()
+    save_data()
 
 
 if __name__ == "__main__":
@@ -151,28 +268,5 @@ if __name__ == "__main__":
         ("Xiangling", "genshin:Xiangling", "Xiangling")
     ]
 
-    for name, identifier, urlname in data:
-        print(f"loading {name}")
-        urls = [
-            f"https://genshin-impact.fandom.com/wiki/{urlname}",
-            f"https://genshin-impact.fandom.com/wiki/{urlname}/Lore",
-            f"https://genshin-impact.fandom.com/wiki/{urlname}/Voice-Overs",
-            f"https://genshin-impact.fandom.com/wiki/{urlname}/Companion",
-        ]
-        texts = get_text(urls)
-        print(f"{name} raw text loaded")
-        desc = get_desc_from_wiki(name, texts, util.GPT4)
-        print(f"{name} desc loaded")
-        quotes = get_quotes_from_wiki(name, texts, util.GPT4)
-        print(f"{name} quotes loaded")
-        tone = get_tone(name, quotes, util.GPT4)
-        save_persona(
-            identifier,
-            name,
-            desc,
-            quotes,
-            f"Keep responses fairly short - around 1-3 sentences, like in a real conversation. \nRespond in a slightly {tone} tone.",
-            0.4,
-        )
-        save_data()
-        print(f"saved {name}")
+    build_roster(data)
+    print(f"saved {', '.join(name for name, _, _ in data)}")
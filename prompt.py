@@ -0,0 +1,77 @@
+"""
+Prompt assembly, with whatever stays the same from turn to turn first.
+
+LLM providers (and local servers with a KV cache) reuse the work done on a prompt prefix
+they've seen recently, which makes a turn cheaper and faster, but only if the prefix is identical.
+So the parts of a persona's prompt that don't change - who they are, how to act, their examples -
+are fixed once and go first, and the recalled memories that change every turn go last,
+trimmed to fit a token budget.
+"""
+from dataclasses import dataclass
+import threading
+
+import util
+
+@dataclass
+class Prompt:
+    messages: list[tuple[int, str]]
+    tokens: int # approximate, see util.count_tokens
+    prefix_tokens: int # tokens before the first thing that changes from turn to turn
+    dropped: int # items left out to fit the budget
+
+class PromptAssembler:
+    """
+    Builds prompts made of a system message (the prefix), then a user message
+    of a header, the items for this turn one per line, and a footer.
+    The prefix, header and footer never change, so every prompt starts with the same prefix and header.
+    Items are dropped from the front (the oldest, for items in order) until the prompt fits in budget tokens.
+    Keeps running totals of the prompts built, see stats.
+    """
+    def __init__(self, prefix: str, header: str, footer: str, budget: int = 4000):
+        self.prefix = prefix
+        self.header = header
+        self.footer = footer
+        self.budget = budget
+        self._prefix_tokens = util.count_tokens(prefix) + util.count_tokens(header)
+        self._fixed = self._prefix_tokens + util.count_tokens(footer)
+        self._lock = threading.Lock()
+        self.last = None
+        self.turns = 0
+        self.tokens = 0
+        self.prefix_tokens = 0
+        self.dropped = 0
+
+    def build(self, items: list[str]) -> Prompt:
+        room = self.budget - self._fixed
+        start, used = len(items), 0
+        while start > 0:
+            cost = util.count_tokens(items[start - 1])
+            if used + cost > room:
+                break
+            used += cost
+            start -= 1
+
+        messages = [
+            (util.SYSTEM, self.prefix),
+            (util.USER, f"{self.header}{util.jlines(items[start:])}{self.footer}"),
+        ]
+        prompt = Prompt(messages, self._fixed + used, self._prefix_tokens, start)
+        with self._lock:
+            self.last = prompt
+            self.turns += 1
+            self.tokens += prompt.tokens
+            self.prefix_tokens += prompt.prefix_tokens
+            self.dropped += prompt.dropped
+        return prompt
+
+    def stats(self) -> dict:
+        """mean prompt size and cacheable prefix per prompt built, in tokens"""
+        with self._lock:
+            turns = max(self.turns, 1)
+            return {
+                "prompts": self.turns,
+                "prompt_tokens": self.tokens / turns,
+                "prefix_tokens": self.prefix_tokens / turns,
+                "prefix_share": self.prefix_tokens / max(self.tokens, 1),
+                "dropped": self.dropped,
+            }
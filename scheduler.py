@@ -0,0 +1,222 @@
+"""
+A process-wide scheduler for backend requests.
+Every LLM and embedding call goes through one long-lived pool of worker threads,
+which takes work in priority order, keeps to per-model request and token rate limits,
+and retries rate-limited and server-side failures with jittered exponential backoff.
+"""
+from concurrent.futures import Future
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable
+import contextvars
+import itertools
+import queue
+import random
+import threading
+import time
+
+# lower goes first
+INTERACTIVE = 0 # someone is waiting on this - conversation turns, readiness checks
+NORMAL = 1
+BACKGROUND = 2 # importance scoring, pre-embedding, page fetches
+
+def retryable(e: Exception) -> bool:
+    """whether a failed request is worth retrying - rate limits, server errors and dropped connections"""
+    from backend import RateLimitError
+    if isinstance(e, (RateLimitError, ConnectionError, TimeoutError)):
+        return True
+    # openai errors carry the status code themselves, requests' HTTPError on its response
+    status = getattr(e, "status_code", None) or getattr(getattr(e, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    # connection and timeout errors from openai and requests don't subclass the builtin ones
+    return type(e).__name__ in ("APIConnectionError", "APITimeoutError", "ConnectionError", "Timeout", "ConnectTimeout", "ReadTimeout")
+
+class TokenBucket:
+    """Allows rate units per minute, in bursts of up to a minute's worth."""
+    def __init__(self, rate: float):
+        self.rate = rate / 60
+        self.capacity = rate
+        self.level = rate
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, amount: float) -> float:
+        """How long until amount is in the bucket, without taking it."""
+        self._refill()
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+@dataclass(order=True)
+class Job:
+    priority: int
+    seq: int
+    fn: Callable = field(compare=False)
+    args: tuple = field(compare=False)
+    model: str | None = field(compare=False)
+    tokens: int = field(compare=False)
+    future: Future = field(compare=False)
+    queued: float = field(compare=False)
+    attempt: int = field(compare=False, default=0)
+    # the submitter's context, so e.g. tracing spans started by fn know what they're part of
+    context: contextvars.Context = field(compare=False, default_factory=contextvars.copy_context)
+
+class Scheduler:
+    def __init__(self, workers: int = 64, max_retries: int = 6, base_delay: float = 0.5, max_delay: float = 30.0):
+        self.workers = workers
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._threads = []
+        self._limits = {} # model -> (requests bucket, tokens bucket)
+        self._held = {} # model -> jobs waiting for its rate limits, requeued together once there's room
+        self._lock = threading.Lock()
+
+        self.completed = 0
+        self.retries = 0
+        self.failed = 0
+        self.waits = {p: deque(maxlen=1000) for p in (INTERACTIVE, NORMAL, BACKGROUND)}
+        self.throttled = 0.0 # total seconds spent waiting on rate limits
+
+    def set_limit(self, model: str, rpm: float | None = None, tpm: float | None = None) -> None:
+        """Limits the requests and tokens per minute sent for a model."""
+        with self._lock:
+            self._limits[model] = (
+                None if rpm is None else TokenBucket(rpm),
+                None if tpm is None else TokenBucket(tpm),
+            )
+
+    def _start(self) -> None:
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, fn: Callable, *args, priority: int = NORMAL, model: str | None = None, tokens: int = 0) -> Future:
+        """Queues fn(*args), returning a future for its result."""
+        if not self._threads:
+            self._start()
+        job = Job(priority, next(self._seq), fn, args, model, tokens, Future(), time.monotonic())
+        self._queue.put(job)
+        return job.future
+
+    def run(self, fn: Callable, *args, **kwargs):
+        """Queues fn(*args) and waits for its result."""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def admit(self, model: str | None, tokens: int = 0) -> None:
+        """Blocks until a request for the model fits in its rate limits, for requests made outside the pool."""
+        while True:
+            delay = self._take(model, tokens)
+            if not delay:
+                return
+            self.throttled += delay
+            time.sleep(delay)
+
+    def _take(self, model: str | None, tokens: int) -> float:
+        """
+        Takes a request's worth out of the model's rate limits if they have it, returning 0.
+        Otherwise takes nothing, and returns how long until they will - so nothing waiting builds up debt
+        that a more urgent request would have to queue behind.
+        """
+        with self._lock:
+            requests, token_bucket = self._limits.get(model, (None, None))
+            delay = max(
+                requests.wait(1) if requests else 0.0,
+                token_bucket.wait(tokens) if token_bucket else 0.0,
+            )
+            if not delay:
+                if requests:
+                    requests.take(1)
+                if token_bucket:
+                    token_bucket.take(tokens)
+            return delay
+
+    def _hold(self, job: Job, delay: float) -> None:
+        """puts a job over its rate limits aside until they have room, without holding a worker"""
+        self.throttled += delay
+        with self._lock:
+            held = self._held.get(job.model)
+            if held is None:
+                held = self._held[job.model] = []
+                timer = threading.Timer(delay, self._release, (job.model,))
+                timer.daemon = True
+                timer.start()
+            held.append(job)
+
+    def _release(self, model: str | None) -> None:
+        # back in the queue all at once, so the most urgent of them gets the room
+        with self._lock:
+            held = self._held.pop(model)
+        for job in held:
+            self._queue.put(job)
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job.future.running():
+                # a retry, or held for the rate limits - already started
+                self._run(job)
+            elif job.future.set_running_or_notify_cancel():
+                self._run(job)
+
+    def _run(self, job: Job) -> None:
+        delay = self._take(job.model, job.tokens)
+        if delay:
+            self._hold(job, delay)
+            return
+        if not job.attempt:
+            # time held for the rate limits counts too - it's all time the caller waited
+            self.waits[job.priority].append(time.monotonic() - job.queued)
+        try:
+            result = job.context.run(job.fn, *job.args)
+        except Exception as e:
+            if job.attempt < self.max_retries and retryable(e):
+                self._retry(job)
+            else:
+                self.failed += 1
+                job.future.set_exception(e)
+            return
+        self.completed += 1
+        job.future.set_result(result)
+
+    def _retry(self, job: Job) -> None:
+        """requeues a failed job after a jittered exponential backoff, without holding a worker"""
+        self.retries += 1
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** job.attempt))
+        job.attempt += 1
+
+        timer = threading.Timer(delay, self._queue.put, (job,))
+        timer.daemon = True
+        timer.start()
+
+    def stats(self) -> dict:
+        """queue depth, wait times (in seconds) per priority, and request counts"""
+        names = {INTERACTIVE: "interactive", NORMAL: "normal", BACKGROUND: "background"}
+        return {
+            "queue_depth": self._queue.qsize(),
+            "completed": self.completed,
+            "retries": self.retries,
+            "failed": self.failed,
+            "throttled_s": self.throttled,
+            "wait": {
+                names[p]: {
+                    "count": len(w),
+                    "mean_s": sum(w) / len(w) if w else 0.0,
+                    "max_s": max(w, default=0.0),
+                }
+                for p, w in self.waits.items()
+            },
+        }
+
+SCHEDULER = Scheduler()
@@ -0,0 +1,418 @@
+"""
+A conversation server, hosting many users' conversations with a shared roster of personas in one process.
+
+Each persona is loaded once (see Roster), and every conversation with it gets a fork of it (see Persona.fork):
+the memories it was loaded with are shared read-only between sessions, and a session only holds what's happened in it.
+Sessions that go unused for a while are saved to disk and dropped, and picked up from there when they're next used.
+
+Requests and responses are JSON objects, one per line, over a local TCP socket (see Server.listen and Connection),
+or passed straight to Server.handle in-process:
+
+    {"op": "open", "personas": ["Raiden"]}               -> {"ok": true, "session": "3f2a..."}
+    {"op": "say", "session": "3f2a...", "text": "Hi!"}   -> {"ok": true, "name": "Raiden", "text": "..."}
+    {"op": "write", "session": ..., "text": ...}         -> {"ok": true}
+    {"op": "read", "session": ..., "persona": ...}       -> {"ok": true, "name": ..., "text": ...}
+    {"op": "is_ready", "session": ..., "persona": ...}   -> {"ok": true, "ready": true}
+    {"op": "close", "session": ...}                      -> {"ok": true}
+    {"op": "stats"}                                      -> {"ok": true, "sessions": ..., ...}
+
+say writes "<name>: <text>" (name defaults to "User") to every persona in the session, and gets the reply
+of whoever speaks next. write goes to every persona, or just the one given. Failed requests get {"ok": false, "error": ...}.
+
+    python3 server.py --port 8765
+"""
+from contextlib import contextmanager
+from typing import Callable, Iterator
+import argparse
+import json
+import os
+import re
+import socket
+import socketserver
+import threading
+import time
+import uuid
+
+import numpy as np
+
+import presets
+import tracing
+from persona import Memory, Persona
+from speaker import SpeakerSelector
+
+SESSION_DIR = "sessions"
+PORT = 8765
+
+class Roster:
+    """
+    The personas conversations can be had with, each loaded by load(identifier) the first time it's asked for.
+    They're only ever forked, never talked to, so their memories stay as loaded.
+    """
+    def __init__(self, load: Callable[[str], Persona | None] = presets.load_snapshot):
+        self.load = load
+        self._bases = {}
+        self._lock = threading.Lock()
+
+    def add(self, identifier: str, persona: Persona) -> None:
+        """Adds an already built persona."""
+        with self._lock:
+            self._add(identifier, persona)
+
+    def _add(self, identifier: str, persona: Persona) -> None:
+        # the first fork waits on the persona's pending embeddings and importances,
+        # so forking it after that only reads it, and can happen on many threads at once
+        persona.fork()
+        self._bases[identifier] = persona
+
+    def base(self, identifier: str) -> Persona:
+        with self._lock:
+            persona = self._bases.get(identifier)
+            if persona is None:
+                persona = self.load(identifier)
+                if persona is None:
+                    raise NameError(f"persona {identifier} not found")
+                self._add(identifier, persona)
+            return persona
+
+    def fork(self, identifier: str) -> Persona:
+        return self.base(identifier).fork()
+
+    @property
+    def nbytes(self) -> int:
+        """bytes of embeddings shared by all the sessions"""
+        with self._lock:
+            return sum(p.mem.nbytes for p in self._bases.values())
+
+def fork_state(persona: Persona) -> tuple[dict, np.ndarray]:
+    """
+    What's changed in a forked persona since it was forked, as (JSON-able state, embeddings of its new memories).
+    Archived memories (see consolidate.py) aren't kept.
+    """
+    mem = persona.mem
+    pending = np.flatnonzero(np.isnan(mem.imp[:mem.n]))
+    if len(pending) and mem.resolve_imp is not None:
+        mem.resolve_imp([mem[i] for i in pending])
+    mem.fill_emb()
+    # a store that's stopped sharing (say, after consolidation) saves every row
+    rows = range(mem.n_shared, mem.n)
+    state = {
+        "time": persona.time,
+        "shared": mem.n_shared,
+        "acc": mem.acc[:mem.n].tolist(),
+        "memories": [[int(mem.type[i]), mem.desc(i), int(mem.crt[i]), float(mem.imp[i]), [r for r in mem.refs(i) if r >= 0]] for i in rows],
+        "history": list(persona.history),
+    }
+    return state, mem.decode(np.arange(mem.n_shared, mem.n))
+
+def restore_fork(base: Persona, state: dict, emb: np.ndarray) -> Persona:
+    """A fork of base, with the changes from fork_state put back."""
+    persona = base.fork()
+    mem = persona.mem
+    mem.truncate(state["shared"])
+    for (mem_type, desc, crt, imp, refs), vector in zip(state["memories"], emb):
+        m = Memory(mem_type, desc, crt, [mem[r] for r in refs], imp)
+        mem.append(m)
+        m.set_emb(vector)
+    mem.acc[:mem.n] = state["acc"]
+    mem.reset_recency()
+    persona.time = state["time"]
+    for msg_type, text in state["history"]:
+        persona._history.append(msg_type, text)
+    return persona
+
+class Session:
+    """One conversation: forks of some of the roster's personas, used by one request at a time."""
+    def __init__(self, id: str, identifiers: list[str], personas: list[Persona], speculate: int = 0):
+        self.id = id
+        self.identifiers = identifiers
+        self.personas = personas
+        self.selector = SpeakerSelector(speculate)
+        self.used = time.monotonic()
+        self.lock = threading.Lock()
+        self.closed = False # set once evicted or closed, for requests that were waiting on the lock
+
+    def persona(self, identifier: str | None) -> Persona:
+        if identifier is None and len(self.personas) == 1:
+            return self.personas[0]
+        if identifier not in self.identifiers:
+            raise KeyError(f"no persona {identifier} in session {self.id}")
+        return self.personas[self.identifiers.index(identifier)]
+
+class Server:
+    """
+    Handles requests for many sessions at once, each a conversation with forks of the roster's personas.
+    Sessions unused for idle seconds, or the least recently used ones past max_sessions,
+    are saved to session_dir and dropped by evict_idle, which listen runs in the background.
+    speculate is passed on to each session's SpeakerSelector.
+    """
+    def __init__(
+            self,
+            roster: Roster,
+            session_dir: str = SESSION_DIR,
+            idle: float = 600.0,
+            max_sessions: int | None = None,
+            speculate: int = 0,
+        ):
+        self.roster = roster
+        self.session_dir = session_dir
+        self.idle = idle
+        self.max_sessions = max_sessions
+        self.speculate = speculate
+        self.sessions = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.requests = 0
+        self.evicted = 0
+        self.restored = 0
+
+    def handle(self, request: dict) -> dict:
+        """The response to one request."""
+        if not isinstance(request, dict):
+            return {"ok": False, "error": "a request must be a JSON object"}
+        op = request.get("op")
+        handler = getattr(self, f"_{op}", None) if op in self.OPS else None
+        if handler is None:
+            return {"ok": False, "error": f"unknown op {op}, expected one of {self.OPS}"}
+        with self._lock:
+            self.requests += 1
+        try:
+            with tracing.span("request", op=op):
+                return {"ok": True, **handler(request)}
+        except Exception as e:
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+    OPS = ("open", "say", "write", "read", "is_ready", "close", "stats")
+
+    def _open(self, request: dict) -> dict:
+        session_id = request.get("session") or uuid.uuid4().hex
+        identifiers = list(request["personas"])
+        if not identifiers:
+            raise ValueError("a session needs at least one persona")
+        self._check_id(session_id)
+        session = Session(session_id, identifiers, [self.roster.fork(i) for i in identifiers], self.speculate)
+        with self._lock:
+            if session_id in self.sessions or os.path.exists(self._path(session_id, ".json")):
+                raise ValueError(f"session {session_id} already exists")
+            self.sessions[session_id] = session
+        self._limit()
+        return {"session": session_id}
+
+    def _say(self, request: dict) -> dict:
+        with self._session(request["session"]) as session:
+            line = f"{request.get('name', 'User')}: {request['text']}"
+            for p in session.personas:
+                p.write(line)
+            if len(session.personas) == 1:
+                speaker, response = session.personas[0], session.personas[0].read()
+            else:
+                speaker, response = session.selector.speak(session.personas)
+                for p in session.personas:
+                    if p is not speaker:
+                        p.write(f"{speaker.name}: {response}")
+            return {"name": speaker.name, "text": response}
+
+    def _write(self, request: dict) -> dict:
+        with self._session(request["session"]) as session:
+            targets = session.personas if request.get("persona") is None else [session.persona(request["persona"])]
+            for p in targets:
+                p.write(request["text"])
+            return {}
+
+    def _read(self, request: dict) -> dict:
+        with self._session(request["session"]) as session:
+            p = session.persona(request.get("persona"))
+            return {"name": p.name, "text": p.read()}
+
+    def _is_ready(self, request: dict) -> dict:
+        with self._session(request["session"]) as session:
+            return {"ready": session.persona(request.get("persona")).is_ready}
+
+    def _close(self, request: dict) -> dict:
+        with self._session(request["session"]) as session:
+            session.closed = True
+            with self._lock:
+                self.sessions.pop(session.id, None)
+            for ext in (".json", ".npz"):
+                if os.path.exists(self._path(session.id, ext)):
+                    os.remove(self._path(session.id, ext))
+            return {}
+
+    def _stats(self, request: dict) -> dict:
+        with self._lock:
+            sessions = list(self.sessions.values())
+            stats = {"sessions": len(sessions), "requests": self.requests, "evicted": self.evicted, "restored": self.restored}
+        # read without the sessions' locks, so it's only approximate
+        stats["session_bytes"] = sum(p.mem.nbytes for s in sessions for p in s.personas)
+        stats["shared_bytes"] = self.roster.nbytes
+        return stats
+
+    @contextmanager
+    def _session(self, session_id: str) -> Iterator[Session]:
+        """The session, locked for this request, restored from disk first if it was evicted."""
+        self._check_id(session_id)
+        while True:
+            with self._lock:
+                session = self.sessions.get(session_id)
+            if session is None:
+                session = self._restore(session_id)
+            with session.lock:
+                # evicted or closed while this request was waiting, so it's looked up again
+                if session.closed:
+                    continue
+                session.used = time.monotonic()
+                yield session
+                return
+
+    @staticmethod
+    def _check_id(session_id: str) -> None:
+        # ids are file names
+        if not re.fullmatch(r"[\w-]{1,64}", session_id):
+            raise ValueError(f"bad session id {session_id!r}")
+
+    def _path(self, session_id: str, ext: str) -> str:
+        return os.path.join(self.session_dir, session_id + ext)
+
+    def _save(self, session: Session) -> None:
+        os.makedirs(self.session_dir, exist_ok=True)
+        states, embs = zip(*(fork_state(p) for p in session.personas))
+        np.savez(self._path(session.id, ".npz"), *embs)
+        # the JSON is written last, so an interrupted save leaves the last one readable
+        with open(self._path(session.id, ".json.tmp"), "w") as file:
+            json.dump({"personas": session.identifiers, "states": states}, file)
+        os.replace(self._path(session.id, ".json.tmp"), self._path(session.id, ".json"))
+
+    def _restore(self, session_id: str) -> Session:
+        if not os.path.exists(self._path(session_id, ".json")):
+            raise KeyError(f"no session {session_id}")
+        with tracing.span("restore"):
+            with open(self._path(session_id, ".json")) as file:
+                saved = json.load(file)
+            with np.load(self._path(session_id, ".npz")) as embs:
+                personas = [
+                    restore_fork(self.roster.base(identifier), state, embs[f"arr_{i}"])
+                    for i, (identifier, state) in enumerate(zip(saved["personas"], saved["states"]))
+                ]
+        with self._lock:
+            # another request may have restored it in the meantime, and that one's kept
+            session = self.sessions.get(session_id)
+            if session is not None:
+                return session
+            session = self.sessions[session_id] = Session(session_id, saved["personas"], personas, self.speculate)
+            self.restored += 1
+        self._limit()
+        return session
+
+    def _limit(self) -> None:
+        if self.max_sessions is not None and len(self.sessions) > self.max_sessions:
+            self.evict_idle()
+
+    def evict_idle(self) -> int:
+        """
+        Saves and drops the sessions unused for idle seconds, and the least recently used ones past max_sessions.
+        Returns how many were evicted.
+        """
+        now = time.monotonic()
+        with self._lock:
+            by_use = sorted(self.sessions.values(), key=lambda s: s.used)
+        over = len(by_use) - self.max_sessions if self.max_sessions is not None else 0
+        evicted = 0
+        for i, session in enumerate(by_use):
+            if i < over or now - session.used > self.idle:
+                evicted += self._evict(session)
+        return evicted
+
+    def _evict(self, session: Session) -> bool:
+        with session.lock:
+            if session.closed:
+                return False
+            with tracing.span("evict", personas=len(session.personas)):
+                self._save(session)
+            session.closed = True
+            with self._lock:
+                self.sessions.pop(session.id, None)
+                self.evicted += 1
+            return True
+
+    def evict_all(self) -> None:
+        """Saves and drops every session, e.g. before shutting down."""
+        with self._lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            self._evict(session)
+
+    def _evict_loop(self) -> None:
+        while not self._stop.wait(max(min(self.idle / 4, 60.0), 0.1)):
+            self.evict_idle()
+
+    def listen(self, host: str = "127.0.0.1", port: int = PORT) -> socketserver.ThreadingTCPServer:
+        """
+        A TCP server taking requests as lines of JSON, one connection per thread, and starts evicting idle sessions.
+        Call serve_forever on it to start serving. Port 0 picks a free port, see server_address.
+        """
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    try:
+                        response = server.handle(json.loads(line))
+                    except json.JSONDecodeError as e:
+                        response = {"ok": False, "error": f"bad JSON: {e}"}
+                    self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+                    self.wfile.flush()
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        tcp = socketserver.ThreadingTCPServer((host, port), Handler)
+        tcp.daemon_threads = True
+        threading.Thread(target=self._evict_loop, daemon=True).start()
+        return tcp
+
+    def stop(self) -> None:
+        """Stops evicting in the background, and saves every session."""
+        self._stop.set()
+        self.evict_all()
+
+class Connection:
+    """A connection to a listening Server, making one request at a time."""
+    def __init__(self, host: str = "127.0.0.1", port: int = PORT):
+        self._sock = socket.create_connection((host, port))
+        self._file = self._sock.makefile("rwb")
+
+    def request(self, op: str, **args) -> dict:
+        """The response to a request, raising RuntimeError if it failed."""
+        self._file.write((json.dumps({"op": op, **args}) + "\n").encode("utf-8"))
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("server closed the connection")
+        response = json.loads(line)
+        if not response["ok"]:
+            raise RuntimeError(response["error"])
+        return response
+
+    def close(self) -> None:
+        self._file.close()
+        self._sock.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves conversations with the personas saved in snapshots/ (see presets.py).")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--sessions", default=SESSION_DIR, help="where idle sessions are saved")
+    parser.add_argument("--idle", type=float, default=600.0, help="seconds before an unused session is saved and dropped")
+    parser.add_argument("--max-sessions", type=int, help="sessions kept in memory at most")
+    parser.add_argument("--speculate", type=int, default=0, help="speakers to draft speculatively in sessions with more than one persona")
+    args = parser.parse_args()
+
+    server = Server(Roster(), args.sessions, args.idle, args.max_sessions, args.speculate)
+    tcp = server.listen(args.host, args.port)
+    print(f"listening on {args.host}:{tcp.server_address[1]}")
+    try:
+        tcp.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tcp.server_close()
+        server.stop()
@@ -0,0 +1,205 @@
+"""
+A binary, column-oriented snapshot format for personas.
+
+Each persona gets a directory holding meta.json plus one raw file per column:
+the MemoryStore columns and embeddings, the memory texts (one utf-8 blob plus offsets),
+and the references between memories (CSR-style offsets plus row indices, negative for archived rows).
+Loading memory-maps the files copy-on-write, and Memory objects are only built when accessed.
+Saving again to the same directory appends the new rows and rewrites only the changed ones.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+
+from persona import Persona
+from store import MemoryStore
+
+VERSION = 1
+META = "meta.json"
+ARCHIVE = "archive" # subdirectory holding the archived memories, in the same format
+
+def _file(path: str, name: str) -> str:
+    return os.path.join(path, name + ".bin")
+
+def exists(path: str) -> bool:
+    return os.path.exists(os.path.join(path, META))
+
+def read_meta(path: str) -> dict | None:
+    if not exists(path):
+        return None
+    with open(os.path.join(path, META)) as file:
+        meta = json.load(file)
+    return meta if meta.get("version") == VERSION else None
+
+def _columns(store: MemoryStore) -> dict[str, np.ndarray]:
+    """every per-row array of the store, by file name"""
+    columns = {name: getattr(store, name) for name in store.COLUMNS}
+    columns["has_emb"] = store.has_emb
+    if store.emb is not None or store.n_shared:
+        # a forked store's embeddings are split between its own and the shared ones, see MemoryStore.fork
+        columns["emb"], scale = store.stored_emb(slice(0, store.n))
+        if scale is not None:
+            columns["scale"] = scale
+    return columns
+
+def _write_rows(path: str, store: MemoryStore, start: int, mode: str) -> None:
+    """
+    writes (mode "wb") or appends (mode "ab") rows start: of the store.
+    Files are never truncated in place, since a loaded store may still have them mapped:
+    full writes go to new files which then replace the old ones.
+    """
+    written = []
+
+    def target(name: str) -> str:
+        if mode == "ab":
+            return _file(path, name)
+        written.append(name)
+        return _file(path, name) + ".tmp"
+
+    for name, column in _columns(store).items():
+        with open(target(name), mode) as file:
+            np.ascontiguousarray(column[start:store.n]).tofile(file)
+
+    texts = [store.desc(i).encode("utf-8") for i in range(start, store.n)]
+    refs = [store.refs(i) for i in range(start, store.n)]
+    text_base, ref_base = 0, 0
+    if mode == "ab":
+        text_base = os.path.getsize(_file(path, "text"))
+        ref_base = os.path.getsize(_file(path, "refs")) // 8
+
+    with open(target("text"), mode) as file:
+        file.write(b"".join(texts))
+    with open(target("refs"), mode) as file:
+        np.array([r for row in refs for r in row], dtype=np.int64).tofile(file)
+
+    # offsets have one more entry than there are rows, so appending skips the first one
+    text_offsets = text_base + np.concatenate(([0], np.cumsum([len(t) for t in texts], dtype=np.int64)))
+    ref_offsets = ref_base + np.concatenate(([0], np.cumsum([len(r) for r in refs], dtype=np.int64)))
+    for name, offsets in (("text_offsets", text_offsets), ("ref_offsets", ref_offsets)):
+        with open(target(name), mode) as file:
+            (offsets if mode == "wb" else offsets[1:]).astype(np.int64).tofile(file)
+
+    for name in written:
+        os.replace(_file(path, name) + ".tmp", _file(path, name))
+
+def _rewrite_rows(path: str, store: MemoryStore, rows: list[int], saved: int) -> None:
+    """overwrites the fixed-size columns of already saved rows in place"""
+    if not rows:
+        return
+    for name, column in _columns(store).items():
+        on_disk = np.memmap(_file(path, name), dtype=column.dtype, mode="r+", shape=(saved,) + column.shape[1:])
+        on_disk[rows] = column[rows]
+        on_disk.flush()
+
+def save_store(store: MemoryStore, path: str, extra: dict | None = None) -> None:
+    """
+    Saves a memory stream, and its archive if it has one, to the directory at path.
+    If it was last saved to or loaded from the same snapshot, only what changed is written.
+    extra is added to meta.json.
+    """
+    pending = np.flatnonzero(np.isnan(store.imp[:store.n]))
+    if len(pending) and store.resolve_imp is not None:
+        store.resolve_imp([store[i] for i in pending])
+    store.fill_emb(list(store.pending))
+
+    os.makedirs(path, exist_ok=True)
+    old = read_meta(path)
+    incremental = (
+        old is not None
+        and store.snapshot == (os.path.abspath(path), old["n"])
+        and store.n >= old["n"]
+        and (old["dim"], old["dtype"]) == (store.dim, store.dtype)
+        and ("emb" in old["columns"]) == (store.emb is not None or store.n_shared > 0)
+    )
+
+    if incremental:
+        saved = old["n"]
+        _rewrite_rows(path, store, sorted(i for i in store.dirty if i < saved), saved)
+        _write_rows(path, store, saved, "ab")
+    else:
+        _write_rows(path, store, 0, "wb")
+
+    if store.archive is not None:
+        save_store(store.archive, os.path.join(path, ARCHIVE))
+    elif exists(os.path.join(path, ARCHIVE)):
+        shutil.rmtree(os.path.join(path, ARCHIVE))
+
+    meta = {
+        "version": VERSION,
+        **(extra or {}),
+        "n": store.n,
+        "dim": store.dim,
+        "dtype": store.dtype,
+        "columns": {name: str(column.dtype) for name, column in _columns(store).items()},
+    }
+    # meta.json is written last, so an interrupted save leaves the old snapshot readable
+    with open(os.path.join(path, META + ".tmp"), "w") as file:
+        json.dump(meta, file, indent=4)
+    os.replace(os.path.join(path, META + ".tmp"), os.path.join(path, META))
+
+    store.dirty.clear()
+    store.snapshot = (os.path.abspath(path), store.n)
+
+def save(persona: Persona, path: str, source: str | None = None) -> None:
+    """
+    Saves a persona's memories and settings to the directory at path.
+    source identifies what the persona was built from, so stale snapshots can be detected.
+    """
+    old = read_meta(path)
+    save_store(persona.mem, path, {
+        "name": persona.name,
+        "inst": persona.inst,
+        "examples": persona.examples,
+        "temp": persona.temp,
+        "time": persona.time,
+        "identity": persona._n_identity,
+        "source": source if source is not None or old is None else old.get("source"),
+    })
+
+def load_store(path: str, meta: dict | None = None) -> MemoryStore:
+    """The memory stream saved at path, memory-mapped copy-on-write."""
+    meta = meta or read_meta(path)
+    n = meta["n"]
+    store = MemoryStore(max(n, 1), dtype=meta["dtype"], dim=meta["dim"])
+    store.n = n
+
+    def mapped(name: str, shape: tuple = ()):
+        dtype = np.dtype(meta["columns"][name])
+        if n == 0:
+            return np.zeros((1,) + shape, dtype=dtype)
+        return np.memmap(_file(path, name), dtype=dtype, mode="c", shape=(n,) + shape)
+
+    for name in list(store.COLUMNS) + ["has_emb"]:
+        setattr(store, name, mapped(name))
+    if "emb" in meta["columns"]:
+        store.emb = mapped("emb", (meta["dim"],))
+    if "scale" in meta["columns"]:
+        store.scale = mapped("scale")
+
+    text = np.memmap(_file(path, "text"), dtype=np.uint8, mode="r") if os.path.getsize(_file(path, "text")) else np.zeros(0, np.uint8)
+    refs = np.memmap(_file(path, "refs"), dtype=np.int64, mode="r") if os.path.getsize(_file(path, "refs")) else np.zeros(0, np.int64)
+    store.lazy = (
+        text,
+        np.fromfile(_file(path, "text_offsets"), dtype=np.int64),
+        np.fromfile(_file(path, "ref_offsets"), dtype=np.int64),
+        refs,
+    )
+    store.mems = [None] * n
+    store.reset_recency()
+    store.snapshot = (os.path.abspath(path), n)
+    if exists(os.path.join(path, ARCHIVE)):
+        store.archive = load_store(os.path.join(path, ARCHIVE))
+    return store
+
+def load(path: str) -> Persona:
+    """The persona saved at path."""
+    meta = read_meta(path)
+    if meta is None:
+        raise FileNotFoundError(f"no snapshot at {path}")
+    store = load_store(path, meta)
+    identity = [store.desc(i) for i in range(meta["identity"])]
+    persona = Persona(meta["name"], identity, meta["inst"], meta["examples"], meta["temp"], mem=store)
+    persona.time = meta["time"]
+    return persona
@@ -0,0 +1,73 @@
+"""
+Picking who speaks next in a conversation between more than two clients.
+
+Every candidate is asked whether they're ready at the same time, rather than one after another.
+Optionally, the likeliest speakers start writing their line (see Client.draft) while that's going on,
+so by the time the speaker is known, their line is often already written.
+"""
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable
+import contextvars
+import random
+import threading
+
+from client import Client
+
+class SpeakerSelector:
+    """
+    Picks a random ready candidate to speak next: the candidates are shuffled,
+    and the first one in that order that's ready speaks (or the first one, if none are),
+    which is a uniform pick among the ready ones.
+    With speculate, the first speculate candidates in that order that can draft
+    start drafting their line alongside the readiness checks. Drafts that lose are thrown away.
+    """
+    _pool = ThreadPoolExecutor(max_workers=64)
+
+    def __init__(self, speculate: int = 0):
+        self.speculate = speculate
+        self._lock = threading.Lock()
+        self.turns = 0
+        self.hits = 0 # turns where the speaker had been drafted
+        self.wasted = 0 # drafts thrown away after being written
+
+    def _submit(self, fn: Callable) -> Future:
+        # in the caller's context, so the work shows up under the caller's tracing span
+        return self._pool.submit(contextvars.copy_context().run, fn)
+
+    def pick(self, candidates: list[Client]) -> Client:
+        """The next speaker out of the candidates."""
+        return self._pick(random.sample(candidates, len(candidates)))
+
+    def _pick(self, order: list[Client]) -> Client:
+        if len(order) == 1:
+            return order[0]
+        # every check is waited on, so none can finish late and cache a stale answer
+        ready = [future.result() for future in [self._submit(lambda p=p: p.is_ready) for p in order]]
+        return next((p for p, r in zip(order, ready) if r), order[0])
+
+    def speak(self, candidates: list[Client]) -> tuple[Client, str]:
+        """The next speaker out of the candidates, and what they say."""
+        order = random.sample(candidates, len(candidates))
+        drafts = {p: self._submit(p.draft) for p in [p for p in order if p.can_draft][:self.speculate]}
+        try:
+            speaker = self._pick(order)
+            draft = drafts.pop(speaker, None)
+            response = speaker.read() if draft is None else speaker.read(draft.result())
+        finally:
+            # the others are written to next, which can't happen while their drafts are still reading them
+            losers = [draft for draft in drafts.values() if not draft.cancel()]
+            wait(losers)
+
+        with self._lock:
+            self.turns += 1
+            self.hits += draft is not None
+            self.wasted += len(losers)
+        return speaker, response
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "turns": self.turns,
+                "hit_rate": self.hits / max(self.turns, 1),
+                "wasted_drafts": self.wasted,
+            }
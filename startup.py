@@ -0,0 +1,41 @@
+"""
+Timing of startup, to see where the time to the first prompt goes.
+Import this first, so the clock starts as early as possible, and wrap each step in a phase:
+
+    import startup
+    with startup.phase("imports"):
+        import persona
+    ...
+    startup.report()
+
+The report is only printed with the STARTUP_PROFILE environment variable set.
+For a breakdown of the imports themselves, run with python -X importtime.
+"""
+from contextlib import contextmanager
+import os
+import sys
+import time
+
+START = time.perf_counter()
+ENABLED = bool(os.environ.get("STARTUP_PROFILE"))
+
+# (name, seconds, modules imported) of each phase so far
+PHASES = []
+
+@contextmanager
+def phase(name: str):
+    start = time.perf_counter()
+    modules = len(sys.modules)
+    try:
+        yield
+    finally:
+        PHASES.append((name, time.perf_counter() - start, len(sys.modules) - modules))
+
+def report(file=sys.stderr) -> None:
+    """Prints how long each phase took, and the time from the start until now."""
+    if not ENABLED:
+        return
+    for name, seconds, modules in PHASES:
+        imported = f" ({modules} modules imported)" if modules else ""
+        print(f"{name:<24}{seconds * 1000:9.1f} ms{imported}", file=file)
+    print(f"{'time to ready':<24}{(time.perf_counter() - START) * 1000:9.1f} ms", file=file)
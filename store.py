@@ -0,0 +1,727 @@
+from typing import Callable
+
+import numpy as np
+
+import ann
+import scheduler
+import util
+
+# weights of the recall score terms - see Persona.recall_score
+RELEVANCE_W = 5.0
+RECENCY_W = 2.0
+IMPORTANCE_W = 3.0
+DECAY = 0.995
+RRF_K = 60 # rank offset in reciprocal rank fusion
+FUSIONS = ("sum", "max", "rrf")
+
+class Column:
+    """
+    Descriptor for a memory attribute that lives in a MemoryStore column once the memory is attached.
+    Detached memories (e.g. queries) keep the value on the instance instead.
+    """
+    def __init__(self, cast: type = int):
+        self.cast = cast
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.local = "_" + name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if obj._store is None:
+            return getattr(obj, self.local)
+        return self.cast(getattr(obj._store, self.name)[obj._idx])
+
+    def __set__(self, obj, value):
+        if obj._store is None:
+            setattr(obj, self.local, value)
+        else:
+            getattr(obj._store, self.name)[obj._idx] = value
+            obj._store.changed(self.name, obj._idx)
+
+class Ranking:
+    """
+    Rows in descending order of a value, kept up to date as values change. key(rows) gives the values of the rows.
+    Changed rows are queued and merged in when the order is read;
+    the whole order is only sorted again once the queue grows past a quarter of the rows.
+    """
+    def __init__(self, key: Callable[[slice | np.ndarray], np.ndarray], n: int):
+        self.key = key
+        self._sort(n)
+
+    def _sort(self, n: int) -> None:
+        # cleared first, so a value changed while sorting (say, by the importance scorer) stays queued
+        self.queued = {}
+        values = self.key(slice(0, n))
+        self.order = np.argsort(-values, kind="stable")
+        self.values = values[self.order]
+
+    def update(self, row: int) -> None:
+        self.queued[row] = None
+
+    def __call__(self, n: int) -> tuple[np.ndarray, np.ndarray]:
+        """(rows, values) for the first n rows, highest value first"""
+        if len(self.queued) > len(self.order) // 4 + 64:
+            self._sort(n)
+        queued = np.fromiter(list(self.queued), dtype=np.int64) # a copy, since other threads may queue more rows
+        queued = queued[queued < n]
+        skip = np.zeros(max(n, len(self.order)), dtype=bool)
+        skip[queued] = True
+        keep = (self.order < n) & ~skip[self.order]
+        rows, values = self.order[keep], self.values[keep]
+        if len(queued) == 0:
+            return rows, values
+
+        current = self.key(queued)
+        at = np.searchsorted(-values, -current, side="left")
+        return np.insert(rows, at, queued), np.insert(values, at, current)
+
+def select(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, in ascending order of score. Only the k winners get sorted."""
+    top = np.argpartition(scores, -k)[-k:] if k < len(scores) else np.arange(len(scores))
+    return top[np.argsort(scores[top], kind="stable")]
+
+def fused(scores: np.ndarray, tops: list[np.ndarray], k: int, method: str) -> np.ndarray:
+    """
+    Indices of the k best columns of a (queries, rows) score matrix under one ranking for every query,
+    in ascending order: the sum or max of the queries' scores,
+    or reciprocal rank fusion - the sum of 1 / (RRF_K + rank) over the queries' own top rows (tops, as from select).
+    """
+    if method == "sum":
+        combined = scores.sum(axis=0)
+    elif method == "max":
+        combined = scores.max(axis=0)
+    elif method == "rrf":
+        combined = np.zeros(scores.shape[1])
+        for top in tops:
+            # tops are in ascending order of score, so the best row is last
+            combined[top] += 1 / (RRF_K + np.arange(len(top), 0, -1))
+    else:
+        raise ValueError(f"unknown fusion {method}, expected one of {FUSIONS}")
+    return select(combined, min(k, len(combined)))
+
+def dot(emb: np.ndarray, query: np.ndarray, tile: int = 256) -> np.ndarray:
+    """
+    emb @ query for one query, or (emb @ queries.T).T for a (queries, dim) array of them.
+    Several queries are multiplied a tile of rows at a time: BLAS does a tall, skinny product
+    several times slower than it needs to, while tiles stay in cache and come close to the cost of one query.
+    """
+    if query.ndim == 1:
+        return emb @ query
+    out = np.empty((len(emb), len(query)), dtype=np.float32)
+    for start in range(0, len(emb), tile):
+        np.matmul(emb[start:start + tile], query.T, out=out[start:start + tile])
+    return out.T
+
+def truncated(emb: np.ndarray, dim: int | None) -> np.ndarray:
+    """
+    Matryoshka-style truncation of (rows of) embeddings to their first dim entries,
+    rescaled to keep their original length.
+    """
+    if dim is None or dim >= emb.shape[-1]:
+        return emb
+    short = emb[..., :dim]
+    scale = np.linalg.norm(emb, axis=-1, keepdims=True) / np.maximum(np.linalg.norm(short, axis=-1, keepdims=True), 1e-12)
+    return (short * scale).astype(np.float32)
+
+def precision_overlap(store: "MemoryStore", queries: np.ndarray, time: int, k: int, dtype: str, dim: int | None = None) -> float:
+    """
+    Mean fraction of the top k memories that recall still finds
+    with embeddings stored as dtype and truncated to dim, over the given query embeddings.
+    For choosing the embedding precision to use.
+    """
+    compact = store.compact(dtype, dim)
+    return float(np.mean([
+        len(set(store.top_rows(q, time, k)) & set(compact.top_rows(q, time, k))) / min(k, store.n)
+        for q in queries
+    ]))
+
+class MemoryStore:
+    """
+    A memory stream stored column-wise:
+    one contiguous embedding matrix, plus parallel crt / acc / imp / type arrays.
+    Memory objects appended to the store become views onto a row of it,
+    so recall can score the whole stream in a single NumPy pass,
+    or only the candidates pulled from an optional ANN index (see ann.IVFIndex).
+    A NaN importance means the importance is still pending;
+    resolve_imp is called with the memories whose pending importance could change a recall result,
+    and must block until their importance has been written.
+
+    To save memory, embeddings can be truncated to their first dim entries (see truncated),
+    and stored as float16, or as int8 with a float32 scale per row.
+    Recall scores directly against the compact form.
+
+    Rows loaded from a snapshot (see snapshot.py) only get a Memory object when first accessed,
+    built by factory(store, idx). Until then their text and references come from the snapshot.
+
+    A store made by fork shares its first rows' embeddings, texts and references read-only with the store it came from,
+    so many conversations can each have their own copy of a persona's memories for little more than the new ones.
+    """
+    COLUMNS = {"crt": np.int64, "acc": np.int64, "imp": np.float32, "type": np.int8}
+    DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+    BLOCK = 16384 # rows decoded at a time when scoring compact embeddings
+
+    def __init__(
+            self,
+            capacity: int = 64,
+            resolve_imp: Callable[[list], None] | None = None,
+            index: ann.IVFIndex | None = None,
+            dtype: str = "float32",
+            dim: int | None = None,
+        ):
+        if dtype not in self.DTYPES:
+            raise ValueError(f"unsupported embedding type {dtype}")
+        self.resolve_imp = resolve_imp
+        self.index = index
+        self.dtype = dtype
+        self.n = 0
+        self.dim = dim
+        self.emb = None # allocated once the first embedding arrives
+        self.scale = None # int8 only
+        # the first n_shared rows' embeddings are in shared_emb and shared_scale, read-only - see fork.
+        # emb and scale only hold the rows after them, so row i is at emb[i - n_shared]
+        self.n_shared = 0
+        self.shared_emb = None
+        self.shared_scale = None
+        self.has_emb = np.zeros(capacity, dtype=bool)
+        for name, dtype in self.COLUMNS.items():
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self.mems = [] # Memory views, None until materialized
+        self.factory = None
+        self.lazy = None # (text, text offsets, ref offsets, refs) of rows loaded from a snapshot
+        self.dirty = set() # rows changed since the last snapshot
+        self.pending = {} # row -> future of its embedding, see prefetch_emb
+        self.archive = None # store of memories moved out by remove, which refs can still point into
+        # recency of row i at time t is DECAY ** (t - rec_time) * rec[i], so advancing time costs nothing
+        self.rec = np.zeros(capacity, dtype=np.float64)
+        self.rec_time = 0
+        self._rankings = None # (by access time, by importance), built on first use - see top_nonrel
+        self.snapshot = None # (path, rows) of the last snapshot saved or loaded
+
+    @property
+    def capacity(self) -> int:
+        return len(self.has_emb)
+
+    def _grow(self, capacity: int) -> None:
+        def grown(arr, shift=0):
+            out = np.zeros((capacity - shift,) + arr.shape[1:], dtype=arr.dtype)
+            out[:self.n - shift] = arr[:self.n - shift]
+            return out
+
+        self.has_emb = grown(self.has_emb)
+        self.rec = grown(self.rec)
+        for name in self.COLUMNS:
+            setattr(self, name, grown(getattr(self, name)))
+        if self.emb is not None:
+            self.emb = grown(self.emb, self.n_shared)
+        if self.scale is not None:
+            self.scale = grown(self.scale, self.n_shared)
+
+    def append(self, mem) -> int:
+        """Append a memory to the store, turning it into a view onto the new row."""
+        if self.n == self.capacity:
+            self._grow(2 * self.capacity)
+
+        idx = self.n
+        self.n += 1
+        for name in self.COLUMNS:
+            getattr(self, name)[idx] = getattr(mem, "_" + name)
+        self.has_emb[idx] = False
+        self.changed("acc", idx)
+        self.changed("imp", idx)
+
+        emb = mem._emb if mem._has_emb else None
+        mem._store, mem._idx = self, idx
+        self.mems.append(mem)
+        if emb is not None:
+            self.set_emb(idx, emb)
+        return idx
+
+    def truncate(self, n: int) -> None:
+        """Drop every memory after the first n. Dropped memories are detached and keep their values."""
+        for mem in self.mems[n:]:
+            if mem is not None:
+                mem._detach()
+        del self.mems[n:]
+        self.n = min(self.n, n)
+        self.pending = {i: f for i, f in self.pending.items() if i < n}
+        if self.index is not None:
+            self.index.truncate(n)
+        # rows from n on get reused, so neither the snapshot nor lazy can speak for them any more
+        self.snapshot = None
+        if self.lazy is not None and len(self.lazy[1]) > n + 1:
+            text, text_offsets, ref_offsets, refs = self.lazy
+            self.lazy = (text[:text_offsets[n]], text_offsets[:n + 1], ref_offsets[:n + 1], refs[:ref_offsets[n]])
+
+    def remove(self, rows: list[int]) -> list:
+        """
+        Take the given rows out of the store, returning their memories, detached.
+        The rows after them move up. Embeddings still being computed are waited on first.
+        """
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if len(rows) == 0:
+            return []
+        self.fill_emb(rows.tolist())
+        self.unshare()
+        # rows are about to move, so every memory needs its text and refs as objects
+        mems = [self[i] for i in range(self.n)]
+        self.lazy = None
+
+        keep = np.setdiff1d(np.arange(self.n), rows)
+        removed = [mems[i] for i in rows]
+        for mem in removed:
+            mem._detach()
+
+        arrays = ["has_emb", "rec", *self.COLUMNS] + [name for name in ("emb", "scale") if getattr(self, name) is not None]
+        for name in arrays:
+            arr = getattr(self, name)
+            arr[:len(keep)] = arr[keep]
+        self.mems = [mems[i] for i in keep]
+        for new, mem in enumerate(self.mems):
+            mem._idx = new
+        moved = dict(zip(keep.tolist(), range(len(keep))))
+        self.pending = {moved[i]: f for i, f in self.pending.items() if i in moved}
+        self.n = len(keep)
+        if self.index is not None:
+            self.index.remap(keep)
+        self._rankings = None
+
+        # every row may have moved, so the next snapshot is written from scratch
+        self.dirty.clear()
+        self.snapshot = None
+        return removed
+
+    def changed(self, name: str, idx: int) -> None:
+        """Keeps track of a column value written for one row."""
+        self.dirty.add(idx)
+        if name == "acc":
+            self.rec[idx] = DECAY ** float(self.rec_time - self.acc[idx])
+        if name in ("acc", "imp") and self._rankings is not None:
+            self._rankings[name == "imp"].update(idx)
+
+    def reset_recency(self) -> None:
+        """Recomputes recency from the acc column, after it was written to directly."""
+        self.rec[:self.n] = DECAY ** (self.rec_time - self.acc[:self.n]).astype(np.float64)
+        self._rankings = None
+
+    def _factor(self, time: int) -> float:
+        """DECAY ** (time - rec_time), moving rec_time to time first if that's out of range"""
+        if abs((time - self.rec_time) * np.log(DECAY)) > 300:
+            self.rec_time = time
+            self.reset_recency()
+        return DECAY ** float(time - self.rec_time)
+
+    def recency(self, time: int, rows: slice | np.ndarray) -> np.ndarray:
+        """DECAY ** (time - acc) of the given rows"""
+        return self._factor(time) * self.rec[rows]
+
+    def top_nonrel(self, time: int, k: int, exclude: list[int] = ()) -> np.ndarray:
+        """
+        Rows of the k memories with the highest recency and importance part of the recall score,
+        using the threshold algorithm over the rows ranked by access time and by importance:
+        rows are read from the top of both rankings, going twice as deep each round,
+        until the k-th best score seen beats the best score an unseen row could have.
+        Pending importances count as 1.
+        """
+        if self._rankings is None:
+            self._rankings = (
+                Ranking(lambda rows: self.acc[rows].astype(np.float64), self.n),
+                Ranking(lambda rows: np.nan_to_num(self.imp[rows], nan=1.0).astype(np.float64), self.n),
+            )
+        (acc_rows, acc), (imp_rows, imp) = (ranking(self.n) for ranking in self._rankings)
+        exclude = np.asarray(list(exclude), dtype=np.int64)
+        factor = self._factor(time)
+
+        depth = 2 * k
+        while True:
+            rows = np.union1d(acc_rows[:depth], imp_rows[:depth])
+            rows = rows[~np.isin(rows, exclude)]
+            scores = RECENCY_W * factor * self.rec[rows] + IMPORTANCE_W * np.nan_to_num(self.imp[rows], nan=1.0)
+            if depth >= self.n:
+                break
+            bound = RECENCY_W * DECAY ** float(time - acc[depth - 1]) + IMPORTANCE_W * imp[depth - 1]
+            if len(rows) >= k and np.partition(scores, -k)[-k] >= bound:
+                break
+            depth *= 2
+        return np.sort(rows[select(scores, min(k, len(rows)))])
+
+    def set_emb(self, idx: int | np.ndarray, emb: list[float] | np.ndarray) -> None:
+        """Set the embedding of one row, or of an array of rows."""
+        emb = np.asarray(emb, dtype=np.float32)
+        if self.n_shared and (np.atleast_1d(idx) < self.n_shared).any():
+            self.unshare()
+        if self.emb is None:
+            self.dim = min(self.dim or emb.shape[-1], emb.shape[-1])
+            self.emb = np.zeros((self.capacity - self.n_shared, self.dim), dtype=self.DTYPES[self.dtype])
+            if self.dtype == "int8":
+                self.scale = np.zeros(self.capacity - self.n_shared, dtype=np.float32)
+
+        emb = truncated(emb, self.dim)
+        own = np.asarray(idx) - self.n_shared
+        if self.dtype == "int8":
+            scale = np.maximum(np.abs(emb).max(axis=-1), 1e-12) / 127
+            self.emb[own] = np.rint(emb / np.expand_dims(scale, -1))
+            self.scale[own] = scale
+        else:
+            self.emb[own] = emb
+        self.has_emb[idx] = True
+        self.dirty.update(np.atleast_1d(idx).tolist())
+
+        if self.index is not None:
+            for i, e in zip(np.atleast_1d(idx), np.atleast_2d(self.decode(idx))):
+                self.index.add(i, e)
+
+    def stored_emb(self, rows: int | slice | np.ndarray) -> tuple[np.ndarray, np.ndarray | None]:
+        """(embeddings, int8 scales or None) of the given rows as stored, wherever they're stored - see fork"""
+        if not self.n_shared:
+            return self.emb[rows], None if self.scale is None else self.scale[rows]
+        ids = np.arange(self.capacity)[rows]
+        if np.ndim(ids) == 0:
+            emb, scale, i = (self.shared_emb, self.shared_scale, ids) if ids < self.n_shared else (self.emb, self.scale, ids - self.n_shared)
+            return emb[i], None if scale is None else scale[i]
+
+        shared = ids < self.n_shared
+        emb = np.empty((len(ids), self.dim), dtype=self.DTYPES[self.dtype])
+        emb[shared] = self.shared_emb[ids[shared]]
+        if not shared.all():
+            emb[~shared] = self.emb[ids[~shared] - self.n_shared]
+        if self.dtype != "int8":
+            return emb, None
+        scale = np.empty(len(ids), dtype=np.float32)
+        scale[shared] = self.shared_scale[ids[shared]]
+        if not shared.all():
+            scale[~shared] = self.scale[ids[~shared] - self.n_shared]
+        return emb, scale
+
+    def decode(self, rows: int | slice | np.ndarray) -> np.ndarray:
+        """float32 embeddings of the given rows"""
+        emb, scale = self.stored_emb(rows)
+        emb = emb.astype(np.float32)
+        if self.dtype == "int8":
+            emb *= np.expand_dims(scale, -1)
+        return emb
+
+    def get_emb(self, idx: int) -> np.ndarray | None:
+        return self.decode(idx) if self.has_emb[idx] else None
+
+    def prepare_query(self, query: np.ndarray) -> np.ndarray:
+        """A query embedding, truncated to match the stored embeddings."""
+        return truncated(np.asarray(query, dtype=np.float32), self.dim)
+
+    def relevance(self, query: np.ndarray, rows: slice | np.ndarray | None = None) -> np.ndarray:
+        """
+        Dot product of the query with the embeddings of every memory, or only the given rows.
+        A (queries, dim) array of queries gives a (queries, rows) array, from one matrix product.
+        """
+        rows = slice(0, self.n) if rows is None else rows
+        query = self.prepare_query(query)
+        if not self.n_shared:
+            return self._relevance(self.emb, self.scale, query, rows)
+        if not isinstance(rows, slice):
+            emb, scale = self.stored_emb(rows)
+            return self._relevance(emb, scale, query, slice(0, len(emb)))
+
+        # the shared rows and this store's own are scored separately, rather than copied into one matrix
+        shared = min(self.n_shared, self.n)
+        parts = [self._relevance(self.shared_emb, self.shared_scale, query, slice(0, shared))]
+        if self.n > shared:
+            parts.append(self._relevance(self.emb, self.scale, query, slice(0, self.n - shared)))
+        return np.concatenate(parts, axis=-1)
+
+    def _relevance(self, emb: np.ndarray, scale: np.ndarray | None, query: np.ndarray, rows: slice | np.ndarray) -> np.ndarray:
+        """relevance against rows of an embedding matrix as stored"""
+        if self.dtype == "float32":
+            return dot(emb[rows], query)
+
+        # decode compact embeddings a block at a time, so there's never a full float32 copy
+        ids = np.arange(len(emb))[rows]
+        result = np.empty(query.shape[:-1] + (len(ids),), dtype=np.float32)
+        for start in range(0, len(ids), self.BLOCK):
+            block = ids[start:start + self.BLOCK]
+            # contiguous rows can be sliced rather than gathered
+            part = emb[block[0]:block[-1] + 1] if isinstance(rows, slice) else emb[block]
+            result[..., start:start + len(block)] = dot(part.astype(np.float32), query)
+        if self.dtype == "int8":
+            result *= scale[ids]
+        return result
+
+    @property
+    def nbytes(self) -> int:
+        """bytes used by the stored embeddings, not counting any shared with other stores"""
+        if self.emb is None:
+            return 0
+        return self.emb.nbytes + (0 if self.scale is None else self.scale.nbytes)
+
+    def prefetch_emb(self, rows: list[int]) -> None:
+        """Start embedding the given rows in the background, so they're ready by the time they're recalled."""
+        rows = [i for i in rows if not self.has_emb[i] and i not in self.pending]
+        if rows:
+            futures = util.embed_async([self.desc(i) for i in rows], priority=scheduler.BACKGROUND)
+            self.pending.update(zip(rows, futures))
+
+    def fill_emb(self, rows: list[int] | None = None) -> None:
+        """
+        Embed every memory (or only the given rows) that doesn't have an embedding yet,
+        waiting on those already being embedded and batching the rest.
+        """
+        missing = np.flatnonzero(~self.has_emb[:self.n]) if rows is None else [i for i in rows if not self.has_emb[i]]
+        if len(missing) == 0:
+            return
+        todo = [i for i in missing if i not in self.pending]
+        if todo:
+            self.pending.update(zip(todo, util.embed_async([self.desc(i) for i in todo])))
+
+        emb = np.stack([self.pending.pop(i).result() for i in missing]).astype(np.float32)
+        self.set_emb(np.asarray(missing), emb / np.linalg.norm(emb, axis=1)[:, None])
+
+    def indices(self, mems) -> list[int]:
+        """Indices of the given memories that belong to this store."""
+        return [m._idx for m in mems if m._store is self]
+
+    def base_scores(self, query: np.ndarray, time: int, exclude: list[int] = (), rows: np.ndarray | None = None) -> np.ndarray:
+        """
+        The relevance and recency part of the recall score against the query embedding,
+        for every memory, or only the given rows. One row of scores per query, for a (queries, dim) array of them.
+        """
+        self.fill_emb()
+        rows = slice(0, self.n) if rows is None else rows
+        relevance = self.relevance(query, rows)
+        recency = self.recency(time, rows)
+        result = RELEVANCE_W * relevance + RECENCY_W * recency
+        if isinstance(rows, slice):
+            result[..., list(exclude)] = -np.inf
+        else:
+            result[..., np.isin(rows, list(exclude))] = -np.inf
+        return result
+
+    def scores(self, query: np.ndarray, time: int, exclude: list[int] = ()) -> np.ndarray:
+        """Recall score of every memory in the store against the query embedding. NaN where importance is pending."""
+        return self.base_scores(query, time, exclude) + IMPORTANCE_W * self.imp[:self.n]
+
+    def _settle(self, base: np.ndarray, k: int, rows: np.ndarray | None = None) -> np.ndarray:
+        """
+        Adds the importance term to base scores (of every memory, or the given rows),
+        resolving pending importances, but only for the memories that could make the top k:
+        a pending memory whose score with importance 1 can't beat the k-th best score
+        with pending importances at 0 is left pending, and scored with importance 0.
+        With one row of base scores per query, that goes for the top k of any of them.
+        """
+        rows = slice(0, self.n) if rows is None else rows
+        imp = self.imp[rows]
+        pending = np.isnan(imp)
+        if pending.any() and self.resolve_imp is not None:
+            low = np.atleast_2d(base) + IMPORTANCE_W * np.where(pending, 0.0, imp)
+            threshold = np.partition(low, -k, axis=1)[:, [-k]] if k < low.shape[1] else -np.inf
+            needed = np.flatnonzero(pending & (low + IMPORTANCE_W >= threshold).any(axis=0))
+            ids = np.arange(self.n)[rows]
+            self.resolve_imp([self[ids[i]] for i in needed])
+            imp = self.imp[rows]
+        return base + IMPORTANCE_W * np.nan_to_num(imp)
+
+    def candidates(self, query: np.ndarray, time: int, k: int, exclude: list[int] = ()) -> np.ndarray | None:
+        """
+        Rows worth scoring exactly for the top k: the most relevant ones from the ANN index
+        (for each query, given a (queries, dim) array of them),
+        plus the top k by recency and importance alone, which relevance-only search would miss.
+        None if there's no index, or the stream is too small for it - then every row gets scored.
+        """
+        if self.index is None or not self.index.maybe_train(self):
+            return None
+        rows = np.unique(np.concatenate([self.index.search(q, self) for q in np.atleast_2d(self.prepare_query(query))]))
+        rows = np.union1d(rows[~np.isin(rows, list(exclude))], self.top_nonrel(time, k, exclude))
+        return rows if len(rows) >= k else None
+
+    def top_rows(self, query: np.ndarray, time: int, k: int, exclude: list[int] = ()) -> np.ndarray:
+        """
+        Rows of the k memories with the highest recall score, in ascending order of score.
+        With an ANN index, only its candidates get scored.
+        """
+        return self.top_rows_many(np.atleast_2d(query), time, k, exclude)[0][0]
+
+    def top_rows_many(
+            self,
+            queries: np.ndarray,
+            time: int,
+            k: int,
+            exclude: list[int] = (),
+            fuse: str | None = None,
+        ) -> tuple[list[np.ndarray], np.ndarray | None]:
+        """
+        top_rows for each of a (queries, dim) array of query embeddings,
+        scoring every query in one pass over the stream rather than one pass each.
+        With fuse ("sum", "max" or "rrf", see fused), also the rows of the top k under one ranking
+        combining the queries' scores; otherwise None.
+        """
+        if fuse is not None and fuse not in FUSIONS:
+            raise ValueError(f"unknown fusion {fuse}, expected one of {FUSIONS}")
+        n = self.n - len(set(exclude))
+        if n <= 0 or k <= 0 or len(queries) == 0:
+            empty = np.zeros(0, dtype=int)
+            return [empty] * len(queries), None if fuse is None else empty
+        k = min(k, n)
+        self.fill_emb()
+        rows = self.candidates(queries, time, k, exclude)
+        base = self.base_scores(queries, time, exclude, rows)
+        if fuse == "sum":
+            # the fused top k can hold rows in no query's top k, so the mean score gets its pending importances settled too
+            scores = self._settle(np.vstack([base, base.mean(axis=0)]), k, rows)[:len(queries)]
+        else:
+            scores = self._settle(base, k, rows)
+        ids = np.arange(self.n) if rows is None else rows
+        tops = [select(s, k) for s in scores]
+        return [ids[top] for top in tops], None if fuse is None else ids[fused(scores, tops, k, fuse)]
+
+    def top_k(self, query: np.ndarray, time: int, k: int, exclude: list[int] = ()) -> list:
+        """The k memories with the highest recall score, in ascending order of score."""
+        return [self[i] for i in self.top_rows(query, time, k, exclude)]
+
+    def compact(self, dtype: str = "float32", dim: int | None = None) -> "MemoryStore":
+        """
+        A copy of this store's columns with embeddings stored as dtype and truncated to dim.
+        The copy has no Memory views, and doesn't resolve pending importances.
+        """
+        self.fill_emb()
+        copy = MemoryStore(max(self.n, 1), dtype=dtype, dim=dim)
+        copy.n = self.n
+        for name in self.COLUMNS:
+            getattr(copy, name)[:self.n] = getattr(self, name)[:self.n]
+        copy.reset_recency()
+        for start in range(0, self.n, self.BLOCK):
+            rows = np.arange(start, min(start + self.BLOCK, self.n))
+            copy.set_emb(rows, self.decode(rows))
+        return copy
+
+    def fork(self) -> "MemoryStore":
+        """
+        A store with the same memories, which can then change without changing this one or the other way round.
+        The embeddings, texts and references of the memories so far are shared read-only rather than copied,
+        and only the small per-row columns are, so this store mustn't change those rows' embeddings while the fork is in use.
+        The fork builds its own Memory objects with factory, and has no ANN index.
+        """
+        if self.resolve_imp is not None:
+            pending = np.flatnonzero(np.isnan(self.imp[:self.n]))
+            if len(pending):
+                self.resolve_imp([self[i] for i in pending])
+        self.fill_emb()
+
+        emb, scale = self.stored_emb(slice(0, self.n)) if self.n else (None, None)
+        columns = {name: getattr(self, name)[:self.n] for name in self.COLUMNS}
+        fork = MemoryStore.sharing(columns, emb, scale, self._lazy_rows(), self.dtype, self.dim, self.resolve_imp, self.rec_time)
+        fork.factory = self.factory
+        if self.archive is not None:
+            fork.archive = self.archive.fork()
+        return fork
+
+    @classmethod
+    def sharing(
+            cls,
+            columns: dict[str, np.ndarray],
+            emb: np.ndarray | None,
+            scale: np.ndarray | None,
+            lazy: tuple,
+            dtype: str = "float32",
+            dim: int | None = None,
+            resolve_imp: Callable[[list], None] | None = None,
+            rec_time: int = 0,
+        ) -> "MemoryStore":
+        """
+        A store of rows with the given columns (see COLUMNS), texts and references (see lazy) and stored embeddings,
+        which it uses where they are, read-only, rather than copying them - say, another store's, or ones in shared memory.
+        Rows added after them get their embeddings in the store's own matrix.
+        """
+        n = len(columns["crt"])
+        store = cls(n + 64, resolve_imp, None, dtype, dim if dim is not None or emb is None else emb.shape[-1])
+        store.n = n
+        store.has_emb[:n] = True
+        for name in cls.COLUMNS:
+            getattr(store, name)[:n] = columns[name]
+        store.rec_time = rec_time
+        store.reset_recency()
+        if n:
+            emb.flags.writeable = False
+            if scale is not None:
+                scale.flags.writeable = False
+            store.n_shared, store.shared_emb, store.shared_scale = n, emb, scale
+        store.lazy = lazy
+        store.mems = [None] * n
+        return store
+
+    def _lazy_rows(self) -> tuple:
+        """lazy, covering every row so far - built from the memories if it doesn't already, e.g. for a store not loaded from a snapshot"""
+        if self.lazy is not None and len(self.lazy[1]) > self.n:
+            return self.lazy
+        texts = [self.desc(i).encode("utf-8") for i in range(self.n)]
+        refs = [self.refs(i) for i in range(self.n)]
+        # text and refs of a row don't change, so it's kept for the next fork
+        self.lazy = (
+            np.frombuffer(b"".join(texts), dtype=np.uint8),
+            np.concatenate(([0], np.cumsum([len(t) for t in texts], dtype=np.int64))),
+            np.concatenate(([0], np.cumsum([len(r) for r in refs], dtype=np.int64))),
+            np.array([r for row in refs for r in row], dtype=np.int64),
+        )
+        return self.lazy
+
+    def unshare(self) -> None:
+        """Copies any embeddings shared with another store (see fork) into this one's own, so they can be changed."""
+        if not self.n_shared:
+            return
+        emb = np.zeros((self.capacity, self.dim), dtype=self.DTYPES[self.dtype])
+        emb[:self.n_shared] = self.shared_emb
+        if self.emb is not None:
+            emb[self.n_shared:] = self.emb
+        if self.dtype == "int8":
+            scale = np.zeros(self.capacity, dtype=np.float32)
+            scale[:self.n_shared] = self.shared_scale
+            if self.scale is not None:
+                scale[self.n_shared:] = self.scale
+            self.scale = scale
+        self.emb = emb
+        self.n_shared, self.shared_emb, self.shared_scale = 0, None, None
+
+    def recent(self, n: int, skip_type: int | tuple[int, ...] | None = None) -> list:
+        """The last n memories added, optionally skipping some memory types."""
+        if skip_type is None:
+            idx = np.arange(max(self.n - n, 0), self.n)
+        else:
+            idx = np.flatnonzero(~np.isin(self.type[:self.n], skip_type))[-n:] if n > 0 else []
+        return [self[i] for i in idx]
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __iter__(self):
+        return (self[i] for i in range(self.n))
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self.n))]
+        mem = self.mems[idx]
+        if mem is None:
+            mem = self.mems[idx] = self.factory(self, idx % self.n)
+        return mem
+
+    def desc(self, idx: int) -> str:
+        """text of a memory, without materializing it"""
+        if self.mems[idx] is not None:
+            return self.mems[idx].desc
+        text, offsets = self.lazy[0], self.lazy[1]
+        return bytes(text[offsets[idx]:offsets[idx + 1]]).decode("utf-8")
+
+    def refs(self, idx: int) -> list[int]:
+        """
+        rows referenced by a memory, without materializing it.
+        Rows of the archive are encoded as -1 - row, see ref_mem.
+        """
+        if self.mems[idx] is not None:
+            return [
+                m._idx if m._store is self else -1 - m._idx
+                for m in self.mems[idx].ref
+                if m._store is self or (m._store is not None and m._store is self.archive)
+            ]
+        offsets, refs = self.lazy[2], self.lazy[3]
+        return refs[offsets[idx]:offsets[idx + 1]].tolist()
+
+    def ref_mem(self, ref: int):
+        """the memory a ref from refs points to"""
+        return self[ref] if ref >= 0 else self.archive[-1 - ref]
@@ -0,0 +1,204 @@
+"""
+Timed spans around the parts of a conversation turn - LLM calls, embedding, recall,
+importance scoring, reads and writes - to see where a turn's time and tokens go.
+
+    with tracing.span("recall", memories=len(mem)) as span:
+        result = ...
+        if span:
+            span.set(found=len(result))
+
+Spans nest by context, so a span started on a scheduler worker or in an asyncio task
+has the span that started the work as its parent.
+Every finished span goes into an in-process latency histogram for its name, with its numeric attributes
+summed (see stats), and to the exporter if there is one (see export).
+
+Tracing is off by default. While it's off, span returns a shared span that does nothing and is falsy,
+so instrumented code only pays for a function call - anything costly to compute for a span goes under `if span:`.
+Turn it on with enable(), or with the TRACE environment variable: TRACE=1, or TRACE=<path> to also export there.
+"""
+from dataclasses import dataclass, field
+import atexit
+import contextvars
+import itertools
+import json
+import math
+import os
+import threading
+import time
+
+ENABLED = False
+
+_current = contextvars.ContextVar("span", default=None)
+_ids = itertools.count(1)
+_lock = threading.Lock()
+_exporter = None
+
+@dataclass
+class Histogram:
+    """Span latencies in log-spaced buckets, 8 to each doubling from a microsecond, so percentiles are within 9%."""
+    PER_DOUBLING = 8
+
+    buckets: dict[int, int] = field(default_factory=dict)
+    count: int = 0 # spans and events
+    timed: int = 0 # just the spans
+    total: float = 0.0
+    max: float = 0.0
+    sums: dict[str, float] = field(default_factory=dict) # numeric attributes, summed
+
+    def add(self, seconds: float | None, attrs: dict) -> None:
+        self.count += 1
+        for key, value in attrs.items():
+            if isinstance(value, (int, float)):
+                self.sums[key] = self.sums.get(key, 0) + value
+        if seconds is None:
+            return
+        bucket = max(0, int(math.log2(max(seconds * 1e6, 1.0)) * self.PER_DOUBLING))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.timed += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        """in seconds"""
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= q * self.timed:
+                return min(2 ** ((bucket + 0.5) / self.PER_DOUBLING) / 1e6, self.max)
+        return 0.0
+
+    def summary(self) -> dict:
+        timed = max(self.timed, 1)
+        return {
+            "count": self.count,
+            "mean_ms": self.total / timed * 1000,
+            "p50_ms": self.percentile(0.5) * 1000,
+            "p95_ms": self.percentile(0.95) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+            "max_ms": self.max * 1000,
+            **self.sums,
+        }
+
+HISTOGRAMS: dict[str, Histogram] = {}
+
+class Span:
+    __slots__ = ("name", "attrs", "id", "parent", "trace", "start", "_token")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> "Span":
+        parent = _current.get()
+        self.id = next(_ids)
+        self.parent = None if parent is None else parent.id
+        self.trace = self.id if parent is None else parent.trace
+        self._token = _current.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        seconds = time.perf_counter() - self.start
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        _finish(self.name, seconds, self.attrs, self.id, self.parent, self.trace)
+        return False
+
+class _NoSpan:
+    """what span gives while tracing is off"""
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+    def __bool__(self) -> bool:
+        return False
+
+    def set(self, **attrs) -> None:
+        pass
+
+NO_SPAN = _NoSpan()
+
+def span(name: str, **attrs) -> Span | _NoSpan:
+    """A span to time a block with, under the current span."""
+    return Span(name, attrs) if ENABLED else NO_SPAN
+
+def record(name: str, seconds: float | None = None, **attrs) -> None:
+    """
+    A span that was timed some other way, under the current span.
+    With seconds None, it's only counted, and its attributes summed - e.g. for cache hits.
+    """
+    if ENABLED:
+        parent = _current.get()
+        span_id = next(_ids)
+        _finish(name, seconds, attrs, span_id, None if parent is None else parent.id, span_id if parent is None else parent.trace)
+
+def _finish(name: str, seconds: float | None, attrs: dict, span_id: int, parent: int | None, trace: int) -> None:
+    with _lock:
+        hist = HISTOGRAMS.get(name)
+        if hist is None:
+            hist = HISTOGRAMS[name] = Histogram()
+        hist.add(seconds, attrs)
+    exporter = _exporter
+    if exporter is not None:
+        exporter.write({
+            "name": name,
+            "trace": trace,
+            "span": span_id,
+            "parent": parent,
+            "thread": threading.get_ident(),
+            "end": time.time(),
+            "ms": None if seconds is None else seconds * 1000,
+            **attrs,
+        })
+
+class JSONLExporter:
+    """Appends each finished span to a file, as a line of JSON."""
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def write(self, span: dict) -> None:
+        line = json.dumps(span, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+def enable(on: bool = True) -> None:
+    global ENABLED
+    ENABLED = on
+
+def export(path: str | None) -> None:
+    """Turns tracing on and writes every span to path from now on, or stops exporting with None."""
+    global _exporter
+    old, _exporter = _exporter, None if path is None else JSONLExporter(path)
+    if old is not None:
+        old.close()
+    if path is not None:
+        enable()
+
+def stats() -> dict[str, dict]:
+    """latency percentiles, counts and summed attributes of the spans so far, by name"""
+    with _lock:
+        return {name: hist.summary() for name, hist in sorted(HISTOGRAMS.items())}
+
+def reset() -> None:
+    with _lock:
+        HISTOGRAMS.clear()
+
+atexit.register(lambda: export(None))
+
+if os.environ.get("TRACE"):
+    if os.environ["TRACE"] == "1":
+        enable()
+    else:
+        export(os.environ["TRACE"])
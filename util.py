@@ -1,13 +1,18 @@
+import asyncio
+import os
 import random
-from typing import Callable
-
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import re
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Iterable
 
 import numpy as np
 
-import dotenv
-
-from openai import OpenAI
+import backend
+import scheduler
+import tracing
+from cache import EmbeddingCache, ResponseCache
 
 GPT3 = "gpt-3.5-turbo"
 GPT4 = "gpt-4-0125-preview"
@@ -16,33 +21,216 @@ USER = 0
 AI = 1
 SYSTEM = 2
 
-dotenv.load_dotenv()
+EMBED_MODEL = "text-embedding-3-large"
+# EMBED_MODEL = "text-embedding-3-small"
+
+# chosen with set_backend, or the LLM_BACKEND environment variable ("openai" or "local")
+BACKEND = None
+
+# shared by everything that embeds text - set to None to disable
+EMBED_CACHE = EmbeddingCache(os.environ.get("EMBED_CACHE_DIR", ".cache/embeddings"))
 
-BACKEND = OpenAI()
+# replies to deterministic calls - LLM_CACHE_MODE=record / replay reruns a whole pipeline from disk. None disables it
+RESPONSE_CACHE = ResponseCache(
+    os.environ.get("LLM_CACHE_DIR", ".cache/responses"),
+    mode=os.environ.get("LLM_CACHE_MODE", "deterministic"),
+)
 
-def call_LLM(query: str | list[tuple[int, str]] | list[str] | list[list[tuple[int, str]]], model: str = GPT4, temp: float = 0.0, single: bool = True) -> str | list[str]:
+def get_backend() -> backend.Backend:
+    """the backend all LLM and embedding calls go to - created on first use"""
+    global BACKEND
+    if BACKEND is None:
+        # .env can pick the backend too
+        backend.load_env()
+        BACKEND = backend.from_name(os.environ.get("LLM_BACKEND", "openai"))
+    return BACKEND
+
+def set_backend(new: backend.Backend | str, **kwargs) -> backend.Backend:
+    """swap out the backend at runtime, either for a Backend object or by name"""
+    global BACKEND
+    BACKEND = backend.from_name(new, **kwargs) if isinstance(new, str) else new
+    return BACKEND
+
+def call_LLM(query: str | list[tuple[int, str]] | list[str] | list[list[tuple[int, str]]], model: str = GPT4, temp: float = 0.0, single: bool = True, stream: bool = False, priority: int = scheduler.NORMAL) -> "str | list[str] | Stream":
+    """
+    Calls go through scheduler.SCHEDULER, which keeps to rate limits and retries failures.
+    priority is one of scheduler.INTERACTIVE, scheduler.NORMAL and scheduler.BACKGROUND.
+    """
     if single:
         if isinstance(query, str):
             query = [(USER, query)]
-        return _call_LLM(query, model, temp)
+        if stream:
+            return stream_LLM(query, model, temp)
+        return _submit(query, model, temp, priority).result()
     
     if isinstance(query[0], str):
         query = [[(USER, q)] for q in query]
     
-    with ThreadPoolExecutor(max_workers=100) as exc:
-        result = [None] * len(query)
-        future_to_idx = {exc.submit(_call_LLM, q, model, temp): i for i, q in enumerate(query)}
-        for future in as_completed(future_to_idx):
-            result[future_to_idx[future]] = future.result()
-        return result
+    futures = [_submit(q, model, temp, priority) for q in query]
+    return [future.result() for future in futures]
+
+def _submit(query: list[tuple[int, str]], model: str, temp: float, priority: int) -> Future:
+    cache_id = get_backend().cache_id
+    cached = None if RESPONSE_CACHE is None else RESPONSE_CACHE.get(query, model, temp, cache_id)
+    if cached is not None:
+        tracing.record("llm", model=model, cache_hits=1)
+        future = Future()
+        future.set_result(cached)
+        return future
+
+    future = scheduler.SCHEDULER.submit(_call_LLM, query, model, temp, priority=priority, model=model, tokens=_tokens(query))
+    if RESPONSE_CACHE is not None and RESPONSE_CACHE.cacheable(temp):
+        cache = RESPONSE_CACHE
+        future.add_done_callback(lambda f: f.exception() is None and cache.put(query, model, temp, cache_id, f.result()))
+    return future
 
 # does final processing and actual call - seperate from threading
 def _call_LLM(query: list[tuple[int, str]], model: str, temp: float) -> str:
-    return BACKEND.chat.completions.create(
-        messages=[{"role": ["user", "assistant", "system"][t], "content": c} for t, c in query], 
-        model=model, 
-        temperature=temp
-    ).choices[0].message.content
+    with tracing.span("llm", model=model) as span:
+        response = get_backend().chat(query, model, temp)
+        if span:
+            span.set(prompt_tokens=_tokens(query), completion_tokens=count_tokens(response))
+        return response
+
+# token count of a prompt, for rate limiting
+def _tokens(query: list[tuple[int, str]] | list[str]) -> int:
+    return sum(count_tokens(q if isinstance(q, str) else q[1]) for q in query) + 1
+
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+def count_tokens(text: str) -> int:
+    """
+    approximate number of tokens in the text - one per word or punctuation mark,
+    plus one per extra 4 characters of long words. Close enough for budgeting, without a tokenizer.
+    """
+    return sum(1 + (len(t) - 1) // 4 for t in _TOKEN.findall(text))
+
+def chunk_text(text: str, max_tokens: int = 2000, overlap: int = 200) -> list[str]:
+    """
+    Splits text into chunks of up to max_tokens, on line boundaries where possible,
+    with each chunk repeating about overlap tokens from the end of the one before.
+    """
+    lines = []
+    for line in text.splitlines():
+        if count_tokens(line) <= max_tokens:
+            lines.append(line)
+            continue
+        # a single line too long for a chunk is split between words
+        words = line.split()
+        step = max(1, len(words) * max_tokens // count_tokens(line))
+        for i in range(0, len(words), step):
+            lines.extend(_cut(" ".join(words[i:i + step]), max_tokens))
+
+    chunks, current, size = [], [], 0
+    for line in lines:
+        tokens = count_tokens(line)
+        if current and size + tokens > max_tokens:
+            chunks.append("\n".join(current))
+            # carry the last lines over, up to overlap tokens
+            carried, carried_size = [], 0
+            for prev in reversed(current):
+                prev_size = count_tokens(prev)
+                if carried_size + prev_size > overlap or carried_size + prev_size + tokens > max_tokens:
+                    break
+                carried.insert(0, prev)
+                carried_size += prev_size
+            current, size = carried, carried_size
+        current.append(line)
+        size += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def _cut(text: str, max_tokens: int) -> list[str]:
+    """text in pieces of up to max_tokens, cut between characters if it has to be - e.g. long URLs"""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return [text]
+    # a character is never more than a token, so this always ends
+    step = max(1, len(text) * max_tokens // tokens)
+    return [piece for i in range(0, len(text), step) for piece in _cut(text[i:i + step], max_tokens)]
+
+class Stream:
+    """
+    Wraps an iterable of text chunks, such as a streamed LLM reply.
+    Keeps the full text, the time to first chunk (ttft) and the total time, all in seconds.
+    on_done is called with the full text once the chunks run out.
+    """
+    def __init__(self, chunks: Iterable[str], on_done: Callable[[str], None] | None = None):
+        self._chunks = iter(chunks)
+        self._on_done = on_done
+        self._parts = []
+        self._start = time.perf_counter()
+        self.ttft = None
+        self.elapsed = None
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if self.done:
+            raise StopIteration
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self.done = True
+            self.elapsed = time.perf_counter() - self._start
+            if self._on_done is not None:
+                self._on_done(self.text)
+            raise
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self._start
+        self._parts.append(chunk)
+        return chunk
+
+    @property
+    def text(self) -> str:
+        """everything received so far"""
+        return "".join(self._parts)
+
+    def drain(self) -> str:
+        """reads whatever is left, returning the full text"""
+        for _ in self:
+            pass
+        return self.text
+
+def stream_LLM(query: str | list[tuple[int, str]], model: str = GPT4, temp: float = 0.0) -> Stream:
+    """like call_LLM, but returns the reply as a Stream of chunks as they arrive"""
+    if isinstance(query, str):
+        query = [(USER, query)]
+    cache_id = get_backend().cache_id
+    cached = None if RESPONSE_CACHE is None else RESPONSE_CACHE.get(query, model, temp, cache_id)
+    if cached is not None:
+        tracing.record("llm", model=model, cache_hits=1)
+        return Stream([cached])
+
+    cache = RESPONSE_CACHE if RESPONSE_CACHE is not None and RESPONSE_CACHE.cacheable(temp) else None
+
+    def on_done(text: str) -> None:
+        if cache is not None:
+            cache.put(query, model, temp, cache_id, text)
+        if tracing.ENABLED:
+            tracing.record(
+                "llm", stream.elapsed, model=model, streamed=1, ttft_ms=(stream.ttft or stream.elapsed) * 1000,
+                prompt_tokens=_tokens(query), completion_tokens=count_tokens(text),
+            )
+
+    # the stream holds its connection for the whole reply, so it's made here rather than on a scheduler worker
+    scheduler.SCHEDULER.admit(model, _tokens(query))
+    stream = Stream(get_backend().stream_chat(query, model, temp), on_done=on_done)
+    return stream
+
+async def acall_LLM(query: str | list[tuple[int, str]] | list[str] | list[list[tuple[int, str]]], model: str = GPT4, temp: float = 0.0, single: bool = True, priority: int = scheduler.NORMAL) -> str | list[str]:
+    """async version of call_LLM - the calls run on the scheduler and are awaited together"""
+    if single:
+        if isinstance(query, str):
+            query = [(USER, query)]
+        return await asyncio.wrap_future(_submit(query, model, temp, priority))
+
+    if isinstance(query[0], str):
+        query = [[(USER, q)] for q in query]
+    return list(await asyncio.gather(*(asyncio.wrap_future(_submit(q, model, temp, priority)) for q in query)))
 
 
 def shuffled(lst):
@@ -71,20 +259,161 @@ def last_n(lst: list, n: int, key: Callable[[object], float] | str | None = None
 def jlines(lines: list[str]) -> str:
     return "\n".join(map(str, lines))
 
-def get_embedding(text: str | list[str], norm: bool = True) -> list[float] | list[list[float]]:
+class Embedder:
+    """
+    Coalesces embedding requests from every thread into batched calls.
+    Texts are collected for up to window seconds, or until max_batch are waiting,
+    then sent as one multi-input request per model, each distinct text only once.
+    Vectors come back through futures. Texts already in EMBED_CACHE never wait.
+    """
+    def __init__(self, window: float = 0.01, max_batch: int = 512):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {} # model -> {text: (future, priority)}
+        self._count = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, texts: list[str], model: str = EMBED_MODEL, priority: int = scheduler.NORMAL) -> list[Future]:
+        """One future per text, resolving to its (unnormalized) embedding."""
+        if EMBED_CACHE is None:
+            vectors, missing = [None] * len(texts), range(len(texts))
+        else:
+            vectors, missing = EMBED_CACHE.get(texts, model, get_backend().cache_id)
+
+        futures = []
+        for vector in vectors:
+            futures.append(Future())
+            if vector is not None:
+                futures[-1].set_result(vector)
+        if not missing:
+            return futures
+
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            pending = self._pending.setdefault(model, {})
+            for i in missing:
+                # the same text asked for twice shares one future
+                if texts[i] in pending:
+                    future, prio = pending[texts[i]]
+                    pending[texts[i]] = (future, min(prio, priority))
+                else:
+                    pending[texts[i]] = (futures[i], priority)
+                    self._count += 1
+                futures[i] = pending[texts[i]][0]
+            self._cond.notify()
+        return futures
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._count:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.window
+                while self._count < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batches, self._pending, self._count = self._pending, {}, 0
+
+            for model, pending in batches.items():
+                items = list(pending.items())
+                for start in range(0, len(items), self.max_batch):
+                    self._send(model, items[start:start + self.max_batch])
+
+    def _send(self, model: str, items: list[tuple[str, tuple[Future, int]]]) -> None:
+        texts = [text for text, _ in items]
+        futures = [future for _, (future, _) in items]
+        priority = min(prio for _, (_, prio) in items)
+        cache_id = get_backend().cache_id
+        try:
+            request = scheduler.SCHEDULER.submit(_embed, texts, model, priority=priority, model=model, tokens=_tokens(texts))
+        except RuntimeError as e: # interpreter shutting down
+            self._fail(futures, e)
+            return
+
+        def done(request: Future) -> None:
+            try:
+                vectors = np.asarray(request.result(), dtype=np.float32)
+                if len(vectors) != len(futures):
+                    raise ValueError(f"asked for {len(futures)} embeddings, got {len(vectors)}")
+                for future, vector in zip(futures, vectors):
+                    future.set_result(vector)
+            except BaseException as e:
+                self._fail(futures, e)
+                return
+            # callers already have their vectors, so a cache that can't be written to only costs a re-embed later
+            if EMBED_CACHE is not None:
+                try:
+                    EMBED_CACHE.put(texts, vectors, model, cache_id)
+                except Exception:
+                    tracing.record("embed_cache", errors=1)
+
+        request.add_done_callback(done)
+
+    @staticmethod
+    def _fail(futures: list[Future], e: BaseException) -> None:
+        """fails every future not yet resolved, so nobody waits forever"""
+        for future in futures:
+            if not future.done():
+                future.set_exception(e)
+
+EMBEDDER = Embedder()
+
+def _clean(text: str) -> str:
+    return text.replace("\n", " ") if text else "this is blank"
+
+def embed_async(text: str | list[str], model: str = EMBED_MODEL, priority: int = scheduler.NORMAL) -> Future | list[Future]:
+    """like get_embedding, but returns futures of the unnormalized vectors instead of waiting"""
+    single, text = (True, [text]) if isinstance(text, str) else (False, text)
+    futures = EMBEDDER.submit([_clean(t) for t in text], model, priority)
+    return futures[0] if single else futures
+
+def get_embedding(text: str | list[str], norm: bool = True, model: str = EMBED_MODEL, priority: int = scheduler.NORMAL) -> list[float] | list[list[float]]:
     """
     returns an embedding vector of the text. 
     This can be used to compute the similarity of the meanings of 2 strings.
+    Vectors are looked up in EMBED_CACHE first, so each text is only ever sent once per model,
+    and the rest are batched with everything else being embedded at the time (see Embedder).
     """
     single, text = (True, [text]) if isinstance(text, str) else (False, text)
-    text = [t.replace("\n", " ") if t else "this is blank" for t in text]
-    # response = BACKEND.embeddings.create(input=text, model="text-embedding-3-small")
-    response = BACKEND.embeddings.create(input=text, model="text-embedding-3-large")
-    result = np.array([emb.embedding for emb in response.data], dtype=np.float32)
+    with tracing.span("embed", texts=len(text)) as span:
+        futures = EMBEDDER.submit([_clean(t) for t in text], model, priority)
+        if span:
+            # cached vectors come back already resolved
+            span.set(cache_hits=sum(future.done() for future in futures))
+        result = np.stack([future.result() for future in futures]).astype(np.float32)
+
     if norm:
         result = result / np.linalg.norm(result, axis=1)[:, None]
     return result[0] if single else result
 
+def _embed(texts: list[str], model: str) -> np.ndarray:
+    with tracing.span("embed_batch", model=model, texts=len(texts)) as span:
+        if span:
+            span.set(tokens=_tokens(texts))
+        return get_backend().embed(texts, model)
+
+def dedup(texts: list[str], threshold: float = 0.95, model: str = EMBED_MODEL) -> list[str]:
+    """
+    texts without near-duplicates, in order - a text is dropped if its embedding has
+    cosine similarity of at least threshold with one already kept.
+    """
+    texts = [t for t in dict.fromkeys(texts) if t.strip()]
+    if len(texts) < 2:
+        return texts
+    emb = get_embedding(texts, model=model)
+    keep = np.zeros(len(texts), dtype=bool)
+    for start in range(0, len(texts), 1024):
+        # similarities of this block to everything before it and itself
+        sim = emb[start:start + 1024] @ emb[:start + 1024].T >= threshold
+        for i in range(start, min(start + 1024, len(texts))):
+            keep[i] = not sim[i - start, :i][keep[:i]].any()
+    return [t for t, k in zip(texts, keep) if k]
+
 def cos_sim(a: list[float], b: list[float], norm: bool = False) -> float:
     """
     returns the cosine similarity between 2 vectors, 